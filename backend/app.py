@@ -1,50 +1,288 @@
-from flask import Flask, request, jsonify, render_template, redirect, url_for, session, send_from_directory, send_file
+from flask import Flask, request, jsonify, render_template, redirect, url_for, session, send_from_directory, send_file, stream_with_context
 from flask_cors import CORS
 from flask_session import Session
-from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity
-from db_manager import add_location, add_memory, get_locations, add_user, get_memories, verify_user, get_user_by_email, delete_location, delete_memories, update_memory, get_memory_files, add_file_to_memory, remove_file_from_memory, update_file_display_name
+from flask_jwt_extended import JWTManager, create_access_token, create_refresh_token, decode_token, jwt_required, get_jwt, get_jwt_identity
+from db_manager import (
+    add_location, add_memory, get_locations, get_locations_in_bbox, get_locations_near, ensure_indexes, close as close_db,
+    add_locations_bulk, add_memories_bulk, export_user_data,
+    add_user, get_memories, verify_user, get_user_by_email, get_memories_page, memory_filters, search_memories, MEMORY_SUMMARY_FIELDS,
+    delete_location, delete_memories, update_memory, get_memory_files, add_file_to_memory,
+    remove_file_from_memory, update_file_display_name, get_memory_by_id, delete_memory_by_id,
+    update_memory_by_id, get_memory_files_by_id, add_file_to_memory_by_id, remove_file_from_memory_by_id,
+    update_file_display_name_by_id, delete_location_by_id, update_location_by_id, get_data_version,
+    record_upload, add_files_to_memory_by_id, iter_memories, get_changes
+)
+import deletion_queue
+from deletion_queue import DeletionWorker
+from cloudinary_config import upload_signature, verified_upload
+from token_denylist import TokenDenylist
+from cache import create_cache
+from clustering import get_clusters
+from geo_tiles import QUADKEY_ZOOM
+import observability
+import compression
+import events
+import static_assets
+import passwords
+import media
+import rate_limit
+from json_provider import FastJSONProvider, stream_json_array
+from urllib.parse import urlencode
+from datetime import timedelta
+from werkzeug.middleware.proxy_fix import ProxyFix
+import hashlib
+import time
+import json
+import logging
+import math
 import os
 
-app = Flask(__name__, static_folder='../frontend/dist', static_url_path='')
+# Niente route statica automatica di Flask: la build del frontend la serve static_files
+app = Flask(__name__, static_folder=None)
+app.static_folder = '../frontend/dist'
+# Reverse proxy fidati davanti all'app: request.remote_addr (limiti di login,
+# METRICS_ALLOW) diventa l'IP del client preso da X-Forwarded-For
+TRUSTED_PROXIES = int(os.environ.get('TRUSTED_PROXIES', 0))
+if TRUSTED_PROXIES:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES, x_proto=TRUSTED_PROXIES, x_host=TRUSTED_PROXIES)
 CORS(app, supports_credentials=True, origins=['http://localhost:5173', 'http://localhost:3000'])
 app.secret_key = os.environ.get('SECRET_KEY', 'supersecretkey')
-app.config['SESSION_TYPE'] = 'filesystem'
 app.config['JWT_SECRET_KEY'] = os.environ.get('JWT_SECRET_KEY', 'jwtsecretkey')
-Session(app)
+app.json = FastJSONProvider(app)
 jwt = JWTManager(app)
+observability.init_app(app)
+compression.init_app(app)
+logger = logging.getLogger(__name__)
+token_denylist = TokenDenylist()
+list_cache = create_cache()
+static_manifest = static_assets.StaticManifest(app.static_folder)
 
-# Serve the main frontend application (SPA catch-all)
-@app.route('/')
-def index():
+def _configure_sessions():
+    """Sessioni server-side opzionali: l'autenticazione delle API usa solo i JWT.
+
+    SESSION_BACKEND: 'none' (default, cookie firmato di Flask, nessun I/O),
+    'memory' (cache nel processo), 'redis' (REDIS_URL, anche server compatibili)
+    oppure 'filesystem' (comportamento precedente).
+    """
+    backend = os.environ.get('SESSION_BACKEND', 'none')
+    if backend == 'none':
+        return
+    if backend == 'memory':
+        from cachelib import SimpleCache
+        app.config['SESSION_TYPE'] = 'cachelib'
+        app.config['SESSION_CACHELIB'] = SimpleCache(threshold=int(os.environ.get('SESSION_MEMORY_SIZE', 10000)))
+    elif backend == 'redis':
+        import redis
+        app.config['SESSION_TYPE'] = 'redis'
+        app.config['SESSION_REDIS'] = redis.from_url(os.environ.get('REDIS_URL', 'redis://localhost:6379/0'))
+    elif backend == 'filesystem':
+        app.config['SESSION_TYPE'] = 'filesystem'
+    else:
+        raise ValueError(f"SESSION_BACKEND non valido: {backend}")
+    Session(app)
+
+_configure_sessions()
+
+@jwt.token_in_blocklist_loader
+def check_if_token_revoked(jwt_header, jwt_payload):
+    return token_denylist.is_revoked(jwt_payload['jti'])
+
+@jwt.token_verification_loader
+def check_token_scope(jwt_header, jwt_payload):
+    # I token per lo stream degli eventi valgono solo su /api/events
+    return not jwt_payload.get(events.TOKEN_CLAIM) or request.endpoint == 'api_events'
+
+@jwt.token_verification_failed_loader
+def token_scope_error(jwt_header, jwt_payload):
+    return jsonify({'error': 'Token non valido per questa API'}), 401
+
+def create_app():
+    """Inizializza l'app per il processo corrente e la restituisce.
+
+    Crea gli indici e avvia i thread in background; va chiamata dopo il fork
+    (wsgi.py con gunicorn, oppure 'python app.py' in sviluppo). Le chiamate
+    successive restituiscono l'app già inizializzata.
+    """
+    if 'deletion_worker' in app.extensions:
+        return app
+    observability.configure_logging()
+    # Pool degli hash delle password: prima di qualunque thread in background
+    passwords.start()
+    if static_assets.STATIC_MANIFEST:
+        static_manifest.scan()
+        logger.info("Build del frontend in memoria: %s", static_manifest.stats())
+    try:
+        ensure_indexes()
+    except Exception as e:
+        logger.warning("Impossibile creare gli indici (usa 'python manage_db.py indexes' per i dettagli): %s", e)
+
+    # Worker in background per le eliminazioni da Cloudinary (DELETION_WORKER=0 per disattivarlo,
+    # ad esempio se si avvia 'python deletion_queue.py' come processo separato)
+    deletion_worker = DeletionWorker()
+    if os.environ.get('DELETION_WORKER', '1') != '0':
+        deletion_worker.start()
+    app.extensions['deletion_worker'] = deletion_worker
+    # Change stream di MongoDB per /api/events (solo con EVENTS_BACKEND=mongo)
+    listener = events.start_backend()
+    if listener:
+        app.extensions['events_listener'] = listener
+    return app
+
+def shutdown_app():
+    """Ferma i thread in background e chiude le connessioni (graceful shutdown)"""
+    deletion_worker = app.extensions.pop('deletion_worker', None)
+    if deletion_worker:
+        deletion_worker.stop()
+    listener = app.extensions.pop('events_listener', None)
+    if listener:
+        listener.stop()
+    passwords.shutdown()
+    close_db()
+
+def _cached_json(email, kind, loader):
+    """Risposta JSON di una lista con cache per versione dei dati ed ETag.
+
+    Se il client ha già la versione corrente (If-None-Match) risponde 304
+    senza leggere nulla; altrimenti usa il JSON in cache o lo genera con loader().
+    """
+    variant = hashlib.sha1(urlencode(sorted(request.args.items(multi=True))).encode('utf-8')).hexdigest()[:12]
+    version = get_data_version(email)
+    # L'ETag identifica anche l'utente: con un browser condiviso un altro
+    # account non deve poter rivalidare (304) la copia in cache di un altro
+    user = hashlib.sha1(email.encode('utf-8')).hexdigest()[:12]
+    etag = f"{kind}-{user}-{version}-{variant}"
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+    else:
+        # In cache il corpo è già compresso nella codifica accettata dal client;
+        # sotto COMPRESS_MIN_SIZE non si comprime e c'è solo la versione 'identity'
+        encoding = compression.choose_encoding(request)
+        key = f"{kind}:{email}:{version}:{variant}"
+        body = list_cache.get(f"{key}:{encoding}") if encoding else None
+        if body is None:
+            body = list_cache.get(f"{key}:identity")
+            if body is None:
+                body = app.json.dumps(loader()).encode('utf-8')
+                if not encoding or len(body) < compression.COMPRESS_MIN_SIZE:
+                    list_cache.set(f"{key}:identity", body)
+            if encoding and len(body) >= compression.COMPRESS_MIN_SIZE:
+                body = compression.compress(body, encoding)
+                list_cache.set(f"{key}:{encoding}", body)
+            else:
+                encoding = None
+        response = app.response_class(body, mimetype='application/json')
+        if encoding:
+            compression.mark_encoded(response, encoding)
+    # ETag debole: lo stesso contenuto può essere inviato con codifiche diverse
+    response.set_etag(etag, weak=True)
+    response.vary.add('Accept-Encoding')
+    response.vary.add('Authorization')
+    # Il browser deve sempre rivalidare: la risposta cambia ad ogni scrittura
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+def _bulk_items():
+    """Elementi di una richiesta bulk: array JSON oppure NDJSON letto riga per riga dallo stream"""
+    if request.mimetype == 'application/x-ndjson':
+        def lines():
+            for line in request.stream:
+                if not line.strip():
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    yield None  # riga non valida: segnalata come errore dell'elemento
+        return lines()
+    data = request.get_json(silent=True)
+    if not isinstance(data, list):
+        return None
+    return data
+
+def _bulk_response(results):
+    errors = sum(1 for r in results if 'error' in r)
+    status = 201 if errors == 0 else 207
+    return jsonify({'inserted': len(results) - errors, 'errors': errors, 'results': results}), status
+
+def _parse_floats(value, count):
+    """Converte 'a,b,...' in una lista di count float, o None se non valida"""
+    try:
+        numbers = [float(v) for v in value.split(',')]
+    except (AttributeError, ValueError):
+        return None
+    return numbers if len(numbers) == count else None
+
+def _send_index():
+    # index.html dalla memoria se il manifest è attivo, altrimenti dal disco
+    response = static_assets.send_index(static_manifest, request)
+    if response is not None:
+        return response
     try:
         return send_from_directory(app.static_folder, 'index.html')
     except FileNotFoundError:
         return "Frontend build not found. Please run 'npm run build' in the frontend directory.", 404
 
+# Serve the main frontend application (SPA catch-all)
+@app.route('/')
+def index():
+    return _send_index()
+
 # Serve static assets (CSS, JS, images, etc.)
 @app.route('/<path:filename>')
 def static_files(filename):
+    response = static_assets.send_asset(static_manifest, filename, request)
+    if response is not None:
+        return response
     try:
+        # File non presente nel manifest (build successiva all'avvio o STATIC_MANIFEST=0)
         return send_from_directory(app.static_folder, filename)
     except FileNotFoundError:
         # If it's not a static file, serve index.html for SPA routing
         if not filename.startswith('api/') and '.' not in filename.split('/')[-1]:
-            try:
-                return send_from_directory(app.static_folder, 'index.html')
-            except FileNotFoundError:
-                return "Frontend build not found. Please run 'npm run build' in the frontend directory.", 404
+            return _send_index()
         return "File not found", 404
 
+def _throttled(email=None):
+    """Risposta 429 se l'IP o l'email hanno esaurito i tentativi, altrimenti None"""
+    wait = rate_limit.check_login(request.remote_addr, email)
+    if not wait:
+        return None
+    response = jsonify({'error': 'Troppi tentativi, riprova più tardi'})
+    response.headers['Retry-After'] = str(math.ceil(wait))
+    return response, 429
+
+@app.errorhandler(passwords.HashingBusy)
+def hashing_busy(e):
+    # Troppi login/registrazioni in corso: meglio rifiutare subito che accodare
+    response = jsonify({'error': 'Servizio temporaneamente occupato, riprova tra poco'})
+    response.headers['Retry-After'] = '1'
+    return response, 503
+
+# Varianti delle immagini generate localmente (media.py): il nome dipende dall'URL originale
+@app.route(f'{media.MEDIA_URL_PATH}/<path:filename>')
+def media_files(filename):
+    response = send_from_directory(media.MEDIA_DIR, filename, max_age=static_assets.IMMUTABLE_MAX_AGE)
+    response.cache_control.immutable = True
+    return response
+
 @app.route('/api/login', methods=['POST'])
 def api_login():
     data = request.json
     email = data.get('email')
     password = data.get('password')
+    # Credenziali mancanti o non stringhe: nessun utente può corrispondere
+    if not isinstance(email, str) or not isinstance(password, str):
+        return jsonify({'error': 'Email o password errati'}), 401
+    throttled = _throttled(email)
+    if throttled:
+        return throttled
     user = verify_user(email, password)
     if user:
         access_token = create_access_token(identity=email)
-        return jsonify({'access_token': access_token, 'email': email, 'name': user['name']}), 200
+        refresh_token = create_refresh_token(identity=email)
+        return jsonify({'access_token': access_token, 'refresh_token': refresh_token, 'email': email, 'name': user['name']}), 200
     else:
+        # Solo i tentativi falliti contano per il limite sull'email
+        rate_limit.record_failure(request.remote_addr, email)
         return jsonify({'error': 'Email o password errati'}), 401
 
 @app.route('/api/register', methods=['POST'])
@@ -53,18 +291,78 @@ def api_register():
     email = data.get('email')
     name = data.get('name')
     password = data.get('password')
+    throttled = _throttled()
+    if throttled:
+        return throttled
     if add_user(email, name, password):
         access_token = create_access_token(identity=email)
-        return jsonify({'access_token': access_token, 'email': email, 'name': name}), 201
+        refresh_token = create_refresh_token(identity=email)
+        return jsonify({'access_token': access_token, 'refresh_token': refresh_token, 'email': email, 'name': name}), 201
     else:
         return jsonify({'error': 'Email già registrata'}), 409
 
+@app.route('/api/token/refresh', methods=['POST'])
+@jwt_required(refresh=True)
+def api_refresh_token():
+    email = get_jwt_identity()
+    return jsonify({'access_token': create_access_token(identity=email)}), 200
+
+@app.route('/api/logout', methods=['POST'])
+@jwt_required(verify_type=False)
+def api_logout():
+    # Revoca il token usato per la richiesta e, se inviato, anche il refresh token
+    claims = get_jwt()
+    token_denylist.revoke(claims['jti'], claims['exp'])
+    refresh_token = (request.get_json(silent=True) or {}).get('refresh_token')
+    if refresh_token:
+        try:
+            refresh_claims = decode_token(refresh_token)
+        except Exception:
+            return jsonify({'error': 'refresh_token non valido'}), 400
+        if refresh_claims.get('sub') == claims.get('sub'):
+            token_denylist.revoke(refresh_claims['jti'], refresh_claims['exp'])
+    return jsonify({'status': 'logged out'}), 200
+
 @app.route('/api/locations', methods=['GET'])
 @jwt_required()
 def api_get_locations():
     email = get_jwt_identity()
-    locations = get_locations(email)
-    return jsonify(locations)
+    bbox = request.args.get('bbox')
+    near = request.args.get('near')
+    if bbox is not None:
+        # bbox=minLon,minLat,maxLon,maxLat (ordine GeoJSON)
+        coords = _parse_floats(bbox, 4)
+        if not coords or not (-180 <= coords[0] <= 180 and -180 <= coords[2] <= 180
+                              and -90 <= coords[1] < coords[3] <= 90):
+            return jsonify({'error': 'bbox non valido (minLon,minLat,maxLon,maxLat)'}), 400
+        loader = lambda: get_locations_in_bbox(email, *coords)
+    elif near is not None:
+        # near=lat,lon&radius=metri&limit=n
+        coords = _parse_floats(near, 2)
+        radius = request.args.get('radius', type=float)
+        limit = request.args.get('limit', type=int)
+        if not coords or not (-90 <= coords[0] <= 90 and -180 <= coords[1] <= 180):
+            return jsonify({'error': 'near non valido (lat,lon)'}), 400
+        if radius is not None and radius < 0:
+            return jsonify({'error': 'radius non valido'}), 400
+        loader = lambda: get_locations_near(email, coords[0], coords[1], radius, limit)
+    else:
+        loader = lambda: get_locations(email)
+    return _cached_json(email, 'locations', loader)
+
+@app.route('/api/locations/clusters', methods=['GET'])
+@jwt_required()
+def api_get_location_clusters():
+    email = get_jwt_identity()
+    # bbox=minLon,minLat,maxLon,maxLat&zoom=livello Web Mercator della vista
+    coords = _parse_floats(request.args.get('bbox', '-180,-90,180,90'), 4)
+    zoom = request.args.get('zoom', type=int)
+    if not coords or not (-180 <= coords[0] <= 180 and -180 <= coords[2] <= 180
+                          and -90 <= coords[1] < coords[3] <= 90):
+        return jsonify({'error': 'bbox non valido (minLon,minLat,maxLon,maxLat)'}), 400
+    if zoom is None or not 0 <= zoom <= QUADKEY_ZOOM:
+        return jsonify({'error': f'zoom deve essere tra 0 e {QUADKEY_ZOOM}'}), 400
+    return _cached_json(email, 'clusters', lambda: get_clusters(email, *coords, zoom))
 
 @app.route('/api/locations', methods=['POST'])
 @jwt_required()
@@ -90,7 +388,57 @@ def api_delete_location(title, lat, lon):
     else:
         return jsonify({'error': 'Not found'}), 404
 
+@app.route('/api/locations/<string(length=24):location_id>', methods=['DELETE'])
+@jwt_required()
+def api_delete_location_by_id(location_id):
+    email = get_jwt_identity()
+    if delete_location_by_id(location_id, email):
+        return jsonify({'status': 'deleted'})
+    return jsonify({'error': 'Not found'}), 404
+
+@app.route('/api/locations/<string(length=24):location_id>', methods=['PUT'])
+@jwt_required()
+def api_update_location_by_id(location_id):
+    email = get_jwt_identity()
+    updated = request.json
+    if not updated:
+        return jsonify({'error': 'Dati mancanti'}), 400
+    if not update_location_by_id(location_id, updated, email):
+        return jsonify({'error': 'Posizione non trovata'}), 404
+    return jsonify({'status': 'updated'})
+
+@app.route('/api/locations/bulk', methods=['POST'])
+@jwt_required()
+def api_add_locations_bulk():
+    email = get_jwt_identity()
+    items = _bulk_items()
+    if items is None:
+        return jsonify({'error': 'Atteso un array JSON o NDJSON'}), 400
+    return _bulk_response(add_locations_bulk(items, email))
+
 #------------------------------------------------------------------------
+@app.route('/api/memories/bulk', methods=['POST'])
+@jwt_required()
+def api_add_memories_bulk():
+    email = get_jwt_identity()
+    items = _bulk_items()
+    if items is None:
+        return jsonify({'error': 'Atteso un array JSON o NDJSON'}), 400
+    return _bulk_response(add_memories_bulk(items, email))
+
+@app.route('/api/export', methods=['GET'])
+@jwt_required()
+def api_export():
+    email = get_jwt_identity()
+
+    def generate():
+        for item in export_user_data(email):
+            yield app.json.dumps(item) + '\n'
+
+    response = app.response_class(stream_with_context(generate()), mimetype='application/x-ndjson')
+    response.headers['Content-Disposition'] = 'attachment; filename=geomemories-export.ndjson'
+    return response
+
 @app.route('/api/memories', methods=['POST'])
 @jwt_required()
 def api_add_memory():
@@ -110,8 +458,67 @@ def api_add_memory():
 @jwt_required()
 def api_get_memory():
     email = get_jwt_identity()
-    memories = get_memories(email)
-    return jsonify(memories)
+    fields = request.args.get('fields')
+    if request.args.get('mode') == 'summary':
+        fields = list(MEMORY_SUMMARY_FIELDS)
+    elif fields is not None:
+        # fields= vuoto equivale a nessun filtro sui campi
+        fields = [f.strip() for f in fields.split(',') if f.strip()] or None
+    limit = request.args.get('limit', type=int)
+    cursor = request.args.get('cursor')
+    # Dei file si restituisce solo la variante ridotta (media=thumbnail|preview|poster|full)
+    variant = request.args.get('media', media.DEFAULT_LIST_VARIANT)
+    # Filtri: near=lat,lon&radius=metri, from=YYYY-MM-DD&to=YYYY-MM-DD, location_id=id
+    near = request.args.get('near')
+    if near is not None:
+        coords = _parse_floats(near, 2)
+        radius = request.args.get('radius', type=float)
+        if not coords or not (-90 <= coords[0] <= 90 and -180 <= coords[1] <= 180):
+            return jsonify({'error': 'near non valido (lat,lon)'}), 400
+        if radius is not None and radius < 0:
+            return jsonify({'error': 'radius non valido'}), 400
+        near = (coords[0], coords[1], radius)
+
+    if request.args.get('stream') == '1' and limit is None and cursor is None:
+        # Lista completa generata dal cursore a blocchi, senza costruirla in memoria (non in cache)
+        try:
+            query = memory_filters(email, request.args.get('from'), request.args.get('to'),
+                                   request.args.get('location_id'), near)
+            memories = iter_memories(email, fields, query, variant=variant)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        chunks = stream_json_array(memories, app.json.dumps)
+        return app.response_class(stream_with_context(chunks), mimetype='application/json')
+
+    def loader():
+        query = memory_filters(email, request.args.get('from'), request.args.get('to'),
+                               request.args.get('location_id'), near)
+        if limit is None and cursor is None:
+            # Senza paginazione la risposta resta la lista completa
+            return get_memories(email, fields, query, variant)
+        memories, next_cursor = get_memories_page(email, limit or 50, cursor, fields, query, variant)
+        return {'memories': memories, 'next_cursor': next_cursor}
+
+    try:
+        return _cached_json(email, 'memories', loader)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/api/memories/search', methods=['GET'])
+@jwt_required()
+def api_search_memories():
+    email = get_jwt_identity()
+    q = request.args.get('q', '').strip()
+    if not q:
+        return jsonify({'error': 'q è obbligatorio'}), 400
+    limit = request.args.get('limit', 20, type=int)
+    offset = request.args.get('offset', 0, type=int)
+
+    def loader():
+        results, next_offset = search_memories(email, q, limit, offset)
+        return {'results': results, 'next_offset': next_offset}
+
+    return _cached_json(email, 'search', loader)
 
 @app.route('/api/memories/<title>/<date>/<text>', methods=['DELETE'])
 @jwt_required()
@@ -134,6 +541,69 @@ def api_update_memory(title, date, text):
     else:
         return jsonify({'error': 'Not found or not updated'}), 404
 
+#------------------------------------------------------------------------
+# API per id (memory_id restituito da POST /api/memories o campo id nelle liste)
+@app.route('/api/memories/<string(length=24):memory_id>', methods=['GET'])
+@jwt_required()
+def api_get_memory_by_id(memory_id):
+    email = get_jwt_identity()
+    memory = get_memory_by_id(memory_id, email)
+    if memory:
+        return jsonify(memory)
+    return jsonify({'error': 'Not found'}), 404
+
+@app.route('/api/memories/<string(length=24):memory_id>', methods=['DELETE'])
+@jwt_required()
+def api_delete_memory_by_id(memory_id):
+    email = get_jwt_identity()
+    if delete_memory_by_id(memory_id, email):
+        return jsonify({'status': 'deleted'})
+    return jsonify({'error': 'Not found'}), 404
+
+@app.route('/api/memories/<string(length=24):memory_id>', methods=['PUT'])
+@jwt_required()
+def api_update_memory_by_id(memory_id):
+    email = get_jwt_identity()
+    data = request.json
+    if update_memory_by_id(memory_id, email, data):
+        return jsonify({'status': 'updated'})
+    return jsonify({'error': 'Not found or not updated'}), 404
+
+@app.route('/api/memories/<string(length=24):memory_id>/files', methods=['GET'])
+@jwt_required()
+def api_get_memory_files_by_id(memory_id):
+    email = get_jwt_identity()
+    return jsonify(get_memory_files_by_id(memory_id, email))
+
+@app.route('/api/memories/<string(length=24):memory_id>/files', methods=['POST'])
+@jwt_required()
+def api_add_file_to_memory_by_id(memory_id):
+    email = get_jwt_identity()
+    data = request.json
+    if add_file_to_memory_by_id(memory_id, email, data):
+        return jsonify({'status': 'file added'})
+    return jsonify({'error': 'Memory not found or file not added'}), 404
+
+@app.route('/api/memories/<string(length=24):memory_id>/files/<path:file_url>', methods=['DELETE'])
+@jwt_required()
+def api_remove_file_from_memory_by_id(memory_id, file_url):
+    email = get_jwt_identity()
+    if remove_file_from_memory_by_id(memory_id, email, file_url):
+        return jsonify({'status': 'file removed'})
+    return jsonify({'error': 'Memory or file not found'}), 404
+
+@app.route('/api/memories/<string(length=24):memory_id>/files/<path:file_url>/display-name', methods=['PUT'])
+@jwt_required()
+def api_update_file_display_name_by_id(memory_id, file_url):
+    email = get_jwt_identity()
+    data = request.json
+    new_display_name = data.get('display_name')
+    if not new_display_name:
+        return jsonify({'error': 'display_name is required'}), 400
+    if update_file_display_name_by_id(memory_id, email, file_url, new_display_name):
+        return jsonify({'status': 'display name updated'})
+    return jsonify({'error': 'Memory or file not found'}), 404
+
 #------------------------------------------------------------------------
 # API specifiche per la gestione dei file
 @app.route('/api/memories/<title>/<date>/<text>/files', methods=['GET'])
@@ -178,6 +648,36 @@ def api_update_file_display_name(title, date, text, file_url):
     else:
         return jsonify({'error': 'Memory or file not found'}), 404
 
+#------------------------------------------------------------------------
+# Upload diretti e firmati verso Cloudinary
+@app.route('/api/uploads/sign', methods=['POST'])
+@jwt_required()
+def api_sign_upload():
+    return jsonify(upload_signature())
+
+@app.route('/api/uploads/complete', methods=['POST'])
+@jwt_required()
+def api_complete_uploads():
+    # {uploads: [risposta Cloudinary + display_name/type], memory_id: opzionale}
+    email = get_jwt_identity()
+    data = request.get_json(silent=True) or {}
+    uploads = data.get('uploads')
+    if not isinstance(uploads, list):
+        return jsonify({'error': 'uploads deve essere una lista'}), 400
+    files = []
+    errors = []
+    for index, upload in enumerate(uploads):
+        # Solo public_id e version sono firmati: URL e tipo vengono ricontrollati
+        upload = verified_upload(upload)
+        if upload is None:
+            errors.append({'index': index, 'error': 'Upload non valido o signature errata'})
+            continue
+        files.append(record_upload(email, upload, upload.get('display_name'), upload.get('type', '')))
+    memory_id = data.get('memory_id')
+    if memory_id and files and not add_files_to_memory_by_id(memory_id, email, files):
+        return jsonify({'error': 'Memory not found', 'files': files, 'errors': errors}), 404
+    return jsonify({'files': files, 'errors': errors}), 200 if not errors else 207
+
 #------------------------------------------------------------------------
 @app.route('/api/locations', methods=['PUT'])
 @jwt_required()
@@ -194,6 +694,89 @@ def api_update_location():
         return jsonify({'error': 'Posizione non trovata'}), 404
     return jsonify({'status': 'updated'})
 
+@app.route('/api/sync', methods=['GET'])
+@jwt_required()
+def api_sync():
+    # since=token restituito dalla sincronizzazione precedente (assente la prima volta)
+    email = get_jwt_identity()
+    try:
+        return jsonify(get_changes(email, request.args.get('since')))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+def _sse(event=None, data=None, event_id=None):
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    if event:
+        lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data, separators=(',', ':'))}")
+    return '\n'.join(lines) + '\n\n'
+
+@app.route('/api/events/token', methods=['POST'])
+@jwt_required()
+def api_events_token():
+    """Token breve, valido solo per aprire /api/events (vedi events.py)"""
+    token = create_access_token(identity=get_jwt_identity(), expires_delta=timedelta(seconds=events.TOKEN_SECONDS),
+                                additional_claims={events.TOKEN_CLAIM: True})
+    return jsonify({'token': token}), 200
+
+@app.route('/api/events', methods=['GET'])
+# EventSource non può inviare header: si accetta solo il token breve di
+# /api/events/token come ?jwt=, mai il token delle API (finirebbe nei log)
+@jwt_required(locations=['query_string'])
+def api_events():
+    """Stream SSE delle modifiche dell'utente (evento 'change' e, se servono, 'resync')"""
+    if not get_jwt().get(events.TOKEN_CLAIM):
+        return jsonify({'error': 'Serve un token di /api/events/token'}), 401
+    email = get_jwt_identity()
+    subscription = events.bus.subscribe(email)
+    if subscription is None:
+        response = jsonify({'error': 'Troppe connessioni attive, riprova più tardi'})
+        response.headers['Retry-After'] = str(events.BUSY_RETRY_SECONDS)
+        return response, 503
+    # Dopo una riconnessione gli eventi persi non sono recuperabili: il client ricarica
+    reconnected = request.headers.get('Last-Event-ID') is not None
+
+    def generate():
+        counter = 0
+        deadline = time.monotonic() + events.MAX_STREAM_SECONDS
+        try:
+            # id: 0 fa inviare Last-Event-ID al browser anche se si ricollega prima di ricevere eventi
+            yield f"retry: {events.RETRY_MS}\nid: 0\n\n"
+            if reconnected:
+                yield _sse('resync', events.RESYNC)
+            while time.monotonic() < deadline:
+                event = subscription.get(timeout=events.HEARTBEAT_SECONDS)
+                if event is None:
+                    # Commento di heartbeat: tiene aperta la connessione attraverso i proxy
+                    yield ': ping\n\n'
+                    continue
+                counter += 1
+                yield _sse('resync' if event is events.RESYNC else 'change', event, counter)
+        finally:
+            events.bus.unsubscribe(subscription)
+
+    response = app.response_class(generate(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # nginx: niente buffering, ogni evento va inviato subito
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    # Solo con METRICS_TOKEN o dagli indirizzi in METRICS_ALLOW: per gli altri non esiste
+    if not observability.metrics_allowed(request):
+        return jsonify({'error': 'Not found'}), 404
+    # Istogrammi Prometheus di richieste, comandi MongoDB e chiamate Cloudinary, stato della coda eliminazioni
+    body = observability.render_metrics()
+    body += ('# HELP geomemories_sse_connections Connessioni SSE aperte nel processo\n'
+             '# TYPE geomemories_sse_connections gauge\n'
+             f"geomemories_sse_connections {events.bus.stats()['connections']}\n")
+    # Stato della coda eliminazioni (comune a tutti i worker)
+    body += deletion_queue.render_metrics()
+    return app.response_class(body, mimetype='text/plain; version=0.0.4')
+
 @app.errorhandler(404)
 def not_found(e):
     # For API routes, return JSON
@@ -201,10 +784,7 @@ def not_found(e):
         return jsonify({'error': 'API endpoint not found'}), 404
     # Serve SPA solo se non è una richiesta per file statico
     if '.' not in request.path.split('/')[-1]:
-        try:
-            return send_from_directory(app.static_folder, 'index.html')
-        except FileNotFoundError:
-            return "Frontend build not found. Please run 'npm run build' in the frontend directory.", 404
+        return _send_index()
     return "File not found", 404
 
 @app.errorhandler(500)
@@ -220,5 +800,6 @@ def bad_request(e):
     return "Bad request", 400
 
 if __name__ == '__main__':
+    # Server di sviluppo: in produzione usare gunicorn (vedi gunicorn.conf.py)
     port = int(os.environ.get('PORT', 5000))
-    app.run(host='0.0.0.0', port=port)
\ No newline at end of file
+    create_app().run(host='0.0.0.0', port=port)
\ No newline at end of file
@@ -0,0 +1,132 @@
+"""Stub HTTP locale delle API di Cloudinary usate dal backend.
+
+Risponde a destroy, all'eliminazione bulk (delete_resources) e all'elenco
+delle risorse dell'Admin API, tenendo le risorse in memoria. Si usa
+impostando CLOUDINARY_API_URL sull'indirizzo dello stub prima di importare
+il backend:
+    python benchmarks/cloudinary_stub.py --port 8900
+    CLOUDINARY_API_URL=http://127.0.0.1:8900 python app.py
+"""
+import argparse
+import json
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+class CloudinaryStub(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0.0):
+        super().__init__(('127.0.0.1', port), _Handler)
+        # Ritardo simulato per ogni chiamata (secondi)
+        self.latency = latency
+        self.resources = defaultdict(dict)  # resource_type -> {public_id: created_at}
+        self.calls = defaultdict(int)
+        self.lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def add_resource(self, resource_type, public_id, created_at=None):
+        with self.lock:
+            self.resources[resource_type][public_id] = created_at or datetime.utcnow()
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name='cloudinary-stub', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def _remove(self, resource_type, public_id):
+        with self.lock:
+            return self.resources[resource_type].pop(public_id, None) is not None
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _route(self):
+        """(parti del path dopo /v1_1/<cloud>/, parametri della query)"""
+        parsed = urlparse(self.path)
+        return parsed.path.strip('/').split('/')[2:], parse_qs(parsed.query)
+
+    def _reply(self, operation, body, status=200):
+        stub = self.server
+        with stub.lock:
+            stub.calls[operation] += 1
+        if stub.latency:
+            time.sleep(stub.latency)
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        parts, _ = self._route()
+        length = int(self.headers.get('Content-Length', 0))
+        form = parse_qs(self.rfile.read(length).decode('utf-8'))
+        if len(parts) == 2 and parts[1] == 'destroy':
+            public_id = form.get('public_id', [''])[0]
+            removed = self.server._remove(parts[0], public_id)
+            return self._reply('destroy', {'result': 'ok' if removed else 'not found'})
+        self._reply('unknown', {'error': {'message': 'not found'}}, 404)
+
+    def do_DELETE(self):
+        parts, query = self._route()
+        if len(parts) == 3 and parts[0] == 'resources':
+            deleted = {
+                public_id: 'deleted' if self.server._remove(parts[1], public_id) else 'not_found'
+                for public_id in query.get('public_ids[]', [])
+            }
+            return self._reply('delete_resources', {'deleted': deleted})
+        self._reply('unknown', {'error': {'message': 'not found'}}, 404)
+
+    def do_GET(self):
+        parts, query = self._route()
+        if len(parts) == 2 and parts[0] == 'resources':
+            prefix = query.get('prefix', [''])[0]
+            max_results = int(query.get('max_results', ['10'])[0])
+            offset = int(query.get('next_cursor', ['0'])[0])
+            with self.server.lock:
+                matching = sorted(
+                    (public_id, created_at)
+                    for public_id, created_at in self.server.resources[parts[1]].items()
+                    if public_id.startswith(prefix)
+                )
+            page = matching[offset:offset + max_results]
+            body = {'resources': [
+                {'public_id': public_id, 'resource_type': parts[1], 'bytes': 1024,
+                 'created_at': created_at.strftime('%Y-%m-%dT%H:%M:%SZ')}
+                for public_id, created_at in page
+            ]}
+            if offset + max_results < len(matching):
+                body['next_cursor'] = str(offset + max_results)
+            return self._reply('list_resources', body)
+        self._reply('unknown', {'error': {'message': 'not found'}}, 404)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Stub locale delle API di Cloudinary')
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--latency', type=float, default=0.0, help='ritardo simulato per chiamata (secondi)')
+    args = parser.parse_args()
+    stub = CloudinaryStub(args.port, args.latency)
+    print(f"Stub Cloudinary su {stub.url}")
+    try:
+        stub.serve_forever()
+    except KeyboardInterrupt:
+        stub.server_close()
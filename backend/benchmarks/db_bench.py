@@ -0,0 +1,139 @@
+"""Micro-benchmark delle funzioni di db_manager.
+
+Genera i dati con seed.py in un database dedicato e misura ogni funzione
+per --iterations chiamate, stampando un report JSON (p50/p95/p99 e
+operazioni al secondo) confrontabile tra versioni e volumi di dati.
+
+Esempi:
+    python benchmarks/db_bench.py --mongomock                 # in memoria, nessun server
+    MONGO_URI=mongodb://localhost:27017 python benchmarks/db_bench.py --memories 5000
+
+Con mongomock le funzioni che usano operatori non supportati (ricerca
+$text, elencata in MONGOMOCK_UNSUPPORTED, e query geospaziali) risultano
+'skipped'; i tempi significativi sono quelli contro un mongod reale.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Di default i benchmark usano un mongod locale
+os.environ.setdefault('MONGO_URI', 'mongodb://localhost:27017')
+
+import db_manager
+from loadtest import summarize
+from seed import BENCH_DB, WORDS, connect, seed
+
+# Funzioni che mongomock non sa eseguire (nessun errore esplicito: fallirebbero con TypeError)
+MONGOMOCK_UNSUPPORTED = {
+    'search_memories': "$text con ordinamento per textScore",
+}
+
+
+def measure(fn, iterations, prepare=None):
+    """Esegue fn(arg) iterations volte; prepare() fornisce l'argomento fuori dal tempo misurato"""
+    values = []
+    errors = 0
+    last_error = None
+    for _ in range(iterations):
+        arg = prepare() if prepare else None
+        start = time.perf_counter()
+        try:
+            ok = fn(arg)
+        except NotImplementedError:
+            return {'skipped': 'operazione non supportata dal backend'}
+        except Exception as e:
+            last_error = repr(e)
+            ok = False
+        elapsed = time.perf_counter() - start
+        if ok is False:
+            errors += 1
+        else:
+            values.append(elapsed)
+    report = summarize(values, sum(values), errors)
+    report['ops_per_s'] = report.pop('rps')
+    if last_error:
+        report['last_error'] = last_error
+    return report
+
+
+def _text(rng):
+    return ' '.join(rng.choice(WORDS) for _ in range(40))
+
+
+def run(email, iterations, rng, mongomock=False):
+    memories = db_manager.get_memories(email)
+    ids = [m['id'] for m in memories]
+    word = rng.choice(WORDS)
+
+    def random_memory(_=None):
+        return db_manager.get_memory_by_id(rng.choice(ids), email)
+
+    def new_memory():
+        return db_manager.add_memory('Benchmark', '2020-05-01', f"{rng.choice(WORDS)} {rng.random()}", email)
+
+    def new_memory_keys():
+        text = f"{rng.choice(WORDS)} {rng.random()}"
+        db_manager.add_memory('Benchmark', '2020-05-01', text, email)
+        return text
+
+    def legacy_update(memory):
+        return db_manager.update_memory(memory['title'], memory['date'], memory['text'], email,
+                                        {'text': memory['text'] + ' +'})
+
+    benchmarks = {
+        'get_memories': (lambda _: db_manager.get_memories(email), None),
+        'get_memories_summary': (lambda _: db_manager.get_memories(email, fields=list(db_manager.MEMORY_SUMMARY_FIELDS)), None),
+        'get_memories_page': (lambda _: db_manager.get_memories_page(email, 50), None),
+        'get_memories_date_range': (lambda _: db_manager.get_memories(
+            email, query=db_manager.memory_filters(email, '2018-01-01', '2018-12-31')), None),
+        'get_memory_by_id': (random_memory, None),
+        'search_memories': (lambda _: db_manager.search_memories(email, word), None),
+        'get_locations': (lambda _: db_manager.get_locations(email), None),
+        'get_locations_in_bbox': (lambda _: db_manager.get_locations_in_bbox(email, 9.0, 44.0, 13.0, 46.5), None),
+        'add_memory': (lambda _: new_memory(), None),
+        'update_memory_by_id': (lambda memory_id: db_manager.update_memory_by_id(
+            memory_id, email, {'text': _text(rng)}), lambda: rng.choice(ids)),
+        'update_memory': (legacy_update, random_memory),
+        'delete_memory_by_id': (lambda memory_id: db_manager.delete_memory_by_id(memory_id, email), new_memory),
+        'delete_memories': (lambda text: db_manager.delete_memories('Benchmark', '2020-05-01', text, email), new_memory_keys),
+    }
+    results = {}
+    for name, (fn, prepare) in benchmarks.items():
+        if mongomock and name in MONGOMOCK_UNSUPPORTED:
+            results[name] = {'skipped': f"non supportato da mongomock: {MONGOMOCK_UNSUPPORTED[name]}"}
+        else:
+            results[name] = measure(fn, iterations, prepare)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro-benchmark di db_manager')
+    parser.add_argument('--db', default=BENCH_DB, help='database dei benchmark (viene svuotato)')
+    parser.add_argument('--mongomock', action='store_true', help='usa mongomock invece di MONGO_URI')
+    parser.add_argument('--locations', type=int, default=100)
+    parser.add_argument('--memories', type=int, default=500)
+    parser.add_argument('--files', type=int, default=2)
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    connect(args.db, use_mongomock=args.mongomock, reset=True)
+    started = time.monotonic()
+    users = seed(1, args.locations, args.memories, args.files, args.seed)
+    seed_seconds = round(time.monotonic() - started, 2)
+    report = {
+        'backend': 'mongomock' if args.mongomock else 'mongod',
+        'data': {'locations': args.locations, 'memories': args.memories, 'files_per_memory': args.files},
+        'seed_seconds': seed_seconds,
+        'iterations': args.iterations,
+        'results': run(users[0]['email'], args.iterations, random.Random(args.seed), args.mongomock)
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+"""Scenario di carico HTTP completo, tutto nello stesso processo.
+
+Avvia lo stub di Cloudinary (cloudinary_stub.py), genera i dati con seed.py
+in un database dedicato, serve l'app Flask con il server di werkzeug su una
+porta libera e la carica con loadtest.run: letture (liste, pagine, ricerca)
+e scritture che creano, modificano ed eliminano ricordi con file, così la
+coda eliminazioni chiama davvero le API (dello stub). Stampa un report JSON
+con throughput, p50/p95/p99 per azione e chiamate ricevute dallo stub.
+
+Esempi:
+    python benchmarks/http_bench.py --mongomock --duration 10
+    MONGO_URI=mongodb://localhost:27017 python benchmarks/http_bench.py --memories 5000
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import loadtest
+from cloudinary_stub import CloudinaryStub
+
+READ_PATHS = [
+    '/api/locations',
+    '/api/memories?mode=summary',
+    '/api/memories?limit=50',
+    '/api/memories?from=2018-01-01&to=2018-12-31',
+    '/api/memories/search?q=mare',
+]
+# Letture che mongomock non sa eseguire ($text con ordinamento per textScore)
+MONGOMOCK_UNSUPPORTED_PATHS = ('/api/memories/search?q=mare',)
+
+
+def write_actions(stub, memory_ids, upload_folder):
+    """Azioni di scrittura: ognuna è una funzione action(session, base_url) -> bool"""
+    rng = random.Random(0)
+
+    def update_memory(session, base_url):
+        memory_id = rng.choice(memory_ids)
+        response = session.put(f"{base_url}/api/memories/{memory_id}",
+                               json={'text': f"Aggiornato {uuid.uuid4().hex}"}, timeout=30)
+        return response.status_code < 400
+
+    def create_delete_memory(session, base_url):
+        public_id = f"{upload_folder}/load_{uuid.uuid4().hex}"
+        stub.add_resource('image', public_id)
+        created = session.post(f"{base_url}/api/memories", json={
+            'title': 'Load test',
+            'date': '2021-06-01',
+            'text': 'Ricordo creato dal load test',
+            'files': [{
+                'url': f"https://res.cloudinary.com/bench/image/upload/v1/{public_id}.jpg",
+                'display_name': 'foto.jpg', 'type': 'image/jpeg',
+                'resource_type': 'image', 'public_id': public_id
+            }]
+        }, timeout=30)
+        if created.status_code != 201:
+            return False
+        deleted = session.delete(f"{base_url}/api/memories/{created.json()['memory_id']}", timeout=30)
+        return deleted.status_code < 400
+
+    return [update_memory, create_delete_memory]
+
+
+def wait_for_deletions(queue_stats, timeout=30):
+    """Attende che la coda eliminazioni si svuoti; ritorna i secondi impiegati"""
+    started = time.monotonic()
+    while time.monotonic() - started < timeout:
+        depth = queue_stats()['depth']
+        if depth['pending'] + depth['processing'] == 0:
+            break
+        time.sleep(0.2)
+    return round(time.monotonic() - started, 2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test HTTP in-process con stub di Cloudinary')
+    parser.add_argument('--db', default=None, help='database dei benchmark (viene svuotato)')
+    parser.add_argument('--mongomock', action='store_true', help='usa mongomock invece di MONGO_URI')
+    parser.add_argument('--locations', type=int, default=100)
+    parser.add_argument('--memories', type=int, default=500)
+    parser.add_argument('--files', type=int, default=2)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=20)
+    parser.add_argument('--cloudinary-latency', type=float, default=0.05,
+                        help='ritardo simulato di ogni chiamata a Cloudinary (secondi)')
+    parser.add_argument('--reads-only', action='store_true')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    # Lo stub va avviato prima di importare il backend, che legge CLOUDINARY_API_URL all'import
+    stub = CloudinaryStub(latency=args.cloudinary_latency).start()
+    os.environ['CLOUDINARY_API_URL'] = stub.url
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+    import seed
+    seed.connect(args.db or seed.BENCH_DB, use_mongomock=args.mongomock, reset=True)
+    users = seed.seed(1, args.locations, args.memories, args.files, args.seed, stub=stub)
+
+    from werkzeug.serving import make_server
+    from app import create_app, shutdown_app
+    from cloudinary_config import UPLOAD_FOLDER
+    from deletion_queue import queue_stats
+    import db_manager
+
+    server = make_server('127.0.0.1', 0, create_app(), threaded=True)
+    threading.Thread(target=server.serve_forever, name='http-bench', daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    try:
+        email = users[0]['email']
+        token = loadtest.login(base_url, email, users[0]['password'])
+        actions = list(READ_PATHS)
+        skipped = []
+        if args.mongomock:
+            skipped = [path for path in actions if path in MONGOMOCK_UNSUPPORTED_PATHS]
+            actions = [path for path in actions if path not in MONGOMOCK_UNSUPPORTED_PATHS]
+        if not args.reads_only:
+            memory_ids = [m['id'] for m in db_manager.get_memories(email, fields=['title'])]
+            actions += write_actions(stub, memory_ids, UPLOAD_FOLDER)
+        report = loadtest.run(base_url, token, actions, args.concurrency, args.duration)
+        report['backend'] = 'mongomock' if args.mongomock else 'mongod'
+        if skipped:
+            report['skipped'] = {path: 'non supportato da mongomock' for path in skipped}
+        report['data'] = {'locations': args.locations, 'memories': args.memories, 'files_per_memory': args.files}
+        report['deletion_drain_s'] = wait_for_deletions(queue_stats)
+        report['deletion_queue'] = queue_stats()
+        report['cloudinary_calls'] = dict(stub.calls)
+        print(json.dumps(report, indent=2, default=str))
+    finally:
+        server.shutdown()
+        shutdown_app()
+        stub.stop()
+
+
+if __name__ == '__main__':
+    main()
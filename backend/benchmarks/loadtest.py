@@ -0,0 +1,120 @@
+"""Load test HTTP minimale per confrontare le modalità di avvio del backend.
+
+Esempio (stesso carico prima e dopo):
+    python app.py                                   # server di sviluppo
+    python benchmarks/loadtest.py --email a@b.it --password x
+    gunicorn -c gunicorn.conf.py wsgi:app           # produzione
+    python benchmarks/loadtest.py --email a@b.it --password x
+
+Stampa richieste/secondo e latenze (p50/p95/p99) per ogni endpoint.
+Per uno scenario completo in-process (dati generati e stub di Cloudinary)
+vedi http_bench.py.
+"""
+import argparse
+import json
+import statistics
+import threading
+import time
+import requests
+
+DEFAULT_PATHS = ['/api/locations', '/api/memories?mode=summary&limit=50']
+
+
+def login(base_url, email, password):
+    response = requests.post(f"{base_url}/api/login", json={'email': email, 'password': password}, timeout=30)
+    response.raise_for_status()
+    return response.json()['access_token']
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def summarize(values, elapsed, errors=0):
+    """Throughput e latenze (in ms) di una serie di durate in secondi"""
+    return {
+        'requests': len(values),
+        'errors': errors,
+        'rps': round(len(values) / elapsed, 1) if elapsed else 0.0,
+        'mean_ms': round(statistics.mean(values) * 1000, 3) if values else 0.0,
+        'p50_ms': round(percentile(values, 50) * 1000, 3),
+        'p95_ms': round(percentile(values, 95) * 1000, 3),
+        'p99_ms': round(percentile(values, 99) * 1000, 3),
+    }
+
+
+def _name(path):
+    return path if isinstance(path, str) else path.__name__
+
+
+def run(base_url, token, paths, concurrency, duration):
+    """Esegue le richieste in ciclo su concurrency thread per duration secondi.
+
+    Ogni elemento di paths è un path da chiamare in GET oppure una funzione
+    action(session, base_url) -> bool per scenari con più richieste o scritture.
+    """
+    names = [_name(path) for path in paths]
+    latencies = {name: [] for name in names}
+    errors = {name: 0 for name in names}
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def client(offset):
+        session = requests.Session()
+        session.headers['Authorization'] = f"Bearer {token}"
+        i = offset
+        while time.monotonic() < deadline:
+            path = paths[i % len(paths)]
+            i += 1
+            start = time.perf_counter()
+            try:
+                if isinstance(path, str):
+                    ok = session.get(base_url + path, timeout=30).status_code < 400
+                else:
+                    ok = path(session, base_url)
+            except requests.RequestException:
+                ok = False
+            elapsed = time.perf_counter() - start
+            with lock:
+                if ok:
+                    latencies[_name(path)].append(elapsed)
+                else:
+                    errors[_name(path)] += 1
+
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(concurrency)]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    report = {'concurrency': concurrency, 'duration_s': round(elapsed, 2), 'endpoints': {}}
+    total = 0
+    for name in names:
+        total += len(latencies[name])
+        report['endpoints'][name] = summarize(latencies[name], elapsed, errors[name])
+    report['total_rps'] = round(total / elapsed, 1)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test del backend GeoMemories')
+    parser.add_argument('--url', default='http://localhost:5000')
+    parser.add_argument('--email', required=True)
+    parser.add_argument('--password', required=True)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--path', action='append', dest='paths', help='endpoint da testare (ripetibile)')
+    args = parser.parse_args()
+    token = login(args.url, args.email, args.password)
+    report = run(args.url, token, args.paths or DEFAULT_PATHS, args.concurrency, args.duration)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+"""Generatore di dati realistici per i benchmark.
+
+Crea utenti con N posizioni e M ricordi ciascuno (con file allegati e
+posizioni collegate per riferimento) in un database separato da quello
+dell'app. I dati sono deterministici a parità di --seed.
+
+Esempio (mongod locale):
+    MONGO_URI=mongodb://localhost:27017 python benchmarks/seed.py --users 5 --locations 200 --memories 2000
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Di default i benchmark usano un mongod locale
+os.environ.setdefault('MONGO_URI', 'mongodb://localhost:27017')
+
+import db_manager
+from cloudinary_config import UPLOAD_FOLDER
+
+BENCH_DB = os.environ.get('BENCH_DB_NAME', 'geomemories_bench')
+BENCH_PASSWORD = 'benchmark'
+WORDS = (
+    'mare montagna lago città viaggio amici famiglia estate inverno tramonto alba '
+    'spiaggia sentiero rifugio castello piazza mercato museo concerto festa cena '
+    'pranzo gelato treno bicicletta barca neve sole pioggia vento bosco fiume '
+    'ponte chiesa porto isola collina vigneto borgo teatro stazione giardino'
+).split()
+# Bounding box approssimativo dell'Italia (lon, lat)
+AREA = (6.6, 36.6, 18.5, 47.1)
+
+
+def connect(db_name=BENCH_DB, use_mongomock=False, reset=False):
+    """Collega db_manager al database dei benchmark (mai a quello dell'app)"""
+    if db_name == db_manager.DB_NAME:
+        raise SystemExit(f"Il database '{db_name}' è quello dell'app: usa un nome diverso per i benchmark")
+    if use_mongomock:
+        import mongomock
+        db_manager.MongoClient = mongomock.MongoClient
+    db_manager.DB_NAME = db_name
+    db_manager.connect()
+    if reset:
+        for name in db_manager.db.list_collection_names():
+            db_manager.db.drop_collection(name)
+    try:
+        db_manager.ensure_indexes()
+    except Exception as e:
+        # mongomock non supporta tutti i tipi di indice
+        print(f"Avviso: indici non creati ({e})", file=sys.stderr)
+
+
+def _sentence(rng, words):
+    return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+
+def _file(rng, public_id):
+    return {
+        'url': f"https://res.cloudinary.com/bench/image/upload/v1/{public_id}.jpg",
+        'display_name': f"{rng.choice(WORDS)}.jpg",
+        'original_name': f"IMG_{rng.randint(1000, 9999)}.jpg",
+        'size': rng.randint(200_000, 4_000_000),
+        'type': 'image/jpeg',
+        'resource_type': 'image',
+        'public_id': public_id
+    }
+
+
+def seed(users=3, locations=100, memories=500, files=2, seed_value=42, stub=None):
+    """Genera i dati e ritorna gli utenti creati ({'email', 'password'}).
+
+    Se stub (CloudinaryStub) è indicato, vi registra anche i file, così le
+    eliminazioni durante i benchmark trovano le risorse.
+    """
+    rng = random.Random(seed_value)
+    created = []
+    start_date = date(2015, 1, 1)
+    for u in range(users):
+        email = f"bench{u}@example.com"
+        db_manager.add_user(email, f"Utente {u}", BENCH_PASSWORD)
+        db_manager.add_locations_bulk(({
+            'title': f"{rng.choice(WORDS).capitalize()} {n}",
+            'latitude': round(rng.uniform(AREA[1], AREA[3]), 6),
+            'longitude': round(rng.uniform(AREA[0], AREA[2]), 6),
+            'description': _sentence(rng, 8)
+        } for n in range(locations)), email)
+        saved = db_manager.get_locations(email)
+
+        # Documenti costruiti come add_memory (posizioni per riferimento) ma inseriti a blocchi
+        batch = []
+        for m in range(memories):
+            memory_files = []
+            for f in range(files):
+                public_id = f"{UPLOAD_FOLDER}/bench_{u}_{m}_{f}"
+                if stub is not None:
+                    stub.add_resource('image', public_id)
+                memory_files.append(_file(rng, public_id))
+            batch.append(db_manager._memory_document(
+                _sentence(rng, 3).capitalize(),
+                (start_date + timedelta(days=rng.randint(0, 3650))).strftime('%Y-%m-%d'),
+                _sentence(rng, rng.randint(20, 120)),
+                email,
+                rng.sample(saved, min(len(saved), rng.randint(1, 3))),
+                memory_files
+            ))
+            if len(batch) >= db_manager.BULK_CHUNK_SIZE:
+                db_manager.memories_collection.insert_many(batch)
+                batch = []
+        if batch:
+            db_manager.memories_collection.insert_many(batch)
+        created.append({'email': email, 'password': BENCH_PASSWORD})
+    return created
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Genera dati per i benchmark di GeoMemories')
+    parser.add_argument('--db', default=BENCH_DB, help='database di destinazione (viene svuotato)')
+    parser.add_argument('--users', type=int, default=3)
+    parser.add_argument('--locations', type=int, default=100, help='posizioni per utente')
+    parser.add_argument('--memories', type=int, default=500, help='ricordi per utente')
+    parser.add_argument('--files', type=int, default=2, help='file per ricordo')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    connect(args.db, reset=True)
+    started = time.monotonic()
+    users = seed(args.users, args.locations, args.memories, args.files, args.seed)
+    print(json.dumps({
+        'db': args.db,
+        'users': users,
+        'locations_per_user': args.locations,
+        'memories_per_user': args.memories,
+        'files_per_memory': args.files,
+        'seconds': round(time.monotonic() - started, 2)
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""Cache delle risposte di lettura (liste di posizioni e ricordi).
+
+Le chiavi includono la versione dei dati dell'utente (db_manager.get_data_version),
+che ogni scrittura incrementa: una scrittura rende quindi irraggiungibili le
+voci vecchie senza bisogno di cancellarle, e funziona anche con più worker.
+I valori sono il JSON già serializzato, così una hit non rifà nemmeno la
+serializzazione.
+
+CACHE_BACKEND: 'memory' (default, LRU con TTL nel processo, al massimo
+CACHE_MAX_BYTES byte di corpi per worker), 'redis' (condivisa tra i worker,
+REDIS_URL) oppure 'none'.
+"""
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+CACHE_TTL = int(os.environ.get('CACHE_TTL', 300))
+CACHE_MAX_ENTRIES = int(os.environ.get('CACHE_MAX_ENTRIES', 2000))
+# Limite sulla dimensione totale dei corpi in cache (byte, per processo)
+CACHE_MAX_BYTES = int(os.environ.get('CACHE_MAX_BYTES', 64 * 1024 * 1024))
+
+
+class LRUCache:
+    """Cache LRU in memoria con scadenza (TTL) per voce, thread-safe.
+
+    Le voci più vecchie vengono eliminate quando si supera max_entries o
+    max_bytes (somma delle dimensioni dei corpi); un corpo più grande di un
+    ottavo di max_bytes non viene messo in cache. Con max_bytes=None conta solo
+    il numero di voci (valori che non sono byte, ad esempio liste).
+    """
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL, max_bytes=CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time.monotonic():
+                self._pop(key)
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def _size(self, value):
+        return 0 if self.max_bytes is None else len(value)
+
+    def set(self, key, value):
+        size = self._size(value)
+        with self._lock:
+            self._pop(key)
+            if self.max_bytes is not None and size > self.max_bytes // 8:
+                return
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._bytes += size
+            while len(self._data) > self.max_entries or (self.max_bytes is not None and self._bytes > self.max_bytes):
+                self._pop(next(iter(self._data)))
+
+    def _pop(self, key):
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self._bytes -= self._size(entry[0])
+
+
+class RedisCache:
+    """Cache condivisa su Redis (o server compatibili); l'eviction LRU la fa il server"""
+
+    def __init__(self, url, ttl=CACHE_TTL, prefix='geomemories:'):
+        import redis
+        self._redis = redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        try:
+            return self._redis.get(self.prefix + key)
+        except Exception as e:
+            logger.warning("Cache Redis non disponibile: %s", e)
+            return None
+
+    def set(self, key, value):
+        try:
+            self._redis.setex(self.prefix + key, self.ttl, value)
+        except Exception as e:
+            logger.warning("Cache Redis non disponibile: %s", e)
+
+
+class NullCache:
+    def get(self, key):
+        return None
+
+    def set(self, key, value):
+        pass
+
+
+def create_cache():
+    backend = os.environ.get('CACHE_BACKEND', 'memory')
+    if backend == 'memory':
+        return LRUCache()
+    if backend == 'redis':
+        return RedisCache(os.environ.get('REDIS_URL', 'redis://localhost:6379/0'))
+    if backend == 'none':
+        return NullCache()
+    raise ValueError(f"CACHE_BACKEND non valido: {backend}")
@@ -1,9 +1,36 @@
+import os
+import logging
 import requests
 import hashlib
 import hmac
 import time
 from urllib.parse import urlparse
 from cloudinary_credentials import CLOUDINARY_CLOUD_NAME, CLOUDINARY_API_KEY, CLOUDINARY_API_SECRET
+from observability import InstrumentedAdapter
+
+logger = logging.getLogger(__name__)
+
+# Base URL delle API (sovrascrivibile per puntare a uno stub HTTP locale nei test)
+CLOUDINARY_API_URL = os.environ.get('CLOUDINARY_API_URL', 'https://api.cloudinary.com').rstrip('/')
+# Base URL da cui Cloudinary consegna i file (secure_url delle risposte di upload)
+CLOUDINARY_DELIVERY_URL = os.environ.get('CLOUDINARY_DELIVERY_URL', 'https://res.cloudinary.com').rstrip('/')
+# Numero massimo di public_id per chiamata a delete_resources
+BULK_DELETE_LIMIT = 100
+# Risorse per pagina nell'elenco dell'Admin API (massimo consentito: 500)
+LIST_PAGE_SIZE = 500
+# Timeout (connessione, lettura) in secondi per tutte le chiamate a Cloudinary
+HTTP_TIMEOUT = (5, 30)
+# resource_type che compaiono negli URL di consegna di Cloudinary
+RESOURCE_TYPES = ('image', 'video', 'raw')
+# Cartella in cui finiscono gli upload firmati dal backend
+UPLOAD_FOLDER = os.environ.get('CLOUDINARY_UPLOAD_FOLDER', 'project_diary')
+
+# Sessione condivisa: riusa le connessioni TLS (keep-alive) tra le richieste;
+# l'adapter cronometra ogni chiamata (vedi observability)
+http_session = requests.Session()
+_adapter = InstrumentedAdapter(pool_connections=4, pool_maxsize=int(os.environ.get('CLOUDINARY_POOL_SIZE', 20)))
+http_session.mount('https://', _adapter)
+http_session.mount('http://', _adapter)
 
 def extract_public_id_from_url(cloudinary_url):
     """Estrae il public_id da un URL Cloudinary"""
@@ -11,10 +38,7 @@ def extract_public_id_from_url(cloudinary_url):
         # Esempio URL: https://res.cloudinary.com/dkgxlxtew/auto/upload/v1234567890/project_diary/filename.jpg
         parsed = urlparse(cloudinary_url)
         path_parts = parsed.path.split('/')
-        
-        print(f"Debug - URL originale: {cloudinary_url}")
-        print(f"Debug - Path parts: {path_parts}")
-        
+
         # Trova la parte dopo /upload/
         if '/upload/' in parsed.path:
             upload_index = path_parts.index('upload')
@@ -32,23 +56,53 @@ def extract_public_id_from_url(cloudinary_url):
                 public_id_parts_no_ext = public_id_parts.copy()
                 public_id_parts_no_ext[-1] = public_id_parts_no_ext[-1].rsplit('.', 1)[0]
                 public_id_without_extension = '/'.join(public_id_parts_no_ext)
-            
-            print(f"Debug - Public ID con estensione: {public_id_with_extension}")
-            print(f"Debug - Public ID senza estensione: {public_id_without_extension}")
+            logger.debug("public_id da %s: %s (senza estensione: %s)",
+                         cloudinary_url, public_id_with_extension, public_id_without_extension)
             
             # Ritorna sia la versione con estensione che quella senza
             # Per i file raw, spesso il public_id include l'estensione
             return public_id_with_extension, public_id_without_extension
     except Exception as e:
-        print(f"Errore nell'estrazione del public_id: {e}")
+        logger.warning("Errore nell'estrazione del public_id da %s: %s", cloudinary_url, e)
     
     return None, None
 
-def delete_file_from_cloudinary(cloudinary_url):
-    """Elimina un file da Cloudinary usando l'URL"""
+def resolve_resource(cloudinary_url, resource_type=None, public_id=None):
+    """Determina (resource_type, public_id) esatti di un file, o (None, None).
+
+    Usa i valori restituiti dall'upload se presenti; altrimenti li ricava
+    dall'URL, che per image/video/raw contiene già il tipo: per i raw il
+    public_id include l'estensione, per image e video no.
+    """
+    if resource_type in RESOURCE_TYPES and public_id:
+        return resource_type, public_id
+    if not cloudinary_url:
+        return None, None
+    path_parts = urlparse(cloudinary_url).path.split('/')
+    if 'upload' not in path_parts:
+        return None, None
+    url_type = path_parts[path_parts.index('upload') - 1]
+    if url_type not in RESOURCE_TYPES:
+        # URL "auto": il tipo reale si conosce solo dalla risposta dell'upload
+        return None, None
     public_id_with_ext, public_id_without_ext = extract_public_id_from_url(cloudinary_url)
     if not public_id_with_ext:
-        print("Errore: impossibile estrarre public_id dall'URL")
+        return None, None
+    return url_type, public_id_with_ext if url_type == 'raw' else public_id_without_ext
+
+def delete_file_from_cloudinary(cloudinary_url, resource_type=None, public_id=None):
+    """Elimina un file da Cloudinary usando l'URL.
+
+    Se resource_type e public_id sono noti (salvati al momento dell'upload)
+    basta una sola chiamata, altrimenti si provano le varianti possibili.
+    """
+    if resource_type in RESOURCE_TYPES and public_id:
+        data = {'timestamp': int(time.time()), 'api_key': CLOUDINARY_API_KEY}
+        return _try_delete_with_resource_type(data, resource_type, public_id)
+
+    public_id_with_ext, public_id_without_ext = extract_public_id_from_url(cloudinary_url)
+    if not public_id_with_ext:
+        logger.error("Impossibile estrarre public_id dall'URL %s", cloudinary_url)
         return False
     
     # Determina il resource_type basandosi sull'URL
@@ -66,20 +120,20 @@ def delete_file_from_cloudinary(cloudinary_url):
         data = {'timestamp': timestamp, 'api_key': CLOUDINARY_API_KEY}
         
         # Per file .docx e simili, prova prima con l'estensione (più probabile)
-        print(f"Debug - Tentativo eliminazione con public_id con estensione: {public_id_with_ext}")
+        logger.debug("Tentativo eliminazione con public_id con estensione: %s", public_id_with_ext)
         success = _try_delete_with_resource_type(data, "raw", public_id_with_ext)
         
         # Se fallisce, prova senza estensione
         if not success and public_id_without_ext != public_id_with_ext:
-            print(f"Debug - Tentativo eliminazione con public_id senza estensione: {public_id_without_ext}")
+            logger.debug("Tentativo eliminazione con public_id senza estensione: %s", public_id_without_ext)
             success = _try_delete_with_resource_type(data, "raw", public_id_without_ext)
         
         # Se ancora fallisce, prova con image
         if not success:
-            print(f"Debug - Tentativo eliminazione come image con estensione: {public_id_with_ext}")
+            logger.debug("Tentativo eliminazione come image con estensione: %s", public_id_with_ext)
             success = _try_delete_with_resource_type(data, "image", public_id_with_ext)
             if not success and public_id_without_ext != public_id_with_ext:
-                print(f"Debug - Tentativo eliminazione come image senza estensione: {public_id_without_ext}")
+                logger.debug("Tentativo eliminazione come image senza estensione: %s", public_id_without_ext)
                 success = _try_delete_with_resource_type(data, "image", public_id_without_ext)
         
         return success
@@ -89,34 +143,147 @@ def delete_file_from_cloudinary(cloudinary_url):
     data = {'timestamp': timestamp, 'api_key': CLOUDINARY_API_KEY}
     
     # Prova prima con il public_id con estensione, poi senza
-    print(f"Debug - Tentativo eliminazione con public_id con estensione: {public_id_with_ext}")
+    logger.debug("Tentativo eliminazione con public_id con estensione: %s", public_id_with_ext)
     success = _try_delete_with_resource_type(data, resource_type, public_id_with_ext)
     if not success and public_id_without_ext != public_id_with_ext:
-        print(f"Debug - Tentativo eliminazione con public_id senza estensione: {public_id_without_ext}")
+        logger.debug("Tentativo eliminazione con public_id senza estensione: %s", public_id_without_ext)
         success = _try_delete_with_resource_type(data, resource_type, public_id_without_ext)
     
     return success
 
+def deletion_candidates(cloudinary_url, resource_type=None, public_id=None):
+    """Coppie (resource_type, public_id) con cui il file potrebbe essere salvato.
+
+    Se il file ha resource_type e public_id registrati la coppia è una sola;
+    altrimenti si usa la stessa logica di delete_file_from_cloudinary,
+    restituendo tutte le varianti da eliminare insieme con delete_resources_bulk.
+    """
+    if resource_type in RESOURCE_TYPES and public_id:
+        return [(resource_type, public_id)]
+    public_id_with_ext, public_id_without_ext = extract_public_id_from_url(cloudinary_url)
+    if not public_id_with_ext:
+        return []
+    public_ids = [public_id_with_ext]
+    if public_id_without_ext != public_id_with_ext:
+        public_ids.append(public_id_without_ext)
+    if "/raw/upload/" in cloudinary_url:
+        resource_types = ["raw"]
+    elif "/video/upload/" in cloudinary_url:
+        resource_types = ["video"]
+    elif "/auto/upload/" in cloudinary_url:
+        resource_types = ["raw", "image"]
+    else:
+        resource_types = ["image"]
+    return [(rt, pid) for rt in resource_types for pid in public_ids]
+
+def delete_resources_bulk(resource_type, public_ids):
+    """Elimina fino a BULK_DELETE_LIMIT risorse con una sola chiamata all'Admin API.
+
+    Ritorna il dizionario public_id -> esito ('deleted', 'not_found', ...);
+    solleva un'eccezione se la richiesta fallisce.
+    """
+    if len(public_ids) > BULK_DELETE_LIMIT:
+        raise ValueError(f"Al massimo {BULK_DELETE_LIMIT} public_id per chiamata")
+    delete_url = f"{CLOUDINARY_API_URL}/v1_1/{CLOUDINARY_CLOUD_NAME}/resources/{resource_type}/upload"
+    response = http_session.delete(
+        delete_url,
+        params={'public_ids[]': list(public_ids)},
+        auth=(CLOUDINARY_API_KEY, CLOUDINARY_API_SECRET),
+        timeout=HTTP_TIMEOUT
+    )
+    response.raise_for_status()
+    return response.json().get('deleted', {})
+
+def list_resources(resource_type, prefix=None, next_cursor=None, max_results=LIST_PAGE_SIZE):
+    """Una pagina dell'elenco delle risorse caricate (Admin API).
+
+    Ritorna la risposta JSON: 'resources' (public_id, created_at, secure_url, ...)
+    e 'next_cursor' se ci sono altre pagine.
+    """
+    params = {'max_results': max_results, 'type': 'upload'}
+    if prefix:
+        params['prefix'] = prefix
+    if next_cursor:
+        params['next_cursor'] = next_cursor
+    response = http_session.get(
+        f"{CLOUDINARY_API_URL}/v1_1/{CLOUDINARY_CLOUD_NAME}/resources/{resource_type}",
+        params=params,
+        auth=(CLOUDINARY_API_KEY, CLOUDINARY_API_SECRET),
+        timeout=HTTP_TIMEOUT
+    )
+    response.raise_for_status()
+    return response.json()
+
+def sign_params(params):
+    """Firma SHA-1 di Cloudinary per i parametri di una richiesta.
+
+    I parametri sono ordinati alfabeticamente e concatenati come k=v&k=v,
+    seguiti dall'API secret. file, cloud_name, resource_type e api_key non
+    vanno mai firmati.
+    """
+    excluded = {'file', 'cloud_name', 'resource_type', 'api_key'}
+    sorted_params = sorted((k, v) for k, v in params.items() if k not in excluded and v not in (None, ''))
+    params_string = '&'.join([f"{key}={value}" for key, value in sorted_params])
+    params_string += CLOUDINARY_API_SECRET
+    return hashlib.sha1(params_string.encode('utf-8')).hexdigest()
+
+def upload_signature(folder=UPLOAD_FOLDER):
+    """Parametri firmati per gli upload diretti dal browser (validi un'ora, riusabili in parallelo)"""
+    params = {'timestamp': int(time.time()), 'folder': folder}
+    return dict(
+        params,
+        signature=sign_params(params),
+        api_key=CLOUDINARY_API_KEY,
+        cloud_name=CLOUDINARY_CLOUD_NAME,
+        upload_url=f"{CLOUDINARY_API_URL}/v1_1/{CLOUDINARY_CLOUD_NAME}/auto/upload"
+    )
+
+def verify_upload_response(upload):
+    """Verifica la signature che Cloudinary allega alla risposta di un upload"""
+    expected = sign_params({'public_id': upload.get('public_id'), 'version': upload.get('version')})
+    return hmac.compare_digest(expected, str(upload.get('signature', '')))
+
+def delivery_url(resource_type, public_id, version, file_format=None):
+    """URL di consegna di un file caricato (per i raw l'estensione è già nel public_id)"""
+    path = f"{public_id}.{file_format}" if file_format and resource_type != 'raw' else public_id
+    return f"{CLOUDINARY_DELIVERY_URL}/{CLOUDINARY_CLOUD_NAME}/{resource_type}/upload/v{version}/{path}"
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and value >= 0
+
+def verified_upload(upload):
+    """Risposta di un upload con signature valida e campi non firmati coerenti, o None.
+
+    La signature copre solo public_id e version: secure_url deve coincidere
+    con l'URL ricostruito da questi, da resource_type e da format, e i
+    metadati numerici (bytes, width, height, duration) devono essere numeri.
+    """
+    if not isinstance(upload, dict) or not isinstance(upload.get('public_id'), str):
+        return None
+    if not verify_upload_response(upload):
+        return None
+    resource_type = upload.get('resource_type')
+    file_format = upload.get('format')
+    if resource_type not in RESOURCE_TYPES:
+        return None
+    if file_format is not None and not (isinstance(file_format, str) and file_format.isalnum()):
+        return None
+    if upload.get('secure_url') != delivery_url(resource_type, upload['public_id'], upload.get('version'), file_format):
+        return None
+    if any(upload.get(key) is not None and not _is_number(upload[key]) for key in ('bytes', 'width', 'height', 'duration')):
+        return None
+    return upload
+
 def _try_delete_with_resource_type(data, resource_type, public_id):
     """Funzione helper per provare l'eliminazione con un resource_type specifico"""
     timestamp = data['timestamp']
     
     # Per l'eliminazione, la signature include SOLO public_id e timestamp
     # Il resource_type va nei dati della richiesta ma NON nella signature
-    params_to_sign = {
+    signature = sign_params({
         'public_id': public_id,
         'timestamp': timestamp
-    }
-    
-    # Costruisci la stringa da firmare (parametri ordinati alfabeticamente)
-    sorted_params = sorted(params_to_sign.items())
-    params_string = '&'.join([f"{key}={value}" for key, value in sorted_params])
-    params_string += CLOUDINARY_API_SECRET
-    
-    print(f"Debug - String to sign: {params_string}")
-    
-    # Genera la signature
-    signature = hashlib.sha1(params_string.encode('utf-8')).hexdigest()
+    })
     
     # Prepara i dati per la richiesta
     request_data = {
@@ -130,27 +297,22 @@ def _try_delete_with_resource_type(data, resource_type, public_id):
     if resource_type != "image":
         request_data['resource_type'] = resource_type
     
-    delete_url = f"https://api.cloudinary.com/v1_1/{CLOUDINARY_CLOUD_NAME}/{resource_type}/destroy"
-    
-    print(f"Debug - Request URL: {delete_url}")
-    print(f"Debug - Request data: {request_data}")
-    
+    delete_url = f"{CLOUDINARY_API_URL}/v1_1/{CLOUDINARY_CLOUD_NAME}/{resource_type}/destroy"
+
     try:
-        response = requests.post(delete_url, data=request_data)
+        response = http_session.post(delete_url, data=request_data, timeout=HTTP_TIMEOUT)
         result = response.json()
-        
-        print(f"Debug - Response: {result}")
-        
+
         if result.get('result') == 'ok':
-            print(f"File eliminato con successo da Cloudinary ({resource_type}): {public_id}")
+            logger.info("File eliminato da Cloudinary (%s): %s", resource_type, public_id)
             return True
         elif result.get('result') == 'not found':
-            print(f"File non trovato su Cloudinary ({resource_type}): {public_id}")
+            logger.debug("File non trovato su Cloudinary (%s): %s", resource_type, public_id)
             return False
         else:
-            print(f"Errore nell'eliminazione da Cloudinary ({resource_type}): {result}")
+            logger.error("Errore nell'eliminazione da Cloudinary (%s) di %s: %s", resource_type, public_id, result)
             return False
             
     except Exception as e:
-        print(f"Errore nella richiesta di eliminazione ({resource_type}): {e}")
+        logger.error("Errore nella richiesta di eliminazione (%s) di %s: %s", resource_type, public_id, e)
         return False
@@ -0,0 +1,53 @@
+"""Cluster delle posizioni per la mappa, calcolati lato server per tile.
+
+Una richiesta (bbox, zoom) raggruppa le posizioni in celle di livello
+zoom + CLUSTER_ZOOM_OFFSET (circa 64 px per cella). Le celle sono lette per
+tile più grandi (al massimo MAX_QUERY_TILES per richiesta) e ogni tile
+aggregato resta in una cache LRU nel processo, con chiave che include la
+versione dei dati dell'utente: spostando la mappa si riusano i tile già
+calcolati e ogni scrittura li invalida.
+"""
+import os
+from cache import LRUCache
+from db_manager import get_location_clusters, get_data_version
+from geo_tiles import QUADKEY_ZOOM, bbox_tile_ranges, tiles_in_ranges, covering_quadkeys, quadkey_to_tile
+
+CLUSTER_ZOOM_OFFSET = 2
+MAX_QUERY_TILES = 16
+
+# I valori sono liste di cluster, non byte: il limite è solo sul numero di tile
+_tile_cache = LRUCache(max_entries=int(os.environ.get('CLUSTER_CACHE_ENTRIES', 5000)), max_bytes=None)
+
+
+def cluster_zoom_for(zoom):
+    return max(0, min(QUADKEY_ZOOM, zoom + CLUSTER_ZOOM_OFFSET))
+
+
+def _query_zoom(ranges_at, cluster_zoom):
+    """Livello più dettagliato (<= cluster_zoom) a cui il bbox è coperto da al più MAX_QUERY_TILES tile"""
+    zoom = cluster_zoom
+    while zoom > 0 and tiles_in_ranges(ranges_at(zoom)) > MAX_QUERY_TILES:
+        zoom -= 1
+    return zoom
+
+
+def get_clusters(user_email, min_lon, min_lat, max_lon, max_lat, zoom):
+    cluster_zoom = cluster_zoom_for(zoom)
+    ranges_at = lambda z: bbox_tile_ranges(min_lon, min_lat, max_lon, max_lat, z)
+    query_zoom = _query_zoom(ranges_at, cluster_zoom)
+    version = get_data_version(user_email)
+
+    visible = ranges_at(cluster_zoom)
+    clusters = []
+    for tile in covering_quadkeys(ranges_at(query_zoom), query_zoom):
+        key = f"{user_email}:{version}:{cluster_zoom}:{tile}"
+        tile_clusters = _tile_cache.get(key)
+        if tile_clusters is None:
+            tile_clusters = get_location_clusters(user_email, tile, cluster_zoom)
+            _tile_cache.set(key, tile_clusters)
+        for cluster in tile_clusters:
+            # Il tile di query sborda dal bbox: tiene solo le celle visibili
+            x, y, _ = quadkey_to_tile(cluster['tile'])
+            if any(x0 <= x <= x1 and y0 <= y <= y1 for x0, x1, y0, y1 in visible):
+                clusters.append(cluster)
+    return {'zoom': cluster_zoom, 'clusters': clusters}
@@ -0,0 +1,112 @@
+"""Compressione negoziata delle risposte (brotli o gzip).
+
+Le risposte testuali (JSON, NDJSON, testo) più grandi di COMPRESS_MIN_SIZE
+byte vengono compresse con la codifica migliore accettata dal client
+(Accept-Encoding): brotli se il modulo è installato, altrimenti gzip.
+Le risposte in streaming vengono compresse a pezzi, senza attendere la
+fine. I file statici (direct_passthrough) e gli stream SSE non vengono
+toccati.
+
+COMPRESS_MIN_SIZE (default 1024), COMPRESS_GZIP_LEVEL (default 6),
+COMPRESS_BROTLI_QUALITY (default 5), COMPRESSION=0 per disattivarla.
+"""
+import gzip
+import os
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSION_ENABLED = os.environ.get('COMPRESSION', '1') != '0'
+COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+GZIP_LEVEL = int(os.environ.get('COMPRESS_GZIP_LEVEL', 6))
+BROTLI_QUALITY = int(os.environ.get('COMPRESS_BROTLI_QUALITY', 5))
+COMPRESSIBLE_TYPES = ('application/json', 'application/x-ndjson', 'application/javascript', 'image/svg+xml')
+
+
+def available_encodings():
+    return ['br', 'gzip'] if brotli is not None else ['gzip']
+
+
+def choose_encoding(request):
+    """Codifica da usare per la richiesta, o None se il client non ne accetta o se è disattivata"""
+    if not COMPRESSION_ENABLED:
+        return None
+    return request.accept_encodings.best_match(available_encodings())
+
+
+def compress(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def _compress_stream(chunks, encoding):
+    """Comprime uno stream pezzo per pezzo, inviando ogni pezzo appena pronto"""
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        for chunk in chunks:
+            data = compressor.process(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+            data += compressor.flush()
+            if data:
+                yield data
+        yield compressor.finish()
+    else:
+        # wbits=31: formato gzip
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+        for chunk in chunks:
+            data = compressor.compress(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+            data += compressor.flush(zlib.Z_SYNC_FLUSH)
+            if data:
+                yield data
+        yield compressor.flush()
+
+
+def _compressible(response):
+    if response.status_code < 200 or response.status_code in (204, 206, 304):
+        return False
+    if 'Content-Encoding' in response.headers or response.direct_passthrough:
+        return False
+    mimetype = response.mimetype or ''
+    # Gli eventi SSE devono arrivare subito, non dentro un blocco compresso
+    if mimetype == 'text/event-stream':
+        return False
+    return mimetype.startswith('text/') or mimetype in COMPRESSIBLE_TYPES
+
+
+def mark_encoded(response, encoding):
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    # Il corpo cambia con la codifica: l'ETag forte non vale più byte per byte
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+
+
+def init_app(app):
+    if not COMPRESSION_ENABLED:
+        return
+
+    from flask import request
+
+    @app.after_request
+    def _compress_response(response):
+        if not _compressible(response):
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding = choose_encoding(request)
+        if encoding is None:
+            return response
+        if response.is_streamed:
+            response.response = _compress_stream(response.response, encoding)
+            response.headers.pop('Content-Length', None)
+            mark_encoded(response, encoding)
+            return response
+        data = response.get_data()
+        if len(data) < COMPRESS_MIN_SIZE:
+            return response
+        response.set_data(compress(data, encoding))
+        mark_encoded(response, encoding)
+        return response
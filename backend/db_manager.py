@@ -1,8 +1,18 @@
 import os
-from pymongo import MongoClient
-from datetime import datetime
-from werkzeug.security import generate_password_hash, check_password_hash
-from cloudinary_config import delete_file_from_cloudinary
+import re
+import json
+import base64
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import MongoClient, GEOSPHERE, TEXT, UpdateOne, UpdateMany, ReturnDocument, ASCENDING, DESCENDING
+from pymongo.errors import DuplicateKeyError, BulkWriteError
+from datetime import datetime, timedelta
+import passwords
+from cloudinary_config import resolve_resource
+from geo_tiles import quadkey_for
+from observability import mongo_listener
+import events
+import media
 
 # Sostituisci con la tua stringa di connessione MongoDB
 # Assicurati di avere la variabile d'ambiente MONGO_URI impostata correttamente
@@ -11,175 +21,1239 @@ DB_NAME = 'diario'
 COLLECTION_NAME = 'locations'
 USERS_COLLECTION = 'users'
 MEMORIES_COLLECTION = 'memories'
+DELETIONS_COLLECTION = 'cloudinary_deletions'
+REVOKED_TOKENS_COLLECTION = 'revoked_tokens'
+UPLOADS_COLLECTION = 'uploads'
+TOMBSTONES_COLLECTION = 'tombstones'
 
-client = MongoClient(MONGO_URI)
-db = client[DB_NAME]
-locations_collection = db[COLLECTION_NAME]
-users_collection = db[USERS_COLLECTION]
-memories_collection = db[MEMORIES_COLLECTION]
+client = None
+db = None
+locations_collection = None
+users_collection = None
+memories_collection = None
+deletions_collection = None
+
+def connect():
+    """(Ri)crea il MongoClient e le collezioni del modulo.
+
+    MongoClient non è fork-safe: i server con più processi (gunicorn) devono
+    chiamare connect() in ogni worker dopo il fork. connect=False rimanda
+    l'apertura delle connessioni alla prima operazione.
+    """
+    global client, db, locations_collection, users_collection, memories_collection, deletions_collection
+    if client is not None:
+        client.close()
+    client = MongoClient(MONGO_URI, connect=False, event_listeners=[mongo_listener])
+    db = client[DB_NAME]
+    locations_collection = db[COLLECTION_NAME]
+    users_collection = db[USERS_COLLECTION]
+    memories_collection = db[MEMORIES_COLLECTION]
+    deletions_collection = db[DELETIONS_COLLECTION]
+
+def close():
+    """Chiude le connessioni del processo corrente (ad esempio all'uscita di un worker)"""
+    global client
+    if client is not None:
+        client.close()
+        client = None
+
+connect()
+
+# Passo (in gradi) con cui si densificano i lati dei bounding box
+BBOX_EDGE_STEP = 10.0
+# Campi interni degli indici spaziali, esclusi dalle risposte
+LOCATION_PROJECTION = {'geo': 0, 'quadkey': 0}
+
+# Campi di un ricordo che il client può richiedere con fields=
+MEMORY_FIELDS = ('title', 'date', 'text', 'locations', 'files')
+# Modalità "summary": niente testo né file, per la timeline
+MEMORY_SUMMARY_FIELDS = ('title', 'date', 'locations')
+MAX_PAGE_SIZE = 200
+# Caratteri di contesto attorno al termine trovato negli snippet di ricerca
+SNIPPET_CONTEXT = 80
+# Raggio terrestre (metri) per convertire i raggi in radianti ($centerSphere)
+EARTH_RADIUS_M = 6378100
+# Raggio di default (metri) del filtro "ricordi vicino a un punto"
+DEFAULT_NEAR_RADIUS = 1000
+# Documenti per singola insert_many negli import bulk
+BULK_CHUNK_SIZE = 1000
+
+# Giorni per cui si conservano le eliminazioni per la sincronizzazione incrementale
+TOMBSTONE_TTL_DAYS = int(os.environ.get('TOMBSTONE_TTL_DAYS', 30))
+# Margine (secondi) con cui /api/sync rilegge le modifiche vicine al token,
+# per le scritture ancora in corso e le differenze di orologio tra i worker
+SYNC_OVERLAP_SECONDS = 5
+# Scritture su più documenti (ricordo + tombstone + coda eliminazioni, ecc.) in
+# una transazione: richiede un replica set (Atlas lo è). Disattivato di default
+TRANSACTIONS_ENABLED = os.environ.get('MONGO_TRANSACTIONS', '0') == '1'
+# Tentativi di _update_memory quando i file vengono modificati in contemporanea
+UPDATE_RETRIES = 3
+
+# Indici dichiarati per ogni collezione: (nome, chiavi, opzioni)
+INDEXES = {
+    USERS_COLLECTION: [
+        ('email_unique', [('email', ASCENDING)], {'unique': True}),
+    ],
+    MEMORIES_COLLECTION: [
+        ('user_date', [('user_email', ASCENDING), ('date', DESCENDING), ('_id', DESCENDING)], {}),
+        ('files_url', [('files.url', ASCENDING)], {}),
+        ('user_location_refs', [('user_email', ASCENDING), ('locations.location_id', ASCENDING)], {}),
+        ('user_updated', [('user_email', ASCENDING), ('updated_at', ASCENDING)], {}),
+        # Ricerca full-text (una sola per collezione), con stemming italiano. Il
+        # prefisso user_email limita la ricerca ai ricordi dell'utente
+        ('user_memories_text', [('user_email', ASCENDING), ('title', TEXT), ('text', TEXT), ('files.display_name', TEXT)], {
+            'default_language': 'italian',
+            'weights': {'title': 10, 'files.display_name': 3, 'text': 1}
+        }),
+    ],
+    COLLECTION_NAME: [
+        ('user_email', [('user_email', ASCENDING)], {}),
+        # Le query geografiche filtrano sempre per utente: il prefisso user_email
+        # limita la scansione ai punti dell'utente nell'area richiesta
+        ('user_geo', [('user_email', ASCENDING), ('geo', GEOSPHERE)], {}),
+        ('user_quadkey', [('user_email', ASCENDING), ('quadkey', ASCENDING)], {}),
+        ('user_updated', [('user_email', ASCENDING), ('updated_at', ASCENDING)], {}),
+    ],
+    DELETIONS_COLLECTION: [
+        ('status_next_attempt', [('status', ASCENDING), ('next_attempt_at', ASCENDING)], {}),
+        ('lease', [('lease', ASCENDING)], {'sparse': True}),
+    ],
+    UPLOADS_COLLECTION: [
+        ('url_unique', [('url', ASCENDING)], {'unique': True}),
+        ('user_created', [('user_email', ASCENDING), ('created_at', DESCENDING)], {}),
+    ],
+    REVOKED_TOKENS_COLLECTION: [
+        # TTL: un token revocato sparisce quando sarebbe comunque scaduto
+        ('expires_at_ttl', [('expires_at', ASCENDING)], {'expireAfterSeconds': 0}),
+        ('revoked_at', [('revoked_at', ASCENDING)], {}),
+    ],
+    TOMBSTONES_COLLECTION: [
+        ('user_deleted', [('user_email', ASCENDING), ('deleted_at', ASCENDING)], {}),
+        # Oltre questo tempo un client deve rifare la sincronizzazione completa
+        ('deleted_at_ttl', [('deleted_at', ASCENDING)], {'expireAfterSeconds': TOMBSTONE_TTL_DAYS * 86400}),
+    ],
+}
+
+# Indici sostituiti da una nuova definizione, eliminati da ensure_indexes
+# (una collezione può avere un solo indice text)
+REPLACED_INDEXES = {
+    MEMORIES_COLLECTION: ['memories_text'],
+    COLLECTION_NAME: ['geo_2dsphere'],
+}
 
 def add_user(email, name, password):
-    if users_collection.find_one({'email': email}):
-        return False  # Email già registrata
-    hashed = generate_password_hash(password)
+    # Può sollevare passwords.HashingBusy se il pool degli hash è saturo
+    hashed = passwords.hash_password(password)
     user = {'email': email, 'name': name, 'password': hashed}
-    users_collection.insert_one(user)
+    try:
+        # L'indice unico su email evita registrazioni doppie concorrenti
+        users_collection.insert_one(user)
+    except DuplicateKeyError:
+        return False  # Email già registrata
     return True
 
+def add_revoked_token(jti, expires_at):
+    """Registra la revoca di un JWT fino alla sua scadenza naturale"""
+    db[REVOKED_TOKENS_COLLECTION].update_one(
+        {'_id': jti},
+        {'$set': {'expires_at': expires_at, 'revoked_at': datetime.utcnow()}},
+        upsert=True
+    )
+
+def get_revoked_tokens_since(since):
+    """Coppie (jti, expires_at) dei token revocati dopo since (tutti se since è None)"""
+    query = {'expires_at': {'$gt': datetime.utcnow()}}
+    if since is not None:
+        query['revoked_at'] = {'$gte': since}
+    return [(d['_id'], d['expires_at']) for d in db[REVOKED_TOKENS_COLLECTION].find(query, {'expires_at': 1})]
+
 def verify_user(email, password):
     user = users_collection.find_one({'email': email})
-    if user and check_password_hash(user['password'], password):
-        return user
-    return None
+    if not user or not passwords.check_password(user['password'], password):
+        return None
+    if passwords.needs_rehash(user['password']):
+        _rehash_password(user, password)
+    return user
+
+def _rehash_password(user, password):
+    """Aggiorna un hash con parametri vecchi (PASSWORD_HASH_METHOD cambiato)"""
+    try:
+        hashed = passwords.hash_password(password)
+    except passwords.HashingBusy:
+        return  # Si riproverà al prossimo login
+    # Solo se nel frattempo la password non è cambiata
+    users_collection.update_one({'_id': user['_id'], 'password': user['password']}, {'$set': {'password': hashed}})
 
 def get_user_by_email(email):
     return users_collection.find_one({'email': email})
 
-def add_location(title, latitude, longitude, user_email, description=None):
+def get_data_version(user_email):
+    """Versione dei dati dell'utente: cambia ad ogni scrittura su posizioni o ricordi"""
+    user = users_collection.find_one({'email': user_email}, {'data_version': 1})
+    return user.get('data_version', 0) if user else 0
+
+def _bump_version(user_email):
+    # Va chiamata DOPO la scrittura: chi legge la versione nuova vede già i dati nuovi
+    users_collection.update_one({'email': user_email}, {'$inc': {'data_version': 1}})
+
+def _bump_versions(user_emails):
+    """Come _bump_version per più utenti (migrazioni): le loro cache e gli ETag vanno rigenerati"""
+    if user_emails:
+        users_collection.update_many({'email': {'$in': list(user_emails)}}, {'$inc': {'data_version': 1}})
+
+def _notify_change(user_email, entity, op, doc_id=None):
+    """Dopo una scrittura: nuova versione dei dati ed evento per /api/events"""
+    _bump_version(user_email)
+    events.publish(user_email, entity, op, doc_id)
+
+def _write(callback):
+    """Esegue callback(session) e ne ritorna il risultato.
+
+    Con MONGO_TRANSACTIONS=1 callback gira in una transazione (e può essere
+    ripetuta da with_transaction in caso di conflitto), altrimenti senza
+    sessione. Gli effetti fuori dal database (eventi, versione) vanno fatti
+    dopo, sul risultato.
+    """
+    if not TRANSACTIONS_ENABLED:
+        return callback(None)
+    with client.start_session() as session:
+        return session.with_transaction(callback)
+
+def _add_tombstone(user_email, kind, doc_id, deleted_at=None, session=None):
+    """Registra l'eliminazione di un documento ('memory' o 'location') per /api/sync"""
+    db[TOMBSTONES_COLLECTION].insert_one({
+        'user_email': user_email,
+        'kind': kind,
+        'doc_id': doc_id,
+        'deleted_at': deleted_at or datetime.utcnow()
+    }, session=session)
+
+def _object_id(value):
+    """Converte un id stringa in ObjectId, None se non valido"""
+    try:
+        return ObjectId(value)
+    except (InvalidId, TypeError):
+        return None
+
+def _public(doc):
+    """Sostituisce _id con l'id stringa usato dalle API"""
+    doc['id'] = str(doc.pop('_id'))
+    return doc
+
+def _geo_point(latitude, longitude):
+    """Costruisce un punto GeoJSON ([lon, lat]) o None se le coordinate non sono valide"""
+    try:
+        lat = float(latitude)
+        lon = float(longitude)
+    except (TypeError, ValueError):
+        return None
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        return None
+    return {'type': 'Point', 'coordinates': [lon, lat]}
+
+def _bbox_polygon(min_lon, min_lat, max_lon, max_lat):
+    """Poligono GeoJSON antiorario per un bounding box (min_lon < max_lon).
+
+    I lati orizzontali vengono densificati, perché su 2dsphere i lati sono
+    geodetiche e non paralleli; il CRS strictwinding permette box più grandi
+    di un emisfero.
+    """
+    steps = max(1, int((max_lon - min_lon) // BBOX_EDGE_STEP) + 1)
+    width = (max_lon - min_lon) / steps
+    bottom = [[min_lon + i * width, min_lat] for i in range(steps + 1)]
+    top = [[max_lon - i * width, max_lat] for i in range(steps + 1)]
+    ring = bottom + top + [[min_lon, min_lat]]
+    return {
+        'type': 'Polygon',
+        'coordinates': [ring],
+        'crs': {'type': 'name', 'properties': {'name': 'urn:x-mongodb:crs:strictwinding:EPSG:4326'}}
+    }
+
+def ensure_indexes():
+    """Crea gli indici dichiarati in INDEXES (operazione idempotente)"""
+    for collection_name, names in REPLACED_INDEXES.items():
+        existing = db[collection_name].index_information()
+        for name in names:
+            if name in existing:
+                db[collection_name].drop_index(name)
+    for collection_name, indexes in INDEXES.items():
+        collection = db[collection_name]
+        for name, keys, options in indexes:
+            collection.create_index(keys, name=name, **options)
+
+def verify_indexes():
+    """Confronta gli indici dichiarati con quelli presenti.
+
+    Ritorna una lista di (collezione, nome indice, problema); vuota se tutto è a posto.
+    """
+    problems = []
+    for collection_name, indexes in INDEXES.items():
+        existing = db[collection_name].index_information()
+        for name, keys, options in indexes:
+            info = existing.get(name)
+            if info is None:
+                problems.append((collection_name, name, 'mancante'))
+            elif any(kind == TEXT for _, kind in keys):
+                # Gli indici text espongono i campi nei weights; in key restano solo i prefissi
+                prefix = [(field, kind) for field, kind in keys if kind != TEXT]
+                if set(info.get('weights', {})) != {field for field, kind in keys if kind == TEXT}:
+                    problems.append((collection_name, name, f"campi diversi: {info.get('weights')}"))
+                elif [tuple(k) for k in info['key']][:len(prefix)] != prefix:
+                    problems.append((collection_name, name, f"chiavi diverse: {info['key']}"))
+            elif [tuple(k) for k in info['key']] != [tuple(k) for k in keys]:
+                problems.append((collection_name, name, f"chiavi diverse: {info['key']}"))
+            elif options.get('unique') and not info.get('unique'):
+                problems.append((collection_name, name, 'non unico'))
+    return problems
+
+def find_duplicate_emails():
+    """Email registrate più volte, che impediscono la creazione dell'indice unico"""
+    pipeline = [
+        {'$group': {'_id': '$email', 'count': {'$sum': 1}}},
+        {'$match': {'count': {'$gt': 1}}}
+    ]
+    return [(d['_id'], d['count']) for d in users_collection.aggregate(pipeline)]
+
+def _plan_stages(plan):
+    """Elenco degli stage di un winningPlan, dal più esterno al più interno"""
+    stages = []
+    while plan:
+        stages.append(plan.get('stage'))
+        if plan.get('indexName'):
+            stages[-1] += f"({plan['indexName']})"
+        if 'inputStage' in plan:
+            plan = plan['inputStage']
+        elif plan.get('inputStages'):
+            plan = plan['inputStages'][0]
+        else:
+            plan = None
+    return stages
+
+def explain_hot_queries(user_email):
+    """Piani di esecuzione delle query più frequenti per un utente.
+
+    Ritorna una lista di (descrizione, stage del piano vincente).
+    """
+    queries = [
+        ('users per email', users_collection.find({'email': user_email})),
+        ('posizioni utente', locations_collection.find({'user_email': user_email})),
+        ('posizioni vicine', locations_collection.find({
+            'user_email': user_email,
+            'geo': {'$near': {'$geometry': {'type': 'Point', 'coordinates': [0, 0]}}}
+        })),
+        ('posizioni nel riquadro', locations_collection.find(_bbox_query(user_email, -10, -10, 10, 10))),
+        ('ricordi utente (pagina)', memories_collection.find({'user_email': user_email})
+            .sort([('date', DESCENDING), ('_id', DESCENDING)]).limit(50)),
+        ('ricordi per file', memories_collection.find({'files.url': ''})),
+        ('ricordi modificati (sync)', memories_collection.find({'user_email': user_email, 'updated_at': {'$gt': datetime.utcnow()}})),
+    ]
+    report = []
+    for description, cursor in queries:
+        plan = cursor.explain().get('queryPlanner', {}).get('winningPlan', {})
+        # Dalla 7.0 il piano può essere annidato sotto queryPlan
+        plan = plan.get('queryPlan', plan)
+        report.append((description, _plan_stages(plan)))
+    return report
+
+def migrate_locations_to_geojson(batch_size=500):
+    """Aggiunge punto GeoJSON e quadkey alle posizioni salvate solo con latitude/longitude.
+
+    Ritorna il numero di documenti aggiornati; quelli con coordinate non valide
+    vengono lasciati senza campi geo e quadkey.
+    """
+    updated = 0
+    ops = []
+    users = set()
+    cursor = locations_collection.find(
+        {'$or': [{'geo': {'$exists': False}}, {'quadkey': {'$exists': False}}]},
+        {'latitude': 1, 'longitude': 1, 'user_email': 1}
+    )
+    for loc in cursor:
+        point = _geo_point(loc.get('latitude'), loc.get('longitude'))
+        if point is None:
+            continue
+        quadkey = quadkey_for(loc['latitude'], loc['longitude'])
+        ops.append(UpdateOne({'_id': loc['_id']}, {'$set': {'geo': point, 'quadkey': quadkey}}))
+        users.add(loc.get('user_email'))
+        if len(ops) >= batch_size:
+            updated += locations_collection.bulk_write(ops, ordered=False).modified_count
+            _bump_versions(users)
+            ops, users = [], set()
+    if ops:
+        updated += locations_collection.bulk_write(ops, ordered=False).modified_count
+        _bump_versions(users)
+    return updated
+
+def _location_document(title, latitude, longitude, user_email, description=None):
+    now = datetime.utcnow()
     location = {
         'title': title,
         'latitude': latitude,
         'longitude': longitude,
         'description': description or '',
-        'created_at': datetime.utcnow(),
+        'created_at': now,
+        'updated_at': now,
         'user_email': user_email
     }
+    point = _geo_point(latitude, longitude)
+    if point:
+        location['geo'] = point
+        location['quadkey'] = quadkey_for(latitude, longitude)
+    return location
+
+def add_location(title, latitude, longitude, user_email, description=None):
+    location = _location_document(title, latitude, longitude, user_email, description)
     result = locations_collection.insert_one(location)
+    _notify_change(user_email, 'location', 'create', result.inserted_id)
     return str(result.inserted_id)
 
 def get_locations(user_email):
-    locations = list(locations_collection.find({'user_email': user_email}, {'_id': 0}))
+    locations = [_public(loc) for loc in locations_collection.find({'user_email': user_email}, LOCATION_PROJECTION)]
     return locations
 
-def delete_location(title, latitude, longitude, user_email):
-    result = locations_collection.delete_one({
+def _bbox_query(user_email, min_lon, min_lat, max_lon, max_lat):
+    if min_lon > max_lon:
+        # Il box attraversa l'antimeridiano: lo si divide in due parti
+        polygons = [
+            _bbox_polygon(min_lon, min_lat, 180.0, max_lat),
+            _bbox_polygon(-180.0, min_lat, max_lon, max_lat)
+        ]
+    else:
+        polygons = [_bbox_polygon(min_lon, min_lat, max_lon, max_lat)]
+    # user_email in ogni ramo: ciascuno usa l'indice (user_email, geo)
+    return {'$or': [{'user_email': user_email, 'geo': {'$geoWithin': {'$geometry': poly}}} for poly in polygons]}
+
+def get_locations_in_bbox(user_email, min_lon, min_lat, max_lon, max_lat):
+    """Posizioni dell'utente contenute nel bounding box (gestisce l'antimeridiano)"""
+    query = _bbox_query(user_email, min_lon, min_lat, max_lon, max_lat)
+    return [_public(loc) for loc in locations_collection.find(query, LOCATION_PROJECTION)]
+
+def get_locations_near(user_email, latitude, longitude, radius=None, limit=None):
+    """Posizioni dell'utente ordinate per distanza dal punto, entro radius metri"""
+    near = {'$geometry': {'type': 'Point', 'coordinates': [longitude, latitude]}}
+    if radius is not None:
+        near['$maxDistance'] = radius
+    cursor = locations_collection.find(
+        {'user_email': user_email, 'geo': {'$near': near}},
+        LOCATION_PROJECTION
+    )
+    if limit:
+        cursor = cursor.limit(limit)
+    return [_public(loc) for loc in cursor]
+
+def get_location_clusters(user_email, tile_quadkey, cluster_zoom, sample_size=3):
+    """Aggrega le posizioni del tile tile_quadkey in celle di livello cluster_zoom.
+
+    Usa l'indice (user_email, quadkey): il tile è l'intervallo [quadkey, quadkey + '4').
+    Per ogni cella ritorna quadkey, numero di posizioni, baricentro e alcuni titoli.
+    """
+    pipeline = [
+        {'$match': {
+            'user_email': user_email,
+            'quadkey': {'$gte': tile_quadkey, '$lt': tile_quadkey + '4'}
+        }},
+        {'$group': {
+            '_id': {'$substrCP': ['$quadkey', 0, cluster_zoom]},
+            'count': {'$sum': 1},
+            'latitude': {'$avg': '$latitude'},
+            'longitude': {'$avg': '$longitude'},
+            'titles': {'$firstN': {'input': '$title', 'n': sample_size}},
+            'location_id': {'$first': '$_id'}
+        }}
+    ]
+    clusters = []
+    for cell in locations_collection.aggregate(pipeline):
+        cluster = {
+            'tile': cell['_id'],
+            'count': cell['count'],
+            'latitude': cell['latitude'],
+            'longitude': cell['longitude'],
+            'titles': cell['titles']
+        }
+        if cell['count'] == 1:
+            # Posizione singola: il client può aprirla direttamente
+            cluster['id'] = str(cell['location_id'])
+        clusters.append(cluster)
+    return clusters
+
+def _location_query_by_keys(title, latitude, longitude, user_email):
+    return {
         'title': title,
         'latitude': float(latitude),
         'longitude': float(longitude),
         'user_email': user_email
-    })
-    return result.deleted_count > 0
+    }
 
-def update_location(old, updated, user_email):
-    query = {
-        'title': old['title'],
-        'latitude': float(old['latitude']),
-        'longitude': float(old['longitude']),
-        'user_email': user_email
+def _location_query_by_id(location_id, user_email):
+    oid = _object_id(location_id)
+    if oid is None:
+        return None
+    return {'_id': oid, 'user_email': user_email}
+
+def _location_snapshot(location):
+    """Copia incorporabile in un ricordo dei campi pubblici di una posizione"""
+    return {
+        'title': location['title'],
+        'latitude': location['latitude'],
+        'longitude': location['longitude'],
+        'description': location.get('description', '')
     }
+
+def _link_copies_op(location, updated_at=None):
+    """Operazione che sostituisce le copie incorporate della posizione con un riferimento"""
+    update = {'$set': {'locations.$[copy]': {'location_id': location['_id']}}}
+    if updated_at is not None:
+        update['$set']['updated_at'] = updated_at
+    return UpdateMany(
+        {'user_email': location['user_email'], 'locations': {'$elemMatch': {
+            'location_id': {'$exists': False},
+            'title': location['title'],
+            'latitude': location['latitude'],
+            'longitude': location['longitude']
+        }}},
+        update,
+        array_filters=[{
+            'copy.location_id': {'$exists': False},
+            'copy.title': location['title'],
+            'copy.latitude': location['latitude'],
+            'copy.longitude': location['longitude']
+        }]
+    )
+
+def _delete_location(query):
+    if query is None:
+        return False
+
+    def write(session):
+        location = locations_collection.find_one_and_delete(query, session=session)
+        if location is None:
+            return None
+        now = datetime.utcnow()
+        _add_tombstone(location['user_email'], 'location', location['_id'], now, session=session)
+        # I ricordi che la citavano mantengono una copia: il luogo del ricordo non si perde
+        memories_collection.bulk_write([
+            UpdateMany(
+                {'user_email': location['user_email'], 'locations.location_id': location['_id']},
+                {'$set': {'locations.$[ref]': _location_snapshot(location), 'updated_at': now}},
+                array_filters=[{'ref.location_id': location['_id']}]
+            ),
+        ], ordered=False, session=session)
+        return location
+
+    location = _write(write)
+    if location is None:
+        return False
+    _notify_change(query['user_email'], 'location', 'delete', location['_id'])
+    return True
+
+def _update_location(query, updated):
+    if query is None:
+        return False
+    now = datetime.utcnow()
     update_fields = {
         'title': updated['title'],
         'latitude': float(updated['latitude']),
         'longitude': float(updated['longitude']),
-        'description': updated.get('description', '')
+        'description': updated.get('description', ''),
+        'updated_at': now
+    }
+    update = {'$set': update_fields}
+    point = _geo_point(update_fields['latitude'], update_fields['longitude'])
+    if point:
+        update_fields['geo'] = point
+        update_fields['quadkey'] = quadkey_for(update_fields['latitude'], update_fields['longitude'])
+    else:
+        update['$unset'] = {'geo': '', 'quadkey': ''}
+
+    def write(session):
+        previous = locations_collection.find_one_and_update(query, update, return_document=ReturnDocument.BEFORE,
+                                                            session=session)
+        if previous is None:
+            return None
+        # I ricordi con riferimenti vedono già i nuovi valori; le vecchie copie
+        # incorporate (dati precedenti alla normalizzazione) diventano riferimenti.
+        # In entrambi i casi il ricordo risulta modificato per /api/sync
+        memories_collection.bulk_write([
+            _link_copies_op(previous, now),
+            UpdateMany({'user_email': previous['user_email'], 'locations.location_id': previous['_id']},
+                       {'$set': {'updated_at': now}}),
+        ], session=session)
+        return previous
+
+    previous = _write(write)
+    if previous is None:
+        return False
+    _notify_change(query['user_email'], 'location', 'update', previous['_id'])
+    return True
+
+def delete_location(title, latitude, longitude, user_email):
+    return _delete_location(_location_query_by_keys(title, latitude, longitude, user_email))
+
+def delete_location_by_id(location_id, user_email):
+    return _delete_location(_location_query_by_id(location_id, user_email))
+
+def update_location(old, updated, user_email):
+    query = _location_query_by_keys(old['title'], old['latitude'], old['longitude'], user_email)
+    return _update_location(query, updated)
+
+def update_location_by_id(location_id, updated, user_email):
+    return _update_location(_location_query_by_id(location_id, user_email), updated)
+
+def _recorded_uploads(user_email, files, session=None):
+    """Upload registrati dall'utente (record_upload) per gli URL dei file, per URL"""
+    urls = [file_data['url'] for file_data in files or [] if file_data.get('url')]
+    if not urls:
+        return {}
+    cursor = db[UPLOADS_COLLECTION].find({'url': {'$in': urls}, 'user_email': user_email},
+                                         {'url': 1, 'resource_type': 1, 'public_id': 1}, session=session)
+    return {upload['url']: upload for upload in cursor}
+
+def _file_entry(file_data, previous=None, recorded=None):
+    """Documento di un file allegato, con resource_type e public_id esatti per l'eliminazione.
+
+    resource_type e public_id decidono cosa verrà eliminato da Cloudinary: si
+    prendono dal file già salvato (previous) o dall'upload verificato e
+    registrato dall'utente (recorded), mai dal corpo della richiesta;
+    altrimenti si ricavano dall'URL.
+    """
+    previous = previous or {}
+    trusted = previous if previous.get('public_id') else (recorded or {})
+    resource_type, public_id = resolve_resource(
+        file_data['url'], trusted.get('resource_type'), trusted.get('public_id')
+    )
+    entry = {
+        'url': file_data['url'],
+        'display_name': file_data.get('display_name', file_data.get('original_name', 'File senza nome')),
+        'original_name': file_data.get('original_name', ''),
+        'size': file_data.get('size', 0),
+        'type': file_data.get('type', ''),
+        'uploaded_at': datetime.utcnow()
+    }
+    if resource_type:
+        entry['resource_type'] = resource_type
+        entry['public_id'] = public_id
+    # Metadati registrati dagli upload firmati (vedi record_upload)
+    for key in ('width', 'height', 'format', 'duration'):
+        if file_data.get(key) is not None:
+            entry[key] = file_data[key]
+    # Varianti ridotte (thumbnail, preview, poster): calcolate una volta sola, all'aggiunta del file
+    derivatives = previous.get('derivatives') or media.derivatives(entry)
+    if derivatives:
+        entry['derivatives'] = derivatives
+    return entry
+
+def record_upload(user_email, upload, display_name=None, mime_type=''):
+    """Registra un upload completato e ritorna il file pronto per add_memory/add_file_to_memory.
+
+    upload è la risposta di Cloudinary (già verificata con verify_upload_response).
+    """
+    file_data = {
+        'url': upload['secure_url'],
+        'display_name': display_name or upload.get('original_filename') or 'File senza nome',
+        'original_name': upload.get('original_filename', ''),
+        'size': upload.get('bytes', 0),
+        'type': mime_type,
+        'resource_type': upload.get('resource_type'),
+        'public_id': upload.get('public_id'),
+        'width': upload.get('width'),
+        'height': upload.get('height'),
+        'format': upload.get('format'),
+        'duration': upload.get('duration')
     }
-    result = locations_collection.update_one(query, {'$set': update_fields})
-    return result.matched_count > 0
+    file_data = {k: v for k, v in file_data.items() if v is not None}
+    db[UPLOADS_COLLECTION].update_one(
+        {'url': file_data['url']},
+        {'$set': dict(file_data, user_email=user_email, created_at=datetime.utcnow())},
+        upsert=True
+    )
+    return file_data
+
+def enqueue_file_deletions(files, session=None):
+    """Accoda i file Cloudinary da eliminare; li elabora deletion_queue.DeletionWorker"""
+    now = datetime.utcnow()
+    entries = []
+    for file_data in files:
+        if not file_data.get('url'):
+            continue
+        entry = {'url': file_data['url'], 'status': 'pending', 'attempts': 0,
+                 'created_at': now, 'next_attempt_at': now}
+        if file_data.get('resource_type') and file_data.get('public_id'):
+            entry['resource_type'] = file_data['resource_type']
+            entry['public_id'] = file_data['public_id']
+        entries.append(entry)
+    if entries:
+        deletions_collection.insert_many(entries, session=session)
+    return len(entries)
+
+def iter_file_references(batch_size=1000):
+    """Genera (url, resource_type, public_id) di tutti i file dei ricordi, leggendo da un cursore"""
+    cursor = memories_collection.find(
+        {'files.0': {'$exists': True}},
+        {'_id': 0, 'files.url': 1, 'files.resource_type': 1, 'files.public_id': 1}
+    ).batch_size(batch_size)
+    for mem in cursor:
+        for file_data in mem.get('files', []):
+            yield file_data.get('url'), file_data.get('resource_type'), file_data.get('public_id')
+
+def delete_upload_records(urls):
+    """Rimuove gli upload registrati con gli URL indicati (file eliminati da Cloudinary)"""
+    deleted = 0
+    urls = list(urls)
+    for start in range(0, len(urls), BULK_CHUNK_SIZE):
+        deleted += db[UPLOADS_COLLECTION].delete_many({'url': {'$in': urls[start:start + BULK_CHUNK_SIZE]}}).deleted_count
+    return deleted
 
 #------------------------------------------------------------------
-def add_memory(title, date, text, user_email, locations=None, files=None):
+def _location_entry(loc):
+    """Posizione di un ricordo: riferimento per id se la posizione è salvata, altrimenti copia"""
+    location_id = _object_id(loc.get('id', loc.get('location_id')))
+    if location_id is not None:
+        return {'location_id': location_id}
+    return _location_snapshot(loc)
+
+def _hydrate_locations(memories, user_email):
+    """Sostituisce i riferimenti nei ricordi con i dati attuali delle posizioni.
+
+    Una sola query per tutti i ricordi della risposta; le copie incorporate
+    restano come sono.
+    """
+    ids = {loc['location_id'] for mem in memories for loc in mem.get('locations', ()) if 'location_id' in loc}
+    found = {}
+    if ids:
+        found = {
+            loc['_id']: loc for loc in locations_collection.find(
+                {'_id': {'$in': list(ids)}, 'user_email': user_email},
+                {'title': 1, 'latitude': 1, 'longitude': 1, 'description': 1}
+            )
+        }
+    for mem in memories:
+        if 'locations' not in mem:
+            continue
+        hydrated = []
+        for loc in mem['locations']:
+            if 'location_id' not in loc:
+                hydrated.append(loc)
+            elif loc['location_id'] in found:
+                hydrated.append(_public(dict(found[loc['location_id']])))
+        mem['locations'] = hydrated
+    return memories
+
+def migrate_memory_location_refs(batch_size=500):
+    """Converte le copie incorporate delle posizioni salvate in riferimenti per id"""
+    updated = 0
+    ops = []
+    for location in locations_collection.find({}, {'title': 1, 'latitude': 1, 'longitude': 1, 'user_email': 1}):
+        ops.append(_link_copies_op(location))
+        if len(ops) >= batch_size:
+            updated += memories_collection.bulk_write(ops, ordered=False).modified_count
+            ops = []
+    if ops:
+        updated += memories_collection.bulk_write(ops, ordered=False).modified_count
+    return updated
+
+def migrate_file_derivatives(batch_size=500, build=media.derivatives):
+    """Aggiunge le varianti (thumbnail, preview, poster) ai file allegati prima che esistessero.
+
+    build calcola le varianti di un file: di default gli URL di trasformazione
+    Cloudinary (nessuna chiamata di rete).
+    """
+    updated = 0
+    ops = []
+    users = set()
+    now = datetime.utcnow()
+    cursor = memories_collection.find(
+        {'files': {'$elemMatch': {'derivatives': {'$exists': False}}}}, {'files': 1, 'user_email': 1}
+    ).batch_size(batch_size)
+    for mem in cursor:
+        files = []
+        for file_data in mem['files']:
+            derivatives = file_data.get('derivatives') or build(file_data)
+            files.append(dict(file_data, derivatives=derivatives) if derivatives else file_data)
+        if files == mem['files']:
+            continue
+        # Solo se i file non sono cambiati nel frattempo
+        ops.append(UpdateOne({'_id': mem['_id'], 'files': mem['files']},
+                             {'$set': {'files': files, 'updated_at': now}}))
+        users.add(mem.get('user_email'))
+        if len(ops) >= batch_size:
+            updated += memories_collection.bulk_write(ops, ordered=False).modified_count
+            _bump_versions(users)
+            ops, users = [], set()
+    if ops:
+        updated += memories_collection.bulk_write(ops, ordered=False).modified_count
+        _bump_versions(users)
+    return updated
+
+def generate_local_file_derivatives(batch_size=50):
+    """Genera con Pillow le varianti delle immagini fuori da Cloudinary (host in MEDIA_LOCAL_HOSTS).
+
+    Scarica ogni immagine: va eseguito come job di manutenzione (manage_db.py media).
+    """
+    return migrate_file_derivatives(batch_size, build=media.local_derivatives)
+
+def _memory_document(title, date, text, user_email, locations=None, files=None):
+    now = datetime.utcnow()
     memory = {
         'title': title,
         'date': datetime.strptime(date, '%Y-%m-%d'),
         'text': text,
         'user_email': user_email,
-        'created_at': datetime.utcnow(),
+        'created_at': now,
+        'updated_at': now,
         'locations': [
-            {
-                'title': loc['title'],
-                'latitude': loc['latitude'],
-                'longitude': loc['longitude'],
-                'description': loc.get('description', '')
-            } for loc in (locations or [])
+            _location_entry(loc) for loc in (locations or [])
         ] if locations else [],
-        'files': [
-            {
-                'url': file_data['url'],
-                'display_name': file_data.get('display_name', file_data.get('original_name', 'File senza nome')),
-                'original_name': file_data.get('original_name', ''),
-                'size': file_data.get('size', 0),
-                'type': file_data.get('type', ''),
-                'uploaded_at': datetime.utcnow()
-            } for file_data in (files or [])
-        ] if files else []
+        'files': []
     }
+    if files:
+        recorded = _recorded_uploads(user_email, files)
+        memory['files'] = [_file_entry(file_data, recorded=recorded.get(file_data['url'])) for file_data in files]
+    return memory
+
+def add_memory(title, date, text, user_email, locations=None, files=None):
+    memory = _memory_document(title, date, text, user_email, locations, files)
     result = memories_collection.insert_one(memory)
+    _notify_change(user_email, 'memory', 'create', result.inserted_id)
     return str(result.inserted_id)
 
-def get_memories(user_email):
-    memories = list(memories_collection.find(
-        {'user_email': user_email},
-        {'_id': 0, 'created_at': 0}
-    ))
-    for mem in memories:
-        mem['date'] = mem['date'].strftime('%Y-%m-%d')
-    return memories
+#------------------------------------------------------------------
+# Import / export bulk
+def _bulk_error(e):
+    """Messaggio leggibile per un elemento bulk non valido"""
+    if isinstance(e, KeyError):
+        return f"campo mancante: {e.args[0]}"
+    if isinstance(e, ValueError) and str(e):
+        return str(e)
+    return 'valore non valido'
 
-def delete_memories(title, date, text, user_email):
-    """Elimina un ricordo e tutti i suoi file associati da Cloudinary"""
-    # Prima recupera il ricordo per ottenere i file
-    memory = memories_collection.find_one({
-        'title': title,
-        'date': datetime.strptime(date, '%Y-%m-%d'),
-        'text': text,
-        'user_email': user_email
-    })
-    
-    if not memory:
-        return False
-    
-    # Elimina tutti i file da Cloudinary
-    files_to_delete = memory.get('files', [])
-    for file_data in files_to_delete:
-        file_url = file_data.get('url')
-        if file_url:
-            try:
-                delete_success = delete_file_from_cloudinary(file_url)
-                if not delete_success:
-                    print(f"Avviso: Non è stato possibile eliminare il file da Cloudinary: {file_url}")
-            except Exception as e:
-                print(f"Errore nell'eliminazione da Cloudinary: {e}")
-    
-    # Elimina il ricordo dal database
-    result = memories_collection.delete_one({
+def _bulk_insert(collection, items, build):
+    """Inserisce gli elementi a blocchi con insert_many(ordered=False).
+
+    items è un iterabile (anche uno stream) di dizionari; build(item) crea il
+    documento, ritorna l'ObjectId di un elemento già salvato (nessun
+    inserimento) o solleva un'eccezione se l'elemento non è valido. Ritorna un
+    risultato per elemento: {'index', 'id'} oppure {'index', 'error'}.
+    """
+    results = []
+    chunk = []
+
+    def flush():
+        if not chunk:
+            return
+        indexes = [index for index, _ in chunk]
+        docs = [doc for _, doc in chunk]
+        failed = {}
+        try:
+            collection.insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            for error in e.details.get('writeErrors', []):
+                failed[error['index']] = error.get('errmsg', 'errore di scrittura')
+        for position, (index, doc) in enumerate(zip(indexes, docs)):
+            if position in failed:
+                results.append({'index': index, 'error': failed[position]})
+            else:
+                results.append({'index': index, 'id': str(doc['_id'])})
+        chunk.clear()
+
+    for index, item in enumerate(items):
+        try:
+            if not isinstance(item, dict):
+                raise ValueError('atteso un oggetto JSON')
+            built = build(item)
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            results.append({'index': index, 'error': f"elemento non valido: {_bulk_error(e)}"})
+            continue
+        if isinstance(built, ObjectId):
+            results.append({'index': index, 'id': str(built)})
+        else:
+            chunk.append((index, built))
+        if len(chunk) >= BULK_CHUNK_SIZE:
+            flush()
+    flush()
+    results.sort(key=lambda r: r['index'])
+    return results
+
+def _bulk_location_document(item, user_email):
+    if not item.get('title'):
+        raise ValueError('title mancante')
+    return _location_document(item['title'], float(item['latitude']), float(item['longitude']),
+                              user_email, item.get('description'))
+
+def _location_key(loc):
+    return loc['title'], float(loc['latitude']), float(loc['longitude'])
+
+def add_locations_bulk(items, user_email):
+    results = _bulk_insert(locations_collection, items, lambda item: _bulk_location_document(item, user_email))
+    if any('id' in r for r in results):
+        _notify_change(user_email, 'location', 'bulk')
+    return results
+
+def add_memories_bulk(items, user_email):
+    """Import bulk di ricordi; accetta anche l'output completo di export_user_data.
+
+    Gli elementi con type='location' creano la posizione, a meno che l'utente
+    non ne abbia già una con stesso titolo e coordinate. Le posizioni dei
+    ricordi importati che corrispondono a una posizione salvata diventano
+    riferimenti (come in migrate_memory_location_refs), così filtri e
+    aggiornamenti delle posizioni valgono anche per loro; le altre restano copie.
+    """
+    # Posizioni salvate dell'utente per (titolo, latitudine, longitudine)
+    saved = {}
+    for loc in locations_collection.find({'user_email': user_email}, {'title': 1, 'latitude': 1, 'longitude': 1}):
+        try:
+            saved.setdefault(_location_key(loc), loc['_id'])
+        except (KeyError, TypeError, ValueError):
+            continue
+    created_locations = []
+    built_memories = False
+
+    def build(item):
+        nonlocal built_memories
+        if item.get('type') == 'location':
+            key = _location_key(item)
+            if key not in saved:
+                document = _bulk_location_document(item, user_email)
+                saved[key] = locations_collection.insert_one(document).inserted_id
+                created_locations.append(saved[key])
+            return saved[key]
+        locations = []
+        for loc in item.get('locations') or []:
+            # Gli id di un export non valgono qui: si cerca la posizione salvata corrispondente
+            location_id = saved.get(_location_key(loc))
+            locations.append({'location_id': location_id} if location_id else _location_snapshot(loc))
+        memory = _memory_document(item['title'], item['date'], item.get('text', ''),
+                                  user_email, None, item.get('files'))
+        memory['locations'] = locations
+        built_memories = True
+        return memory
+
+    results = _bulk_insert(memories_collection, items, build)
+    if created_locations:
+        _notify_change(user_email, 'location', 'bulk')
+    if built_memories and any('id' in r for r in results):
+        _notify_change(user_email, 'memory', 'bulk')
+    return results
+
+def export_user_data(user_email, batch_size=500):
+    """Genera tutte le posizioni e i ricordi dell'utente, uno alla volta, dai cursori Mongo.
+
+    Ogni elemento ha un campo 'type' ('location' o 'memory'); l'export
+    completo si può reimportare con add_memories_bulk (POST /api/memories/bulk).
+    """
+    for loc in locations_collection.find({'user_email': user_email}, dict(LOCATION_PROJECTION, user_email=0)).batch_size(batch_size):
+        loc = _public(loc)
+        loc['type'] = 'location'
+        yield loc
+    cursor = memories_collection.aggregate(
+        [{'$match': {'user_email': user_email}}, {'$sort': {'date': ASCENDING}}]
+        + _public_memory_stages(variant='full', extra={'type': {'$literal': 'memory'}}, exclude=('user_email',)),
+        batchSize=batch_size
+    )
+    batch = []
+    for mem in cursor:
+        batch.append(mem)
+        if len(batch) >= batch_size:
+            yield from _hydrate_locations(batch, user_email)
+            batch = []
+    yield from _hydrate_locations(batch, user_email)
+
+def _memory_query_by_keys(title, date, text, user_email):
+    """Query legacy: ricordo identificato da titolo, data e testo"""
+    return {
         'title': title,
         'date': datetime.strptime(date, '%Y-%m-%d'),
         'text': text,
         'user_email': user_email
-    })
-    return result.deleted_count > 0
+    }
 
-def update_memory(old_title, old_date, old_text, user_email, new_data):
-    # Cerca il ricordo da aggiornare
-    query = {
-        'title': old_title,
-        'date': datetime.strptime(old_date, '%Y-%m-%d'),
-        'text': old_text,
-        'user_email': user_email
+def _memory_query_by_id(memory_id, user_email):
+    """Query per _id (None se l'id non è un ObjectId valido)"""
+    oid = _object_id(memory_id)
+    if oid is None:
+        return None
+    return {'_id': oid, 'user_email': user_email}
+
+def _public_memory_stages(fields=None, variant='full', extra=None, exclude=(), keep=()):
+    """Stage di aggregazione che producono i ricordi nel formato delle API.
+
+    id stringa, data 'YYYY-MM-DD' e file ridotti alla variante richiesta
+    (vedi media.variant_expression) vengono calcolati da Mongo: i documenti
+    arrivano pronti per la serializzazione, senza un passaggio Python per
+    ricordo. fields vuoto o None significa tutti i campi pubblici; extra
+    aggiunge campi calcolati, exclude toglie campi, keep conserva campi interni
+    anche con fields. ValueError se un campo richiesto non esiste.
+    """
+    computed = {'id': {'$toString': '$_id'}}
+    hidden = {'_id': 0}
+    if fields:
+        unknown = set(fields) - set(MEMORY_FIELDS)
+        if unknown:
+            raise ValueError(f"Campi non validi: {', '.join(sorted(unknown))}")
+        stages = [{'$project': {field: 1 for field in (*fields, *keep)}}]
+    else:
+        fields = MEMORY_FIELDS
+        stages = []
+        hidden['created_at'] = 0
+    if 'date' in fields:
+        computed['date'] = {'$dateToString': {'format': '%Y-%m-%d', 'date': '$date'}}
+    if 'files' in fields and variant != 'full':
+        computed['files'] = media.variant_expression('$files', variant)
+    computed.update(extra or {})
+    hidden.update({field: 0 for field in exclude})
+    return stages + [{'$addFields': computed}, {'$project': hidden}]
+
+def _encode_cursor(memory):
+    raw = json.dumps({'d': memory['date'].isoformat(), 'id': str(memory['_id'])})
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+def _decode_cursor(cursor):
+    """Decodifica il cursore opaco in (date, ObjectId); ValueError se non valido"""
+    try:
+        raw = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return datetime.fromisoformat(raw['d']), ObjectId(raw['id'])
+    except (ValueError, KeyError, TypeError, InvalidId) as e:
+        raise ValueError('Cursore non valido') from e
+
+def memory_filters(user_email, date_from=None, date_to=None, location_id=None, near=None):
+    """Query dei ricordi dell'utente con i filtri opzionali.
+
+    date_from/date_to sono date 'YYYY-MM-DD' incluse (indice user_email, date);
+    location_id e near=(lat, lon, raggio in metri) cercano i ricordi che
+    citano posizioni salvate: le posizioni vicine si trovano con l'indice
+    2dsphere, i ricordi con l'indice (user_email, locations.location_id).
+    Solleva ValueError se un filtro non è valido.
+    """
+    query = {'user_email': user_email}
+    date_range = {}
+    if date_from:
+        date_range['$gte'] = datetime.strptime(date_from, '%Y-%m-%d')
+    if date_to:
+        date_range['$lte'] = datetime.strptime(date_to, '%Y-%m-%d')
+    if date_range:
+        query['date'] = date_range
+    location_ids = None
+    if location_id is not None:
+        oid = _object_id(location_id)
+        if oid is None:
+            raise ValueError('location_id non valido')
+        location_ids = [oid]
+    if near is not None:
+        latitude, longitude, radius = near
+        radius = DEFAULT_NEAR_RADIUS if radius is None else radius
+        nearby = [loc['_id'] for loc in locations_collection.find({
+            'user_email': user_email,
+            'geo': {'$geoWithin': {'$centerSphere': [[longitude, latitude], radius / EARTH_RADIUS_M]}}
+        }, {'_id': 1})]
+        location_ids = nearby if location_ids is None else [i for i in location_ids if i in nearby]
+    if location_ids is not None:
+        query['locations.location_id'] = {'$in': location_ids}
+    return query
+
+def get_memories(user_email, fields=None, query=None, variant=media.DEFAULT_LIST_VARIANT):
+    media.check_list_variant(variant)
+    memories = list(memories_collection.aggregate(
+        [{'$match': query or {'user_email': user_email}}] + _public_memory_stages(fields, variant)
+    ))
+    return _hydrate_locations(memories, user_email)
+
+def iter_memories(user_email, fields=None, query=None, batch_size=500, variant=media.DEFAULT_LIST_VARIANT):
+    """Come get_memories, ma ritorna un generatore che legge il cursore a blocchi (risposte in streaming).
+
+    I campi non validi sollevano ValueError subito, non durante lo streaming.
+    """
+    media.check_list_variant(variant)
+    cursor = memories_collection.aggregate(
+        [{'$match': query or {'user_email': user_email}}] + _public_memory_stages(fields, variant),
+        batchSize=batch_size
+    )
+
+    def generate():
+        batch = []
+        for mem in cursor:
+            batch.append(mem)
+            if len(batch) >= batch_size:
+                yield from _hydrate_locations(batch, user_email)
+                batch = []
+        yield from _hydrate_locations(batch, user_email)
+
+    return generate()
+
+def get_memories_page(user_email, limit, cursor=None, fields=None, query=None, variant=media.DEFAULT_LIST_VARIANT):
+    """Pagina di ricordi ordinata per (date, _id) decrescenti, con paginazione keyset.
+
+    query (da memory_filters) restringe i ricordi; ritorna (ricordi, next_cursor),
+    con next_cursor None sull'ultima pagina.
+    """
+    media.check_list_variant(variant)
+    limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+    query = dict(query or {'user_email': user_email})
+    if cursor:
+        last_date, last_id = _decode_cursor(cursor)
+        query['$or'] = [
+            {'date': {'$lt': last_date}},
+            {'date': last_date, '_id': {'$lt': last_id}}
+        ]
+    # Il cursore usa la data salvata, non quella formattata della risposta:
+    # la pipeline la conserva in _cursor_date, tolto prima di rispondere
+    memories = list(memories_collection.aggregate([
+        {'$match': query},
+        {'$sort': {'date': DESCENDING, '_id': DESCENDING}},
+        {'$limit': limit + 1},
+        {'$addFields': {'_cursor_date': '$date'}},
+    ] + _public_memory_stages(fields, variant, keep=('_cursor_date',))))
+    next_cursor = None
+    if len(memories) > limit:
+        memories = memories[:limit]
+        last = memories[-1]
+        next_cursor = _encode_cursor({'date': last['_cursor_date'], '_id': last['id']})
+    for mem in memories:
+        mem.pop('_cursor_date', None)
+    return _hydrate_locations(memories, user_email), next_cursor
+
+def _encode_sync_token(moment):
+    raw = json.dumps({'t': moment.isoformat()})
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+def _decode_sync_token(token):
+    """Istante codificato nel token di sincronizzazione; ValueError se non valido"""
+    try:
+        return datetime.fromisoformat(json.loads(base64.urlsafe_b64decode(token.encode('ascii')))['t'])
+    except (ValueError, KeyError, TypeError) as e:
+        raise ValueError('Token di sincronizzazione non valido') from e
+
+def get_changes(user_email, token=None):
+    """Ricordi e posizioni cambiati, ed eliminati, dopo il token di sincronizzazione.
+
+    Senza token, o con un token più vecchio delle eliminazioni conservate
+    (TOMBSTONE_TTL_DAYS), ritorna tutti i dati con full=True. Le modifiche
+    vicine al token vengono rinviate (SYNC_OVERLAP_SECONDS): il client le
+    applica per id, quindi i duplicati non sono un problema. Solleva
+    ValueError se il token non è valido.
+    """
+    # L'istante del nuovo token precede le letture: ciò che cambia durante
+    # la risposta viene rinviato alla sincronizzazione successiva
+    now = datetime.utcnow()
+    since = _decode_sync_token(token) if token else None
+    deleted = {'memories': [], 'locations': []}
+    if since is None or since < now - timedelta(days=TOMBSTONE_TTL_DAYS):
+        return {
+            'full': True,
+            'memories': get_memories(user_email),
+            'locations': get_locations(user_email),
+            'deleted': deleted,
+            'token': _encode_sync_token(now)
+        }
+    changed = {'user_email': user_email,
+               'updated_at': {'$gt': since - timedelta(seconds=SYNC_OVERLAP_SECONDS)}}
+    tombstones = db[TOMBSTONES_COLLECTION].find(
+        {'user_email': user_email, 'deleted_at': changed['updated_at']},
+        {'kind': 1, 'doc_id': 1}
+    )
+    for tombstone in tombstones:
+        deleted['memories' if tombstone['kind'] == 'memory' else 'locations'].append(str(tombstone['doc_id']))
+    return {
+        'full': False,
+        'memories': get_memories(user_email, query=changed),
+        'locations': [_public(loc) for loc in locations_collection.find(changed, LOCATION_PROJECTION)],
+        'deleted': deleted,
+        'token': _encode_sync_token(now)
     }
-    
-    # Se stiamo aggiornando i file, controlla se dobbiamo eliminare file da Cloudinary
-    if 'files' in new_data:
-        # Recupera il ricordo attuale per vedere i file esistenti
-        current_memory = memories_collection.find_one(query)
-        if current_memory:
-            current_files = current_memory.get('files', [])
-            new_files = new_data['files'] or []
-            
-            # Trova file che sono stati rimossi
-            current_urls = {f.get('url') for f in current_files}
-            new_urls = {f.get('url') for f in new_files}
-            removed_urls = current_urls - new_urls
-            
-            # Elimina i file rimossi da Cloudinary
-            for removed_url in removed_urls:
-                if removed_url:
-                    try:
-                        delete_success = delete_file_from_cloudinary(removed_url)
-                        if not delete_success:
-                            print(f"Avviso: Non è stato possibile eliminare il file da Cloudinary: {removed_url}")
-                    except Exception as e:
-                        print(f"Errore nell'eliminazione da Cloudinary: {e}")
+
+def _search_terms(q):
+    """Termini positivi di una query $text (senza frasi tra virgolette né esclusioni)"""
+    return [t.strip('"').lower() for t in q.split() if t.strip('"') and not t.startswith('-')]
+
+def _stem(term):
+    # Prefisso del termine senza le ultime lettere: approssima lo stemming
+    # per evidenziare le corrispondenze ("viaggi" trova anche "viaggio")
+    return term[:max(3, len(term) - 2)]
+
+def _snippet(text, terms):
+    """Frammento del testo attorno al primo termine trovato"""
+    if not text:
+        return ''
+    best = None
+    for term in terms:
+        match = re.search(re.escape(_stem(term)), text, re.IGNORECASE)
+        if match and (best is None or match.start() < best):
+            best = match.start()
+    if best is None:
+        return text[:2 * SNIPPET_CONTEXT] + ('…' if len(text) > 2 * SNIPPET_CONTEXT else '')
+    start = max(0, best - SNIPPET_CONTEXT)
+    end = min(len(text), best + SNIPPET_CONTEXT)
+    return ('…' if start > 0 else '') + text[start:end] + ('…' if end < len(text) else '')
+
+def search_memories(user_email, q, limit=20, offset=0):
+    """Ricordi che corrispondono alla ricerca q, ordinati per rilevanza.
+
+    Usa l'indice text (user_email, titolo, testo, nomi dei file): la
+    condizione di uguaglianza su user_email è obbligatoria. Ritorna
+    (risultati, next_offset) con next_offset None sull'ultima pagina.
+    """
+    limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+    offset = max(0, int(offset))
+    cursor = memories_collection.find(
+        {'user_email': user_email, '$text': {'$search': q}},
+        {'score': {'$meta': 'textScore'}, 'title': 1, 'date': 1, 'text': 1, 'files.display_name': 1}
+    ).sort([('score', {'$meta': 'textScore'})]).skip(offset).limit(limit + 1)
+    memories = list(cursor)
+    next_offset = offset + limit if len(memories) > limit else None
+    terms = _search_terms(q)
+    results = []
+    for mem in memories[:limit]:
+        file_names = [f.get('display_name', '') for f in mem.get('files', [])]
+        results.append({
+            'id': str(mem['_id']),
+            'title': mem['title'],
+            'date': mem['date'].strftime('%Y-%m-%d'),
+            'score': mem['score'],
+            'snippet': _snippet(mem.get('text', ''), terms),
+            # Nomi dei file che contengono uno dei termini
+            'files': [name for name in file_names if any(_stem(t) in name.lower() for t in terms)]
+        })
+    return results, next_offset
+
+def get_memory_by_id(memory_id, user_email):
+    query = _memory_query_by_id(memory_id, user_email)
+    if query is None:
+        return None
+    memory = memories_collection.find_one(query, {'created_at': 0})
+    if memory:
+        _public(memory)
+        memory['date'] = memory['date'].strftime('%Y-%m-%d')
+        _hydrate_locations([memory], user_email)
+    return memory
+
+def _delete_memory(query):
+    """Elimina un ricordo e tutti i suoi file associati da Cloudinary"""
+    if query is None:
+        return False
+
+    def write(session):
+        # Una sola operazione: elimina il ricordo e restituisce i file che aveva
+        memory = memories_collection.find_one_and_delete(query, projection={'files': 1}, session=session)
+        if memory is None:
+            return None
+        _add_tombstone(query['user_email'], 'memory', memory['_id'], session=session)
+        # Accoda l'eliminazione di tutti i file da Cloudinary
+        enqueue_file_deletions(memory.get('files', []), session=session)
+        return memory
+
+    memory = _write(write)
+    if memory is None:
+        return False
+    _notify_change(query['user_email'], 'memory', 'delete', memory['_id'])
+    return True
+
+def delete_memories(title, date, text, user_email):
+    return _delete_memory(_memory_query_by_keys(title, date, text, user_email))
+
+def delete_memory_by_id(memory_id, user_email):
+    return _delete_memory(_memory_query_by_id(memory_id, user_email))
+
+def _update_memory(query, new_data):
+    if query is None:
+        return False
     
     update_fields = {}
     if 'title' in new_data:
@@ -190,126 +1264,158 @@ def update_memory(old_title, old_date, old_text, user_email, new_data):
         update_fields['text'] = new_data['text']
     if 'locations' in new_data:
         update_fields['locations'] = [
-            {
-                'title': loc['title'],
-                'latitude': loc['latitude'],
-                'longitude': loc['longitude'],
-                'description': loc.get('description', '')
-            } for loc in (new_data['locations'] or [])
+            _location_entry(loc) for loc in (new_data['locations'] or [])
         ]
-    if 'files' in new_data:
-        update_fields['files'] = [
-            {
-                'url': file_data['url'],
-                'display_name': file_data.get('display_name', file_data.get('original_name', 'File senza nome')),
-                'original_name': file_data.get('original_name', ''),
-                'size': file_data.get('size', 0),
-                'type': file_data.get('type', ''),
-                'uploaded_at': datetime.utcnow()
-            } for file_data in (new_data['files'] or [])
-        ]
-    if not update_fields:
+    if not update_fields and 'files' not in new_data:
         return False
-    result = memories_collection.update_one(query, {'$set': update_fields})
-    return result.modified_count > 0
+    update_fields['updated_at'] = datetime.utcnow()
 
-def get_memory_files(title, date, text, user_email):
+    if 'files' not in new_data:
+        # Una sola operazione, che restituisce anche l'id per l'evento
+        before = memories_collection.find_one_and_update(
+            query, {'$set': update_fields}, projection={'_id': 1}, return_document=ReturnDocument.BEFORE)
+    else:
+        before = _write(lambda session: _replace_memory_files(query, update_fields, new_data['files'] or [], session))
+    if before is None:
+        return False
+    _notify_change(query['user_email'], 'memory', 'update', before['_id'])
+    return True
+
+def _replace_memory_files(query, update_fields, new_files, session=None):
+    """Aggiorna un ricordo sostituendone i file; ritorna lo stato precedente o None.
+
+    I nuovi file ereditano resource_type/public_id da quelli già salvati, che
+    vanno quindi letti prima. L'aggiornamento avviene solo se nel frattempo
+    l'array dei file non è cambiato (altrimenti si rilegge e si riprova), così
+    i file rimossi accodati per l'eliminazione sono sempre quelli giusti.
+    """
+    recorded = _recorded_uploads(query['user_email'], new_files, session=session)
+    for _ in range(UPDATE_RETRIES):
+        current = memories_collection.find_one(query, {'files': 1}, session=session)
+        if current is None:
+            return None
+        current_files = current.get('files', [])
+        previous_files = {f.get('url'): f for f in current_files}
+        fields = dict(update_fields, files=[
+            _file_entry(file_data, previous_files.get(file_data['url']), recorded.get(file_data['url']))
+            for file_data in new_files
+        ])
+        guard = current_files if 'files' in current else {'$exists': False}
+        before = memories_collection.find_one_and_update(
+            dict(query, _id=current['_id'], files=guard), {'$set': fields},
+            projection={'_id': 1}, return_document=ReturnDocument.BEFORE, session=session)
+        if before is None:
+            continue
+        # Accoda l'eliminazione da Cloudinary dei file rimossi
+        new_urls = {f.get('url') for f in new_files}
+        enqueue_file_deletions([f for f in current_files if f.get('url') not in new_urls], session=session)
+        return before
+    return None
+
+def update_memory(old_title, old_date, old_text, user_email, new_data):
+    # Cerca il ricordo da aggiornare
+    return _update_memory(_memory_query_by_keys(old_title, old_date, old_text, user_email), new_data)
+
+def update_memory_by_id(memory_id, user_email, new_data):
+    return _update_memory(_memory_query_by_id(memory_id, user_email), new_data)
+
+def _get_memory_files(query):
     """Recupera i file associati a un ricordo specifico"""
-    memory = memories_collection.find_one({
-        'title': title,
-        'date': datetime.strptime(date, '%Y-%m-%d'),
-        'text': text,
-        'user_email': user_email
-    })
+    if query is None:
+        return []
+    memory = memories_collection.find_one(query, {'files': 1})
     return memory.get('files', []) if memory else []
 
-def update_file_display_name(title, date, text, user_email, file_url, new_display_name):
+def get_memory_files(title, date, text, user_email):
+    return _get_memory_files(_memory_query_by_keys(title, date, text, user_email))
+
+def get_memory_files_by_id(memory_id, user_email):
+    return _get_memory_files(_memory_query_by_id(memory_id, user_email))
+
+def _update_file_display_name(query, file_url, new_display_name):
     """Aggiorna il display_name di un file specifico in un ricordo"""
-    query = {
-        'title': title,
-        'date': datetime.strptime(date, '%Y-%m-%d'),
-        'text': text,
-        'user_email': user_email,
-        'files.url': file_url
-    }
+    if query is None:
+        return False
+    query = dict(query, **{'files.url': file_url})
     update = {
         '$set': {
-            'files.$.display_name': new_display_name
+            'files.$.display_name': new_display_name,
+            'updated_at': datetime.utcnow()
         }
     }
-    result = memories_collection.update_one(query, update)
-    return result.modified_count > 0
+    before = memories_collection.find_one_and_update(query, update, projection={'_id': 1})
+    if before is None:
+        return False
+    _notify_change(query['user_email'], 'memory', 'update', before['_id'])
+    return True
 
-def remove_file_from_memory(title, date, text, user_email, file_url):
+def update_file_display_name(title, date, text, user_email, file_url, new_display_name):
+    query = _memory_query_by_keys(title, date, text, user_email)
+    return _update_file_display_name(query, file_url, new_display_name)
+
+def update_file_display_name_by_id(memory_id, user_email, file_url, new_display_name):
+    query = _memory_query_by_id(memory_id, user_email)
+    return _update_file_display_name(query, file_url, new_display_name)
+
+def _remove_file_from_memory(query, file_url):
     """Rimuove un file specifico da un ricordo e lo elimina da Cloudinary"""
-    # Prima recupera il file per verificare che esista
-    memory = memories_collection.find_one({
-        'title': title,
-        'date': datetime.strptime(date, '%Y-%m-%d'),
-        'text': text,
-        'user_email': user_email
-    })
-    
-    if not memory:
-        return False
-    
-    # Trova il file con l'URL specificato
-    file_found = None
-    for file_data in memory.get('files', []):
-        if file_data.get('url') == file_url:
-            file_found = file_data
-            break
-    
-    if not file_found:
+    if query is None:
         return False
-    
-    # Rimuove dal database
-    query = {
-        'title': title,
-        'date': datetime.strptime(date, '%Y-%m-%d'),
-        'text': text,
-        'user_email': user_email
-    }
     update = {
         '$pull': {
             'files': {'url': file_url}
-        }
+        },
+        '$set': {'updated_at': datetime.utcnow()}
     }
-    result = memories_collection.update_one(query, update)
-    
-    # Se rimosso dal database con successo, elimina da Cloudinary
-    if result.modified_count > 0:
-        try:
-            delete_success = delete_file_from_cloudinary(file_url)
-            if not delete_success:
-                print(f"Avviso: File rimosso dal database ma non da Cloudinary: {file_url}")
-        except Exception as e:
-            print(f"Errore nell'eliminazione da Cloudinary: {e}")
-        
-        return True
-    
-    return False
 
-def add_file_to_memory(title, date, text, user_email, file_data):
+    def write(session):
+        # Rimuove il file e restituisce, dallo stato precedente, solo il file rimosso
+        before = memories_collection.find_one_and_update(
+            dict(query, **{'files.url': file_url}), update,
+            projection={'files': {'$elemMatch': {'url': file_url}}},
+            return_document=ReturnDocument.BEFORE, session=session)
+        if before is not None:
+            # Accoda l'eliminazione da Cloudinary
+            enqueue_file_deletions(before.get('files', []), session=session)
+        return before
+
+    before = _write(write)
+    if before is None:
+        return False
+    _notify_change(query['user_email'], 'memory', 'update', before['_id'])
+    return True
+
+def remove_file_from_memory(title, date, text, user_email, file_url):
+    return _remove_file_from_memory(_memory_query_by_keys(title, date, text, user_email), file_url)
+
+def remove_file_from_memory_by_id(memory_id, user_email, file_url):
+    return _remove_file_from_memory(_memory_query_by_id(memory_id, user_email), file_url)
+
+def _add_file_to_memory(query, file_data):
     """Aggiunge un file a un ricordo esistente"""
-    query = {
-        'title': title,
-        'date': datetime.strptime(date, '%Y-%m-%d'),
-        'text': text,
-        'user_email': user_email
-    }
-    file_obj = {
-        'url': file_data['url'],
-        'display_name': file_data.get('display_name', file_data.get('original_name', 'File senza nome')),
-        'original_name': file_data.get('original_name', ''),
-        'size': file_data.get('size', 0),
-        'type': file_data.get('type', ''),
-        'uploaded_at': datetime.utcnow()
-    }
+    return _add_files_to_memory(query, [file_data])
+
+def _add_files_to_memory(query, files):
+    if query is None or not files:
+        return False
+    recorded = _recorded_uploads(query['user_email'], files)
     update = {
         '$push': {
-            'files': file_obj
-        }
+            'files': {'$each': [_file_entry(file_data, recorded=recorded.get(file_data['url'])) for file_data in files]}
+        },
+        '$set': {'updated_at': datetime.utcnow()}
     }
-    result = memories_collection.update_one(query, update)
-    return result.modified_count > 0
\ No newline at end of file
+    before = memories_collection.find_one_and_update(query, update, projection={'_id': 1})
+    if before is None:
+        return False
+    _notify_change(query['user_email'], 'memory', 'update', before['_id'])
+    return True
+
+def add_file_to_memory(title, date, text, user_email, file_data):
+    return _add_file_to_memory(_memory_query_by_keys(title, date, text, user_email), file_data)
+
+def add_file_to_memory_by_id(memory_id, user_email, file_data):
+    return _add_file_to_memory(_memory_query_by_id(memory_id, user_email), file_data)
+
+def add_files_to_memory_by_id(memory_id, user_email, files):
+    return _add_files_to_memory(_memory_query_by_id(memory_id, user_email), files)
@@ -0,0 +1,222 @@
+"""Coda persistente per l'eliminazione asincrona dei file da Cloudinary.
+
+db_manager.enqueue_file_deletions scrive gli URL nella collezione
+cloudinary_deletions (outbox); i thread di DeletionWorker li prelevano a lotti,
+li eliminano con l'endpoint bulk delete_resources e, in caso di errore,
+ritentano con backoff esponenziale. Per i test basta impostare
+CLOUDINARY_API_URL su uno stub HTTP locale.
+
+Uso standalone (senza l'app Flask):
+    python deletion_queue.py
+"""
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta
+import db_manager
+import observability
+from cloudinary_config import deletion_candidates, delete_resources_bulk, BULK_DELETE_LIMIT
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = int(os.environ.get('DELETION_BATCH_SIZE', 50))
+WORKER_THREADS = int(os.environ.get('DELETION_WORKER_THREADS', 2))
+POLL_INTERVAL = float(os.environ.get('DELETION_POLL_INTERVAL', 2.0))
+MAX_ATTEMPTS = 8
+BACKOFF_BASE = 5      # secondi, raddoppia ad ogni tentativo
+BACKOFF_MAX = 3600
+# Un elemento in 'processing' oltre questo tempo (worker caduto) torna prelevabile
+LEASE_SECONDS = 300
+
+# Contatori del processo corrente, esposti da queue_stats()
+_counters = defaultdict(int)
+_counters_lock = threading.Lock()
+
+
+def _count(name, amount=1):
+    with _counters_lock:
+        _counters[name] += amount
+
+
+def _backoff(attempts):
+    return min(BACKOFF_BASE * (2 ** (attempts - 1)), BACKOFF_MAX)
+
+
+def claim_batch(limit=BATCH_SIZE):
+    """Preleva in modo atomico fino a limit elementi pronti, impostando un lease.
+
+    Gli elementi vengono marcati con un token di lease in una sola
+    update_many e poi riletti con il token: tre comandi per lotto invece di
+    uno per elemento. Il filtro ripetuto nella update_many esclude gli
+    elementi presi nel frattempo da un altro worker.
+    """
+    now = datetime.utcnow()
+    ready = {'status': {'$in': ['pending', 'processing']}, 'next_attempt_at': {'$lte': now}}
+    ids = [item['_id'] for item in db_manager.deletions_collection.find(ready, {'_id': 1})
+           .sort([('next_attempt_at', 1)]).limit(limit)]
+    if not ids:
+        return []
+    lease = uuid.uuid4().hex
+    db_manager.deletions_collection.update_many(
+        {'_id': {'$in': ids}, **ready},
+        {
+            '$set': {'status': 'processing', 'next_attempt_at': now + timedelta(seconds=LEASE_SECONDS), 'lease': lease},
+            '$inc': {'attempts': 1}
+        }
+    )
+    return list(db_manager.deletions_collection.find({'lease': lease}))
+
+
+def _retry_or_fail(item, error):
+    if item['attempts'] >= MAX_ATTEMPTS:
+        db_manager.deletions_collection.update_one(
+            {'_id': item['_id']},
+            {'$set': {'status': 'failed', 'last_error': error}}
+        )
+        _count('failed')
+        logger.error("Eliminazione da Cloudinary fallita definitivamente: %s (%s)", item['url'], error)
+    else:
+        next_attempt = datetime.utcnow() + timedelta(seconds=_backoff(item['attempts']))
+        db_manager.deletions_collection.update_one(
+            {'_id': item['_id']},
+            {'$set': {'status': 'pending', 'next_attempt_at': next_attempt, 'last_error': error}}
+        )
+        _count('retried')
+
+
+def _candidates(item):
+    return deletion_candidates(item['url'], item.get('resource_type'), item.get('public_id'))
+
+
+def process_batch(batch):
+    """Elimina da Cloudinary i file del lotto, raggruppando le chiamate per resource_type"""
+    by_type = defaultdict(list)
+    owners = defaultdict(list)
+    results = {}
+    errors = {}
+    for item in batch:
+        candidates = _candidates(item)
+        if not candidates:
+            errors[item['_id']] = "impossibile estrarre public_id dall'URL"
+            item['attempts'] = MAX_ATTEMPTS  # errore permanente, inutile ritentare
+            continue
+        for resource_type, public_id in candidates:
+            if public_id not in by_type[resource_type]:
+                by_type[resource_type].append(public_id)
+            owners[resource_type].append((public_id, item['_id']))
+
+    for resource_type, public_ids in by_type.items():
+        for start in range(0, len(public_ids), BULK_DELETE_LIMIT):
+            chunk = public_ids[start:start + BULK_DELETE_LIMIT]
+            _count('api_calls')
+            try:
+                outcome = delete_resources_bulk(resource_type, chunk)
+            except Exception as e:
+                chunk_ids = set(chunk)
+                for public_id, item_id in owners[resource_type]:
+                    if public_id in chunk_ids:
+                        errors[item_id] = f"{resource_type}: {e}"
+                continue
+            for public_id in chunk:
+                results[(resource_type, public_id)] = outcome.get(public_id)
+
+    done = []
+    for item in batch:
+        if item['_id'] in errors:
+            _retry_or_fail(item, errors[item['_id']])
+            continue
+        # Se nessuna variante risulta eliminata il file non esiste già più: va bene lo stesso
+        deleted = any(
+            results.get((resource_type, public_id)) == 'deleted'
+            for resource_type, public_id in _candidates(item)
+        )
+        _count('deleted' if deleted else 'not_found')
+        done.append(item['_id'])
+    if done:
+        db_manager.deletions_collection.delete_many({'_id': {'$in': done}})
+    return len(done)
+
+
+def queue_stats():
+    """Profondità della coda per stato, età del più vecchio in attesa e contatori del processo"""
+    depth = {d['_id']: d['count'] for d in db_manager.deletions_collection.aggregate([
+        {'$group': {'_id': '$status', 'count': {'$sum': 1}}}
+    ])}
+    oldest = db_manager.deletions_collection.find_one({'status': 'pending'}, {'created_at': 1}, sort=[('created_at', 1)])
+    with _counters_lock:
+        counters = dict(_counters)
+    return {
+        'depth': {status: depth.get(status, 0) for status in ('pending', 'processing', 'failed')},
+        'oldest_pending_seconds': (datetime.utcnow() - oldest['created_at']).total_seconds() if oldest else 0,
+        'processed': counters
+    }
+
+
+def render_metrics():
+    """Stato della coda nel formato testuale di Prometheus (aggiunto a /metrics)"""
+    stats = queue_stats()
+    lines = [
+        '# HELP geomemories_deletion_queue_depth Elementi nella coda eliminazioni per stato',
+        '# TYPE geomemories_deletion_queue_depth gauge',
+    ]
+    lines.extend(f'geomemories_deletion_queue_depth{{status="{status}"}} {count}' for status, count in stats['depth'].items())
+    lines += [
+        '# HELP geomemories_deletion_oldest_pending_seconds Età del più vecchio elemento in attesa',
+        '# TYPE geomemories_deletion_oldest_pending_seconds gauge',
+        f"geomemories_deletion_oldest_pending_seconds {stats['oldest_pending_seconds']:.3f}",
+        '# HELP geomemories_deletions_processed_total Elementi elaborati dal processo per esito',
+        '# TYPE geomemories_deletions_processed_total counter',
+    ]
+    lines.extend(f'geomemories_deletions_processed_total{{outcome="{name}"}} {count}' for name, count in sorted(stats['processed'].items()))
+    return '\n'.join(lines) + '\n'
+
+
+class DeletionWorker:
+    """Pool di thread che svuota la coda finché non viene chiamato stop()"""
+
+    def __init__(self, threads=WORKER_THREADS, batch_size=BATCH_SIZE, poll_interval=POLL_INTERVAL):
+        self.threads = threads
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self):
+        for i in range(self.threads):
+            thread = threading.Thread(target=self._run, name=f'cloudinary-deletions-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=10):
+        """Ferma i thread dopo il lotto in corso; gli elementi non finiti restano in coda"""
+        self._stop.set()
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(0, deadline - time.monotonic()))
+        self._threads = []
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                batch = claim_batch(self.batch_size)
+                if batch:
+                    process_batch(batch)
+                    continue
+            except Exception as e:
+                logger.exception("Errore nel worker di eliminazione Cloudinary: %s", e)
+            self._stop.wait(self.poll_interval)
+
+
+if __name__ == '__main__':
+    observability.configure_logging()
+    worker = DeletionWorker()
+    worker.start()
+    try:
+        while True:
+            time.sleep(60)
+            print(f"Coda eliminazioni: {queue_stats()}")
+    except KeyboardInterrupt:
+        worker.stop()
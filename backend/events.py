@@ -0,0 +1,220 @@
+"""Eventi di modifica in tempo reale per GET /api/events (Server-Sent Events).
+
+Le funzioni di db_manager che scrivono chiamano publish(user_email, entity,
+op, id) dopo ogni modifica riuscita; gli eventi sono compatti
+({'entity': 'memory'|'location', 'op': 'create'|'update'|'delete'|'bulk',
+'id'}) e vengono consegnati alle connessioni SSE aperte dello stesso utente.
+
+EVENTS_BACKEND sceglie da dove arrivano gli eventi:
+- 'memory': pub/sub nel processo; ogni worker vede solo le proprie
+  scritture, quindi va bene solo con un processo (default di 'python app.py').
+- 'mongo': un thread per processo legge i change stream di MongoDB (serve un
+  replica set, come Atlas) e consegna le modifiche fatte da qualunque worker.
+  publish() in questo caso non consegna nulla, per non duplicare gli eventi.
+  È il default con gunicorn e più worker (gunicorn.conf.py) e nel processo
+  dedicato agli eventi.
+
+Ogni connessione aperta occupa un thread del server: con gunicorn lo stream
+va servito dal processo dedicato (events_wsgi.py, gunicorn_events.conf.py),
+con molti thread, e il reverse proxy vi inoltra /api/events. Nei worker
+dell'API EVENTS_MAX_CONNECTIONS (default un quarto dei thread) limita i
+thread che gli stream possono occupare.
+
+EventSource non può inviare header: il client chiede prima un token breve
+(POST /api/events/token, EVENTS_TOKEN_SECONDS, default 60) con il claim
+TOKEN_CLAIM e lo passa come ?jwt=. Solo /api/events lo accetta, e lì non si
+accettano i token normali: nei log di accesso finiscono solo token scaduti
+dopo un minuto e inutili per il resto delle API.
+
+Ogni connessione ha una coda limitata (EVENTS_QUEUE_SIZE): se il client è
+troppo lento e la coda si riempie, gli eventi vengono scartati e il client
+riceve un solo evento 'resync' che gli chiede di ricaricare le liste.
+"""
+import logging
+import os
+import queue
+import threading
+from collections import defaultdict
+from pymongo.errors import PyMongoError
+
+logger = logging.getLogger(__name__)
+
+EVENTS_BACKEND = os.environ.get('EVENTS_BACKEND', 'memory')
+QUEUE_SIZE = int(os.environ.get('EVENTS_QUEUE_SIZE', 100))
+HEARTBEAT_SECONDS = float(os.environ.get('EVENTS_HEARTBEAT', 20))
+# Durata massima di una connessione: poi il browser si ricollega da solo
+MAX_STREAM_SECONDS = float(os.environ.get('EVENTS_MAX_STREAM_SECONDS', 600))
+# Connessioni SSE per processo: ognuna occupa un thread del server finché resta
+# aperta, quindi di default al massimo un quarto dei thread di gunicorn
+MAX_CONNECTIONS = int(os.environ.get('EVENTS_MAX_CONNECTIONS',
+                                     max(1, int(os.environ.get('GUNICORN_THREADS', 4)) // 4)))
+# Attesa suggerita (secondi, header Retry-After) quando le connessioni sono esaurite
+BUSY_RETRY_SECONDS = 60
+# Attesa del browser prima di ricollegarsi (campo retry: dell'SSE, millisecondi)
+RETRY_MS = 3000
+
+# Token per aprire lo stream (vedi sopra)
+TOKEN_SECONDS = int(os.environ.get('EVENTS_TOKEN_SECONDS', 60))
+TOKEN_CLAIM = 'events'
+
+RESYNC = {'op': 'resync'}
+
+
+def _event(entity, op, doc_id=None):
+    return {'entity': entity, 'op': op, 'id': str(doc_id) if doc_id is not None else None}
+
+
+class Subscription:
+    """Coda limitata degli eventi di una connessione SSE"""
+
+    def __init__(self, user_email, maxsize=QUEUE_SIZE):
+        self.user_email = user_email
+        self._queue = queue.Queue(maxsize)
+        self.overflowed = False
+
+    def put(self, event):
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            # Client lento: invece di accumulare eventi gli si chiede di risincronizzarsi
+            self.overflowed = True
+
+    def get(self, timeout):
+        """Prossimo evento, RESYNC dopo un overflow, None se non arriva nulla entro timeout"""
+        if self.overflowed:
+            self.overflowed = False
+            with self._queue.mutex:
+                self._queue.queue.clear()
+                self._queue.not_full.notify_all()
+            return RESYNC
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class EventBus:
+    """Pub/sub nel processo: user_email -> connessioni SSE aperte"""
+
+    def __init__(self, max_connections=MAX_CONNECTIONS):
+        self.max_connections = max_connections
+        self._subscribers = defaultdict(set)
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def subscribe(self, user_email):
+        """Nuova Subscription, o None se il processo ha già troppe connessioni"""
+        with self._lock:
+            if self._count >= self.max_connections:
+                return None
+            subscription = Subscription(user_email)
+            self._subscribers[user_email].add(subscription)
+            self._count += 1
+            return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.user_email)
+            if subscribers and subscription in subscribers:
+                subscribers.remove(subscription)
+                self._count -= 1
+                if not subscribers:
+                    del self._subscribers[subscription.user_email]
+
+    def deliver(self, user_email, event):
+        with self._lock:
+            subscribers = list(self._subscribers.get(user_email, ()))
+        for subscription in subscribers:
+            subscription.put(event)
+
+    def stats(self):
+        with self._lock:
+            return {'backend': EVENTS_BACKEND, 'connections': self._count, 'users': len(self._subscribers)}
+
+
+bus = EventBus()
+
+
+def publish(user_email, entity, op, doc_id=None):
+    """Notifica una modifica alle connessioni SSE dell'utente (backend 'memory')"""
+    if EVENTS_BACKEND != 'memory':
+        return
+    bus.deliver(user_email, _event(entity, op, doc_id))
+
+
+class ChangeStreamListener:
+    """Thread che inoltra al bus le modifiche lette dai change stream di MongoDB"""
+
+    def __init__(self, database, collections, target=bus, retry_interval=5.0):
+        # collections: nome collezione -> entità ('memory', 'location', 'tombstone')
+        self.database = database
+        self.collections = collections
+        self.target = target
+        self.retry_interval = retry_interval
+        self._resume_token = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='events-change-stream', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _pipeline(self):
+        return [
+            {'$match': {
+                'ns.coll': {'$in': list(self.collections)},
+                'operationType': {'$in': ['insert', 'update', 'replace']}
+            }},
+            {'$project': {
+                'operationType': 1, 'ns': 1, 'documentKey': 1,
+                'fullDocument.user_email': 1, 'fullDocument.kind': 1, 'fullDocument.doc_id': 1
+            }}
+        ]
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                with self.database.watch(self._pipeline(), full_document='updateLookup',
+                                         resume_after=self._resume_token, max_await_time_ms=1000) as stream:
+                    while not self._stop.is_set() and stream.alive:
+                        change = stream.try_next()
+                        self._resume_token = stream.resume_token
+                        if change is not None:
+                            self._handle(change)
+            except PyMongoError as e:
+                logger.warning("Change stream interrotto, nuovo tentativo tra %ss: %s", self.retry_interval, e)
+                self._stop.wait(self.retry_interval)
+
+    def _handle(self, change):
+        document = change.get('fullDocument') or {}
+        user_email = document.get('user_email')
+        if not user_email:
+            # Documento già eliminato al momento della lettura: arriverà la sua tombstone
+            return
+        entity = self.collections.get(change['ns']['coll'])
+        if entity == 'tombstone':
+            event = _event(document['kind'], 'delete', document['doc_id'])
+        else:
+            op = 'create' if change['operationType'] == 'insert' else 'update'
+            event = _event(entity, op, change['documentKey']['_id'])
+        self.target.deliver(user_email, event)
+
+
+def start_backend():
+    """Avvia il listener dei change stream se EVENTS_BACKEND='mongo' (None altrimenti)"""
+    if EVENTS_BACKEND != 'mongo':
+        return None
+    import db_manager
+    listener = ChangeStreamListener(db_manager.db, {
+        db_manager.MEMORIES_COLLECTION: 'memory',
+        db_manager.COLLECTION_NAME: 'location',
+        db_manager.TOMBSTONES_COLLECTION: 'tombstone',
+    })
+    listener.start()
+    return listener
@@ -0,0 +1,13 @@
+"""Entry point WSGI del processo dedicato agli eventi SSE: gunicorn -c gunicorn_events.conf.py events_wsgi:app"""
+import os
+
+# Questo processo serve solo /api/events: niente coda eliminazioni, pool degli
+# hash delle password né indice della build del frontend
+os.environ.setdefault('DELETION_WORKER', '0')
+os.environ.setdefault('PASSWORD_HASH_POOL', '0')
+os.environ.setdefault('STATIC_MANIFEST', '0')
+os.environ.setdefault('EVENTS_BACKEND', 'mongo')
+
+from app import create_app
+
+app = create_app()
@@ -0,0 +1,82 @@
+"""Tile Web Mercator e quadkey per l'indice spaziale delle posizioni.
+
+Ogni posizione salva il quadkey del tile che la contiene a QUADKEY_ZOOM:
+il prefisso di lunghezza z è il tile che la contiene al livello z, quindi
+un tile corrisponde a un intervallo [quadkey, quadkey + '4') sull'indice
+(user_email, quadkey).
+"""
+import math
+
+QUADKEY_ZOOM = 18
+# Latitudine massima rappresentabile in Web Mercator
+MAX_LATITUDE = 85.05112878
+
+
+def tile_xy(latitude, longitude, zoom):
+    """Coordinate (x, y) del tile che contiene il punto al livello zoom"""
+    lat = max(-MAX_LATITUDE, min(MAX_LATITUDE, latitude))
+    n = 1 << zoom
+    x = int((longitude + 180.0) / 360.0 * n)
+    lat_rad = math.radians(lat)
+    y = int((1.0 - math.log(math.tan(lat_rad) + 1.0 / math.cos(lat_rad)) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def tile_to_quadkey(x, y, zoom):
+    digits = []
+    for level in range(zoom, 0, -1):
+        mask = 1 << (level - 1)
+        digit = 0
+        if x & mask:
+            digit += 1
+        if y & mask:
+            digit += 2
+        digits.append(str(digit))
+    return ''.join(digits)
+
+
+def quadkey_to_tile(quadkey):
+    """Inverso di tile_to_quadkey: (x, y, zoom)"""
+    x = y = 0
+    zoom = len(quadkey)
+    for i, digit in enumerate(quadkey):
+        mask = 1 << (zoom - i - 1)
+        if digit in '13':
+            x |= mask
+        if digit in '23':
+            y |= mask
+    return x, y, zoom
+
+
+def quadkey_for(latitude, longitude, zoom=QUADKEY_ZOOM):
+    """Quadkey del punto, o None se le coordinate non sono valide"""
+    try:
+        lat = float(latitude)
+        lon = float(longitude)
+    except (TypeError, ValueError):
+        return None
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        return None
+    x, y = tile_xy(lat, lon, zoom)
+    return tile_to_quadkey(x, y, zoom)
+
+
+def bbox_tile_ranges(min_lon, min_lat, max_lon, max_lat, zoom):
+    """Intervalli (x0, x1, y0, y1) di tile che coprono il bbox; due se attraversa l'antimeridiano"""
+    if min_lon > max_lon:
+        return (bbox_tile_ranges(min_lon, min_lat, 180.0, max_lat, zoom)
+                + bbox_tile_ranges(-180.0, min_lat, max_lon, max_lat, zoom))
+    x0, y0 = tile_xy(max_lat, min_lon, zoom)
+    x1, y1 = tile_xy(min_lat, max_lon, zoom)
+    return [(x0, x1, y0, y1)]
+
+
+def tiles_in_ranges(ranges):
+    return sum((x1 - x0 + 1) * (y1 - y0 + 1) for x0, x1, y0, y1 in ranges)
+
+
+def covering_quadkeys(ranges, zoom):
+    return [tile_to_quadkey(x, y, zoom)
+            for x0, x1, y0, y1 in ranges
+            for x in range(x0, x1 + 1)
+            for y in range(y0, y1 + 1)]
@@ -0,0 +1,47 @@
+"""Configurazione gunicorn per la produzione.
+
+Avvio: gunicorn -c gunicorn.conf.py wsgi:app
+Tutti i valori si possono regolare con variabili d'ambiente.
+"""
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+
+# Worker "gthread": ogni processo serve più richieste in parallelo su thread,
+# adatto a un carico dominato dall'attesa di MongoDB e Cloudinary
+worker_class = 'gthread'
+workers = int(os.environ.get('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+
+# Con più worker gli eventi SSE scritti da un worker devono arrivare anche ai
+# client collegati agli altri: di default si usano i change stream di MongoDB
+os.environ.setdefault('EVENTS_BACKEND', 'mongo' if workers > 1 else 'memory')
+
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 60))
+# Tempo concesso alle richieste in corso per terminare dopo SIGTERM
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+
+# Riciclo periodico dei worker per contenere eventuali leak di memoria
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 2000))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', 200))
+
+# L'app viene caricata in ogni worker dopo il fork: MongoClient e i thread
+# in background (coda eliminazioni) non sopravvivono a un fork
+preload_app = False
+
+accesslog = os.environ.get('GUNICORN_ACCESS_LOG', '-')
+errorlog = '-'
+
+
+def post_fork(server, worker):
+    # Sicurezza in più se preload_app viene attivato: un client per processo
+    import db_manager
+    db_manager.connect()
+
+
+def worker_exit(server, worker):
+    # Dopo il drenaggio delle richieste: ferma la coda eliminazioni e chiude Mongo
+    from app import shutdown_app
+    shutdown_app()
@@ -0,0 +1,33 @@
+"""Configurazione gunicorn del processo dedicato agli eventi SSE (GET /api/events).
+
+Avvio: gunicorn -c gunicorn_events.conf.py events_wsgi:app
+Ogni stream aperto occupa un thread per tutta la sua durata: qui i thread
+sono molti (EVENTS_THREADS) e nessuno serve le altre API, che restano ai
+worker di gunicorn.conf.py. Il reverse proxy inoltra a questo processo solo
+/api/events (vedi installation.md).
+"""
+import os
+
+bind = f"0.0.0.0:{os.environ.get('EVENTS_PORT', 5001)}"
+
+worker_class = 'gthread'
+workers = int(os.environ.get('EVENTS_WORKERS', 1))
+threads = int(os.environ.get('EVENTS_THREADS', 256))
+
+# Qualche thread resta libero per rispondere 503 quando gli stream sono al limite
+os.environ.setdefault('EVENTS_MAX_CONNECTIONS', str(max(1, threads - 8)))
+# Le scritture avvengono negli altri processi: gli eventi arrivano solo dai change stream
+os.environ.setdefault('EVENTS_BACKEND', 'mongo')
+
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 60))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+preload_app = False
+
+accesslog = os.environ.get('GUNICORN_ACCESS_LOG', '-')
+errorlog = '-'
+
+
+def worker_exit(server, worker):
+    from app import shutdown_app
+    shutdown_app()
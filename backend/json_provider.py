@@ -0,0 +1,65 @@
+"""Serializzazione JSON delle risposte dell'API.
+
+FastJSONProvider sostituisce il provider di Flask: usa orjson se installato
+(JSON_ENCODER='orjson', default) oppure il modulo json della libreria
+standard (JSON_ENCODER='std'). In entrambi i casi ObjectId diventa una
+stringa, datetime una data ISO 8601 e date 'YYYY-MM-DD'.
+
+stream_json_array genera un array JSON elemento per elemento, per le
+risposte troppo grandi da costruire in memoria.
+"""
+import os
+from datetime import date, datetime
+from bson import ObjectId
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+JSON_ENCODER = os.environ.get('JSON_ENCODER', 'orjson')
+# Dimensione indicativa dei pezzi inviati da stream_json_array
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def _default(value):
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f"Oggetto di tipo {type(value).__name__} non serializzabile in JSON")
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    default = staticmethod(_default)
+    ensure_ascii = False
+    sort_keys = False
+
+    def __init__(self, app):
+        super().__init__(app)
+        self.use_orjson = orjson is not None and JSON_ENCODER == 'orjson'
+
+    def dumps(self, obj, **kwargs):
+        # Con argomenti extra (indentazione in debug) si usa il json standard
+        if self.use_orjson and not kwargs:
+            return orjson.dumps(obj, default=_default, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+        return super().dumps(obj, **kwargs)
+
+
+def stream_json_array(items, dumps, chunk_size=STREAM_CHUNK_SIZE):
+    """Genera un array JSON a pezzi di circa chunk_size caratteri da un iterabile di elementi"""
+    buffer = ['[']
+    size = 1
+    separator = ''
+    for item in items:
+        encoded = dumps(item)
+        buffer.append(separator + encoded)
+        separator = ','
+        size += len(encoded) + 1
+        if size >= chunk_size:
+            yield ''.join(buffer)
+            buffer = []
+            size = 0
+    buffer.append(']')
+    yield ''.join(buffer)
@@ -0,0 +1,74 @@
+"""Comandi di manutenzione del database.
+
+Uso:
+    python manage_db.py indexes              # crea e verifica gli indici
+    python manage_db.py migrate              # migrazioni dello schema (GeoJSON, riferimenti, varianti dei file)
+    python manage_db.py media                # varianti locali delle immagini fuori da Cloudinary
+    python manage_db.py explain EMAIL        # piani di esecuzione delle query principali
+"""
+import argparse
+import sys
+import db_manager
+import media
+
+
+def cmd_indexes(args):
+    duplicates = db_manager.find_duplicate_emails()
+    if duplicates:
+        print("Errore: email duplicate, l'indice unico su users.email non può essere creato:")
+        for email, count in duplicates:
+            print(f"  {email}: {count} utenti")
+        return 1
+    db_manager.ensure_indexes()
+    problems = db_manager.verify_indexes()
+    for collection, name, problem in problems:
+        print(f"Indice {collection}.{name}: {problem}")
+    if problems:
+        return 1
+    print("Indici creati e verificati")
+    return 0
+
+
+def cmd_migrate(args):
+    print(f"Posizioni migrate a GeoJSON: {db_manager.migrate_locations_to_geojson()}")
+    print(f"Ricordi con posizioni convertite in riferimenti: {db_manager.migrate_memory_location_refs()}")
+    print(f"Ricordi con varianti dei file aggiunte: {db_manager.migrate_file_derivatives()}")
+    return 0
+
+
+def cmd_media(args):
+    if not media.MEDIA_LOCAL_HOSTS:
+        print("MEDIA_LOCAL_HOSTS non impostato: nessun host da cui scaricare le immagini")
+        return 1
+    if media.Image is None:
+        print("Pillow non installato (pip install pillow)")
+        return 1
+    print(f"Ricordi con varianti locali generate: {db_manager.generate_local_file_derivatives()}")
+    return 0
+
+
+def cmd_explain(args):
+    status = 0
+    for description, stages in db_manager.explain_hot_queries(args.email):
+        scan = 'COLLSCAN' in stages
+        if scan:
+            status = 1
+        print(f"{'!!' if scan else 'ok'} {description}: {' <- '.join(stages)}")
+    return status
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Manutenzione del database GeoMemories')
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('indexes', help='crea e verifica gli indici').set_defaults(func=cmd_indexes)
+    sub.add_parser('migrate', help='migra le posizioni a GeoJSON, i ricordi ai riferimenti e aggiunge le varianti dei file').set_defaults(func=cmd_migrate)
+    sub.add_parser('media', help='genera le varianti delle immagini su MEDIA_LOCAL_HOSTS').set_defaults(func=cmd_media)
+    explain = sub.add_parser('explain', help='mostra i piani delle query principali')
+    explain.add_argument('email', help='utente su cui eseguire le query')
+    explain.set_defaults(func=cmd_explain)
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,164 @@
+"""Varianti ridotte (derivati) delle immagini e dei video allegati ai ricordi.
+
+Quando un file viene allegato si calcolano e si salvano nel ricordo gli URL
+delle sue varianti (files[].derivatives):
+- thumbnail: 320x320 ritagliata, per liste e anteprime;
+- preview: al massimo 1600 px di lato, per il visualizzatore;
+- poster: fotogramma iniziale dei video in JPEG.
+Sono calcolate solo per i file su Cloudinary, come URL di trasformazione:
+nessuna chiamata di rete, Cloudinary genera ogni variante alla prima
+richiesta e la tiene in cache. MEDIA_DERIVATIVES=off non calcola nulla.
+
+Le immagini su altri host restano senza varianti finché non le genera
+`python manage_db.py media` (local_derivatives): le scarica con Pillow, se
+installato, solo dagli host elencati in MEDIA_LOCAL_HOSTS e le salva in
+MEDIA_DIR, servite da /media/<nome>. Mai durante una richiesta.
+"""
+import hashlib
+import io
+import logging
+import os
+import requests
+from urllib.parse import urlparse
+from cloudinary_config import resolve_resource, HTTP_TIMEOUT
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+MEDIA_DERIVATIVES = os.environ.get('MEDIA_DERIVATIVES', 'cloudinary')
+MEDIA_DIR = os.environ.get('MEDIA_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'media'))
+MEDIA_URL_PATH = '/media'
+# Host da cui la generazione locale può scaricare immagini (separati da virgola; vuoto = nessuno)
+MEDIA_LOCAL_HOSTS = {h.strip().lower() for h in os.environ.get('MEDIA_LOCAL_HOSTS', '').split(',') if h.strip()}
+# Dimensione massima (byte) di un'immagine scaricata per la generazione locale
+MAX_SOURCE_BYTES = 25 * 1024 * 1024
+LOCAL_JPEG_QUALITY = 80
+
+# Trasformazioni Cloudinary per tipo di risorsa: variante -> (trasformazione, estensione o None)
+CLOUDINARY_TRANSFORMS = {
+    'image': {
+        'thumbnail': ('c_fill,g_auto,w_320,h_320,f_auto,q_auto', None),
+        'preview': ('c_limit,w_1600,h_1600,f_auto,q_auto', None),
+    },
+    'video': {
+        'thumbnail': ('so_0,c_fill,g_auto,w_320,h_320,q_auto', 'jpg'),
+        'preview': ('c_limit,w_1280,h_1280,q_auto', 'mp4'),
+        'poster': ('so_0,c_limit,w_1280,h_1280,q_auto', 'jpg'),
+    },
+}
+# Varianti locali: variante -> (larghezza, altezza, ritaglio)
+LOCAL_SIZES = {
+    'thumbnail': (320, 320, True),
+    'preview': (1600, 1600, False),
+}
+# Variante inclusa nelle liste di ricordi se non se ne chiede un'altra
+DEFAULT_LIST_VARIANT = 'thumbnail'
+VARIANTS = ('thumbnail', 'preview', 'poster')
+
+
+def _is_image(entry):
+    return entry.get('resource_type') == 'image' or (entry.get('type') or '').startswith('image/')
+
+
+def cloudinary_derivatives(entry):
+    """URL di trasformazione per un file su Cloudinary ({} se non è un'immagine o un video)"""
+    url = entry.get('url') or ''
+    resource_type, _ = resolve_resource(url, entry.get('resource_type'), entry.get('public_id'))
+    if resource_type not in CLOUDINARY_TRANSFORMS or '/upload/' not in urlparse(url).path:
+        return {}
+    head, tail = url.split('/upload/', 1)
+    derivatives = {}
+    for variant, (transformation, extension) in CLOUDINARY_TRANSFORMS[resource_type].items():
+        path = tail
+        if extension:
+            path = f"{tail.rsplit('.', 1)[0]}.{extension}"
+        derivatives[variant] = f"{head}/upload/{transformation}/{path}"
+    return derivatives
+
+
+# Sessione separata da quella delle API Cloudinary (e dalle sue metriche)
+_download_session = requests.Session()
+
+
+def local_host_allowed(url):
+    """True se l'URL è http(s) su uno degli host di MEDIA_LOCAL_HOSTS"""
+    parsed = urlparse(url or '')
+    return parsed.scheme in ('http', 'https') and (parsed.hostname or '') in MEDIA_LOCAL_HOSTS
+
+
+def _download(url):
+    # Niente redirect: porterebbero fuori dagli host ammessi
+    response = _download_session.get(url, timeout=HTTP_TIMEOUT, stream=True, allow_redirects=False)
+    response.raise_for_status()
+    if response.is_redirect:
+        raise ValueError("redirect non seguito")
+    data = io.BytesIO()
+    for chunk in response.iter_content(64 * 1024):
+        data.write(chunk)
+        if data.tell() > MAX_SOURCE_BYTES:
+            raise ValueError(f"immagine oltre {MAX_SOURCE_BYTES} byte")
+    data.seek(0)
+    return data
+
+
+def local_derivatives(entry):
+    """Genera thumbnail e preview con Pillow in MEDIA_DIR ({} se non è possibile).
+
+    Scarica l'immagine: da usare solo nei job di manutenzione, mai in una richiesta.
+    """
+    if Image is None or not _is_image(entry) or not local_host_allowed(entry.get('url')):
+        return {}
+    # Nome stabile per URL: rigenerare lo stesso file non crea duplicati
+    key = hashlib.sha1(entry['url'].encode('utf-8')).hexdigest()[:20]
+    try:
+        with Image.open(_download(entry['url'])) as source:
+            image = ImageOps.exif_transpose(source).convert('RGB')
+        os.makedirs(MEDIA_DIR, exist_ok=True)
+        derivatives = {}
+        for variant, (width, height, crop) in LOCAL_SIZES.items():
+            if crop:
+                resized = ImageOps.fit(image, (width, height))
+            else:
+                resized = image.copy()
+                resized.thumbnail((width, height))
+            name = f"{key}_{variant}.jpg"
+            temporary = os.path.join(MEDIA_DIR, f".{name}.tmp")
+            resized.save(temporary, 'JPEG', quality=LOCAL_JPEG_QUALITY, optimize=True, progressive=True)
+            os.replace(temporary, os.path.join(MEDIA_DIR, name))
+            derivatives[variant] = f"{MEDIA_URL_PATH}/{name}"
+        return derivatives
+    except Exception as e:
+        logger.warning("Varianti locali non generate per %s: %s", entry['url'], e)
+        return {}
+
+
+def derivatives(entry):
+    """Varianti di un file allegato secondo MEDIA_DERIVATIVES ({} se non è su Cloudinary)"""
+    if MEDIA_DERIVATIVES == 'off':
+        return {}
+    return cloudinary_derivatives(entry)
+
+
+def check_list_variant(variant):
+    """Valida la variante chiesta per le liste (una di VARIANTS o 'full'); ValueError se sconosciuta"""
+    if variant != 'full' and variant not in VARIANTS:
+        raise ValueError(f"media non valido: {variant} (valori: {', '.join(VARIANTS)}, full)")
+    return variant
+
+
+def variant_expression(files, variant=DEFAULT_LIST_VARIANT):
+    """Espressione di aggregazione che riduce i derivati dei file alla sola variante richiesta.
+
+    Ogni file perde la mappa 'derivatives' e riceve il campo <variant> (se
+    disponibile); files è il percorso dell'array, ad esempio '$files'.
+    """
+    return {'$map': {'input': {'$ifNull': [files, []]}, 'as': 'file', 'in': {'$arrayToObject': {'$concatArrays': [
+        {'$filter': {'input': {'$objectToArray': '$$file'}, 'as': 'field',
+                     'cond': {'$ne': ['$$field.k', 'derivatives']}}},
+        {'$filter': {'input': {'$objectToArray': {'$ifNull': ['$$file.derivatives', {}]}}, 'as': 'field',
+                     'cond': {'$eq': ['$$field.k', variant]}}},
+    ]}}}}
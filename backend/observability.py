@@ -0,0 +1,289 @@
+"""Osservabilità: log strutturati, tempi delle richieste e metriche Prometheus.
+
+- Ogni richiesta Flask riceve un request ID (header X-Request-ID se presente,
+  altrimenti generato) che compare in tutti i log emessi durante la richiesta
+  e nella risposta.
+- I comandi MongoDB (pymongo command monitoring) e le chiamate HTTP a
+  Cloudinary (InstrumentedAdapter) vengono cronometrati: i totali per
+  richiesta finiscono nel log della richiesta e nell'header Server-Timing,
+  le durate negli istogrammi esposti da render_metrics() (endpoint /metrics).
+
+LOG_LEVEL (default INFO) e LOG_FORMAT ('json', default, oppure 'text').
+Le metriche sono del singolo processo: con più worker gunicorn ogni scrape
+vede il worker che risponde. /metrics risponde solo con l'header
+'Authorization: Bearer <METRICS_TOKEN>' o agli indirizzi in METRICS_ALLOW
+(IP o reti separati da virgole); senza nessuno dei due è disattivato.
+"""
+import bisect
+import contextvars
+import hmac
+import ipaddress
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import uuid
+from pymongo import monitoring
+from requests.adapters import HTTPAdapter
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json')
+# Comandi Mongo e chiamate HTTP più lenti di così vengono segnalati nei log
+SLOW_CALL_MS = float(os.environ.get('SLOW_CALL_MS', 500))
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+METRICS_ALLOW = tuple(
+    ipaddress.ip_network(network.strip(), strict=False)
+    for network in os.environ.get('METRICS_ALLOW', '').split(',') if network.strip()
+)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+logger = logging.getLogger('geomemories')
+
+_request_id = contextvars.ContextVar('request_id', default=None)
+# Totali (ms e numero di chiamate) di Mongo e Cloudinary per la richiesta corrente
+_spans = contextvars.ContextVar('spans', default=None)
+
+
+class Histogram:
+    """Istogramma Prometheus con etichette, thread-safe"""
+
+    def __init__(self, name, documentation, labels, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(label, '')) for label in self.labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = [(key, list(counts), total) for key, (counts, total) in self._series.items()]
+        for key, counts, total in sorted(series):
+            labels = ','.join(f'{name}="{_escape(value)}"' for name, value in zip(self.labels, key))
+            prefix = labels + ',' if labels else ''
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{self.name}_bucket{{{prefix}le="{le}"}} {cumulative}')
+            lines.append(f"{self.name}_sum{{{labels}}} {total}")
+            lines.append(f"{self.name}_count{{{labels}}} {cumulative}")
+        return lines
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+REQUEST_DURATION = Histogram(
+    'geomemories_http_request_duration_seconds', 'Durata delle richieste servite da Flask',
+    ('method', 'route', 'status'))
+MONGO_DURATION = Histogram(
+    'geomemories_mongo_command_duration_seconds', 'Durata dei comandi MongoDB',
+    ('command', 'collection', 'outcome'))
+CLOUDINARY_DURATION = Histogram(
+    'geomemories_cloudinary_request_duration_seconds', 'Durata delle chiamate HTTP a Cloudinary',
+    ('method', 'operation', 'status'))
+REGISTRY = (REQUEST_DURATION, MONGO_DURATION, CLOUDINARY_DURATION)
+
+
+def metrics_allowed(request):
+    """True se la richiesta può leggere /metrics (token o indirizzo ammesso)"""
+    if METRICS_TOKEN:
+        scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+        if scheme.lower() == 'bearer' and hmac.compare_digest(token.encode('utf-8'), METRICS_TOKEN.encode('utf-8')):
+            return True
+    if METRICS_ALLOW and request.remote_addr:
+        try:
+            address = ipaddress.ip_address(request.remote_addr)
+        except ValueError:
+            return False
+        return any(address in network for network in METRICS_ALLOW)
+    return False
+
+
+def render_metrics():
+    """Tutte le metriche nel formato testuale di Prometheus"""
+    lines = []
+    for histogram in REGISTRY:
+        lines.extend(histogram.render())
+    return '\n'.join(lines) + '\n'
+
+
+def _record_span(kind, seconds):
+    spans = _spans.get()
+    if spans is not None:
+        spans[f'{kind}_ms'] = spans.get(f'{kind}_ms', 0.0) + seconds * 1000
+        spans[f'{kind}_calls'] = spans.get(f'{kind}_calls', 0) + 1
+
+
+#------------------------------------------------------------------
+# MongoDB
+class MongoCommandListener(monitoring.CommandListener):
+    """Cronometra ogni comando inviato a MongoDB (registrato in db_manager.connect)"""
+
+    def __init__(self):
+        self._collections = {}
+        self._lock = threading.Lock()
+
+    def started(self, event):
+        if event.command_name == 'getMore':
+            collection = event.command.get('collection')
+        else:
+            collection = event.command.get(event.command_name)
+        with self._lock:
+            self._collections[(event.connection_id, event.request_id)] = collection if isinstance(collection, str) else ''
+
+    def succeeded(self, event):
+        self._record(event, 'ok')
+
+    def failed(self, event):
+        self._record(event, 'error')
+
+    def _record(self, event, outcome):
+        with self._lock:
+            collection = self._collections.pop((event.connection_id, event.request_id), '')
+        seconds = event.duration_micros / 1e6
+        MONGO_DURATION.observe(seconds, command=event.command_name, collection=collection, outcome=outcome)
+        _record_span('db', seconds)
+        if seconds * 1000 >= SLOW_CALL_MS:
+            logger.warning("Comando MongoDB lento", extra={'fields': {
+                'command': event.command_name, 'collection': collection,
+                'outcome': outcome, 'duration_ms': round(seconds * 1000, 1)
+            }})
+
+
+mongo_listener = MongoCommandListener()
+
+
+#------------------------------------------------------------------
+# Cloudinary
+def _operation(path_url):
+    """Operazione Cloudinary dal path, senza cloud name e query (es. 'image/destroy')"""
+    parts = path_url.split('?', 1)[0].strip('/').split('/')
+    return '/'.join(parts[2:]) or '/'
+
+
+class InstrumentedAdapter(HTTPAdapter):
+    """HTTPAdapter che cronometra ogni chiamata, comprese quelle fallite"""
+
+    def send(self, request, **kwargs):
+        started = time.perf_counter()
+        status = 'error'
+        try:
+            response = super().send(request, **kwargs)
+            status = str(response.status_code)
+            return response
+        finally:
+            seconds = time.perf_counter() - started
+            operation = _operation(request.path_url)
+            CLOUDINARY_DURATION.observe(seconds, method=request.method, operation=operation, status=status)
+            _record_span('cloudinary', seconds)
+            fields = {'method': request.method, 'operation': operation, 'status': status,
+                      'duration_ms': round(seconds * 1000, 1)}
+            if seconds * 1000 >= SLOW_CALL_MS:
+                logger.warning("Chiamata Cloudinary lenta", extra={'fields': fields})
+            else:
+                logger.debug("Chiamata Cloudinary", extra={'fields': fields})
+
+
+#------------------------------------------------------------------
+# Log
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'request_id': _request_id.get()
+        }
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s [%(request_id)s] %(name)s: %(message)s')
+
+    def format(self, record):
+        record.request_id = _request_id.get() or '-'
+        message = super().format(record)
+        fields = getattr(record, 'fields', None)
+        if fields:
+            message += ' ' + ' '.join(f"{key}={value}" for key, value in fields.items())
+        return message
+
+
+def configure_logging():
+    """Configura il logger radice (una sola volta per processo)"""
+    root = logging.getLogger()
+    if any(getattr(handler, '_geomemories', False) for handler in root.handlers):
+        return
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(JsonFormatter() if LOG_FORMAT == 'json' else TextFormatter())
+    handler._geomemories = True
+    root.addHandler(handler)
+    root.setLevel(LOG_LEVEL)
+
+
+#------------------------------------------------------------------
+# Flask
+def init_app(app):
+    """Registra request ID, tempi per route e log di ogni richiesta"""
+    from flask import g, request
+
+    @app.before_request
+    def _start_request():
+        _request_id.set(request.headers.get('X-Request-ID', '')[:64] or uuid.uuid4().hex)
+        _spans.set({})
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def _finish_request(response):
+        started = g.pop('request_started', None)
+        if started is None:
+            return response
+        seconds = time.perf_counter() - started
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        REQUEST_DURATION.observe(seconds, method=request.method, route=route, status=str(response.status_code))
+        spans = _spans.get() or {}
+        db_ms = spans.get('db_ms', 0.0)
+        cloudinary_ms = spans.get('cloudinary_ms', 0.0)
+        response.headers['X-Request-ID'] = _request_id.get()
+        # Per le risposte in streaming il tempo misurato arriva fino all'invio degli header
+        response.headers['Server-Timing'] = (
+            f"db;dur={db_ms:.1f}, cloudinary;dur={cloudinary_ms:.1f}, total;dur={seconds * 1000:.1f}"
+        )
+        logger.info("Richiesta", extra={'fields': {
+            'method': request.method,
+            'route': route,
+            'path': request.path,
+            'status': response.status_code,
+            'duration_ms': round(seconds * 1000, 1),
+            'db_ms': round(db_ms, 1),
+            'db_calls': spans.get('db_calls', 0),
+            'cloudinary_ms': round(cloudinary_ms, 1),
+            'cloudinary_calls': spans.get('cloudinary_calls', 0)
+        }})
+        return response
+
+    @app.teardown_request
+    def _clear_request(exc):
+        _request_id.set(None)
+        _spans.set(None)
@@ -0,0 +1,120 @@
+"""Hash delle password fuori dai thread che servono le richieste.
+
+generate_password_hash/check_password_hash di werkzeug sono volutamente
+lenti (scrypt): eseguiti nel thread della richiesta, una raffica di login
+occupa la CPU e il GIL del worker e rallenta tutte le altre route. Qui
+girano in un piccolo pool di processi (PASSWORD_HASH_WORKERS, default 2 per
+worker) con un limite di richieste in attesa (PASSWORD_HASH_QUEUE, default
+4 per processo del pool): oltre il limite si solleva HashingBusy, che l'API
+trasforma in 503 invece di accodare lavoro che arriverebbe comunque tardi.
+
+PASSWORD_HASH_METHOD (default 'scrypt:32768:8:1', quello di werkzeug) è il
+metodo dei nuovi hash; needs_rehash() dice se un hash salvato usa parametri
+diversi, così verify_user lo aggiorna al primo login riuscito.
+PASSWORD_HASH_POOL=0 calcola gli hash nel thread corrente.
+"""
+import functools
+import logging
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from werkzeug.security import generate_password_hash, check_password_hash, DEFAULT_PBKDF2_ITERATIONS
+
+logger = logging.getLogger(__name__)
+
+HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+HASH_POOL_ENABLED = os.environ.get('PASSWORD_HASH_POOL', '1') != '0'
+HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', 2))
+HASH_QUEUE_LIMIT = int(os.environ.get('PASSWORD_HASH_QUEUE', HASH_WORKERS * 4))
+HASH_TIMEOUT = float(os.environ.get('PASSWORD_HASH_TIMEOUT', 10))
+
+
+class HashingBusy(Exception):
+    """Troppi hash in attesa: la richiesta va rifiutata e ritentata più tardi"""
+
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(HASH_QUEUE_LIMIT)
+
+
+def _get_executor():
+    global _executor, _executor_pid
+    with _executor_lock:
+        # Un pool creato prima di un fork non è utilizzabile nel processo figlio
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ProcessPoolExecutor(HASH_WORKERS)
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def start():
+    """Crea subito i processi del pool.
+
+    Va chiamata all'avvio, prima dei thread in background (Mongo, coda
+    eliminazioni): con il fork i processi del pool partono tutti al primo
+    submit, e fare fork di un processo che ha già altri thread può bloccare
+    il figlio su un lock rimasto acquisito.
+    """
+    if HASH_POOL_ENABLED:
+        _get_executor().submit(int).result()
+
+
+def _run(function, *args):
+    if not HASH_POOL_ENABLED:
+        return function(*args)
+    if not _slots.acquire(blocking=False):
+        raise HashingBusy()
+    try:
+        return _get_executor().submit(function, *args).result(timeout=HASH_TIMEOUT)
+    except FutureTimeoutError:
+        logger.warning("Hash della password non completato entro %ss", HASH_TIMEOUT)
+        raise HashingBusy()
+    except BrokenProcessPool as e:
+        # Un processo del pool è morto: il pool va ricreato alla prossima richiesta
+        logger.error("Pool degli hash non più utilizzabile: %s", e)
+        shutdown()
+        raise HashingBusy()
+    finally:
+        _slots.release()
+
+
+def hash_password(password):
+    return _run(generate_password_hash, password, HASH_METHOD)
+
+
+def check_password(pwhash, password):
+    return _run(check_password_hash, pwhash, password)
+
+
+@functools.lru_cache(maxsize=None)
+def _method_prefix():
+    """Prefisso completo che werkzeug salva per HASH_METHOD (es. 'scrypt' -> 'scrypt:32768:8:1').
+
+    Ricavato dalla stringa con gli stessi default di werkzeug, senza calcolare un hash.
+    """
+    method, *args = HASH_METHOD.split(':')
+    if method == 'scrypt':
+        n, r, p = map(int, args) if args else (2 ** 15, 8, 1)
+        return f"scrypt:{n}:{r}:{p}"
+    if method == 'pbkdf2':
+        hash_name = args[0] if args else 'sha256'
+        iterations = int(args[1]) if len(args) > 1 else DEFAULT_PBKDF2_ITERATIONS
+        return f"pbkdf2:{hash_name}:{iterations}"
+    raise ValueError(f"PASSWORD_HASH_METHOD non valido: {HASH_METHOD}")
+
+
+def needs_rehash(pwhash):
+    """True se l'hash è stato calcolato con un metodo o parametri diversi da HASH_METHOD"""
+    return pwhash.split('$', 1)[0] != _method_prefix()
+
+
+def shutdown():
+    """Ferma il pool del processo corrente"""
+    global _executor
+    with _executor_lock:
+        if _executor is not None and _executor_pid == os.getpid():
+            _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
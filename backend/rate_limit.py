@@ -0,0 +1,92 @@
+"""Limitazione dei tentativi di login e registrazione (token bucket).
+
+Ogni chiave ha un secchiello di 'capacity' gettoni che si ricarica di
+'rate' gettoni al secondo. Il controllo avviene prima di calcolare qualunque
+hash, così una raffica di tentativi viene respinta con 429 senza consumare CPU:
+- per IP del client ogni tentativo consuma un gettone;
+- per email consumano solo i login falliti (record_failure), e la chiave
+  include l'IP: chi sbaglia la password di un altro utente non può
+  bloccarne l'accesso da un'altra rete.
+
+L'IP è request.remote_addr: dietro un reverse proxy va impostato
+TRUSTED_PROXIES (vedi app.py), altrimenti tutti i client condividono
+l'indirizzo del proxy. I secchielli sono nel processo: con più worker i
+limiti valgono per worker. LOGIN_RATE_IP (default '20/60': 20 tentativi,
+ricaricati in 60 secondi), LOGIN_RATE_EMAIL (default '5/60'),
+LOGIN_RATE_LIMIT=0 per disattivarli.
+"""
+import os
+import threading
+import time
+
+RATE_LIMIT_ENABLED = os.environ.get('LOGIN_RATE_LIMIT', '1') != '0'
+# Secchielli oltre questo numero: si eliminano quelli già pieni (inattivi)
+MAX_BUCKETS = 10000
+
+
+def _parse_rate(value):
+    """'N/S' -> (capacità N, ricarica N/S gettoni al secondo)"""
+    count, seconds = value.split('/')
+    return int(count), int(count) / float(seconds)
+
+
+class TokenBucketLimiter:
+    """Token bucket per chiave, thread-safe"""
+
+    def __init__(self, capacity, rate, max_buckets=MAX_BUCKETS):
+        self.capacity = capacity
+        self.rate = rate
+        self.max_buckets = max_buckets
+        self._buckets = {}  # chiave -> (gettoni, istante dell'ultimo aggiornamento)
+        self._lock = threading.Lock()
+
+    def _tokens(self, key, now):
+        tokens, updated = self._buckets.get(key, (self.capacity, now))
+        return min(self.capacity, tokens + (now - updated) * self.rate)
+
+    def consume(self, key):
+        """Consuma un gettone: 0 se il tentativo è ammesso, altrimenti i secondi da attendere"""
+        now = time.monotonic()
+        with self._lock:
+            tokens = self._tokens(key, now)
+            if tokens < 1:
+                self._buckets[key] = (tokens, now)
+                return (1 - tokens) / self.rate
+            self._buckets[key] = (tokens - 1, now)
+            if len(self._buckets) > self.max_buckets:
+                self._prune(now)
+            return 0
+
+    def wait_time(self, key):
+        """Secondi da attendere per il prossimo gettone, senza consumarlo (0 se disponibile)"""
+        with self._lock:
+            tokens = self._tokens(key, time.monotonic())
+        return 0 if tokens >= 1 else (1 - tokens) / self.rate
+
+    def _prune(self, now):
+        for key in [k for k in self._buckets if self._tokens(k, now) >= self.capacity]:
+            del self._buckets[key]
+
+
+ip_limiter = TokenBucketLimiter(*_parse_rate(os.environ.get('LOGIN_RATE_IP', '20/60')))
+email_limiter = TokenBucketLimiter(*_parse_rate(os.environ.get('LOGIN_RATE_EMAIL', '5/60')))
+
+
+def _email_key(ip, email):
+    return f"email:{email.strip().lower()}|ip:{ip}"
+
+
+def check_login(ip, email=None):
+    """Secondi da attendere prima di un nuovo tentativo (0 se ammesso)"""
+    if not RATE_LIMIT_ENABLED:
+        return 0
+    wait = ip_limiter.consume(f"ip:{ip}")
+    if email:
+        wait = max(wait, email_limiter.wait_time(_email_key(ip, email)))
+    return wait
+
+
+def record_failure(ip, email):
+    """Conta un login fallito per l'email (dallo stesso IP)"""
+    if RATE_LIMIT_ENABLED and email:
+        email_limiter.consume(_email_key(ip, email))
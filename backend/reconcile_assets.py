@@ -0,0 +1,163 @@
+"""Riconciliazione tra i file dei ricordi su MongoDB e le risorse su Cloudinary.
+
+Trova i file "orfani": caricati su Cloudinary (upload finiti nel browser ma mai
+salvati in un ricordo, eliminazioni fallite) e non più referenziati da nessun
+ricordo. Il confronto avviene in due metà:
+  1. i file di tutti i ricordi vengono letti da un cursore e ridotti a un set
+     di chiavi "resource_type/public_id";
+  2. l'elenco delle risorse nella cartella degli upload viene sfogliato con
+     l'Admin API, pagina per pagina, e confrontato con il set.
+Le risorse più recenti di GRACE_HOURS non vengono mai toccate (upload in corso
+o ricordi non ancora salvati). Gli orfani vengono eliminati a lotti con
+delete_resources_bulk. Per i test basta impostare CLOUDINARY_API_URL su uno
+stub HTTP locale.
+
+Uso:
+    python reconcile_assets.py                    # solo report (dry run)
+    python reconcile_assets.py --apply            # elimina gli orfani
+    python reconcile_assets.py --apply --every 24 # ripete ogni 24 ore
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+import db_manager
+import observability
+from cloudinary_config import (
+    RESOURCE_TYPES, UPLOAD_FOLDER, BULK_DELETE_LIMIT,
+    deletion_candidates, list_resources, delete_resources_bulk
+)
+
+logger = logging.getLogger(__name__)
+
+GRACE_HOURS = float(os.environ.get('RECONCILE_GRACE_HOURS', 24))
+
+
+def _key(resource_type, public_id):
+    return f"{resource_type}/{public_id}"
+
+
+def referenced_keys():
+    """Set delle risorse referenziate dai ricordi.
+
+    Per i file senza resource_type/public_id registrati si aggiungono tutte
+    le varianti possibili: meglio tenere un orfano che eliminare un file usato.
+    """
+    keys = set()
+    for url, resource_type, public_id in db_manager.iter_file_references():
+        for candidate in deletion_candidates(url, resource_type, public_id):
+            keys.add(_key(*candidate))
+    return keys
+
+
+def iter_resources(resource_type, prefix):
+    """Tutte le risorse di un resource_type sotto prefix, seguendo next_cursor"""
+    next_cursor = None
+    while True:
+        page = list_resources(resource_type, prefix=prefix, next_cursor=next_cursor)
+        yield from page.get('resources', [])
+        next_cursor = page.get('next_cursor')
+        if not next_cursor:
+            return
+
+
+def _created_at(resource):
+    try:
+        return datetime.strptime(resource.get('created_at', ''), '%Y-%m-%dT%H:%M:%SZ')
+    except ValueError:
+        return None
+
+
+def find_orphans(referenced, prefix=UPLOAD_FOLDER, grace_hours=GRACE_HOURS):
+    """Risorse su Cloudinary non referenziate e più vecchie del periodo di grazia"""
+    cutoff = datetime.utcnow() - timedelta(hours=grace_hours)
+    orphans = []
+    for resource_type in RESOURCE_TYPES:
+        for resource in iter_resources(resource_type, prefix):
+            if _key(resource_type, resource['public_id']) in referenced:
+                continue
+            created_at = _created_at(resource)
+            if created_at is None or created_at > cutoff:
+                continue
+            orphans.append({
+                'resource_type': resource_type,
+                'public_id': resource['public_id'],
+                'url': resource.get('secure_url'),
+                'bytes': resource.get('bytes', 0)
+            })
+    return orphans
+
+
+def delete_orphans(orphans):
+    """Elimina gli orfani a lotti di BULK_DELETE_LIMIT; ritorna (eliminati, errori)"""
+    deleted = []
+    errors = 0
+    for resource_type in RESOURCE_TYPES:
+        batch = [o for o in orphans if o['resource_type'] == resource_type]
+        for start in range(0, len(batch), BULK_DELETE_LIMIT):
+            chunk = batch[start:start + BULK_DELETE_LIMIT]
+            try:
+                outcome = delete_resources_bulk(resource_type, [o['public_id'] for o in chunk])
+            except Exception as e:
+                logger.error("Errore nell'eliminazione degli orfani (%s): %s", resource_type, e)
+                errors += len(chunk)
+                continue
+            for orphan in chunk:
+                if outcome.get(orphan['public_id']) in ('deleted', 'not_found'):
+                    deleted.append(orphan)
+                else:
+                    errors += 1
+    # Gli upload registrati ma mai salvati in un ricordo non servono più
+    db_manager.delete_upload_records(o['url'] for o in deleted if o['url'])
+    return len(deleted), errors
+
+
+def reconcile(apply=False, prefix=UPLOAD_FOLDER, grace_hours=GRACE_HOURS):
+    """Esegue la riconciliazione e ritorna un report; elimina solo se apply è True"""
+    started = time.monotonic()
+    referenced = referenced_keys()
+    orphans = find_orphans(referenced, prefix, grace_hours)
+    report = {
+        'referenced': len(referenced),
+        'orphans': len(orphans),
+        'orphan_bytes': sum(o['bytes'] for o in orphans),
+        'deleted': 0,
+        'errors': 0
+    }
+    if apply and orphans:
+        report['deleted'], report['errors'] = delete_orphans(orphans)
+    report['seconds'] = round(time.monotonic() - started, 2)
+    return report, orphans
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Trova ed elimina i file Cloudinary non usati da nessun ricordo')
+    parser.add_argument('--apply', action='store_true', help='elimina gli orfani (altrimenti solo report)')
+    parser.add_argument('--prefix', default=UPLOAD_FOLDER, help='cartella Cloudinary da controllare')
+    parser.add_argument('--grace-hours', type=float, default=GRACE_HOURS,
+                        help='ignora le risorse caricate da meno di queste ore')
+    parser.add_argument('--every', type=float, default=0, help='ripete la riconciliazione ogni N ore')
+    parser.add_argument('--verbose', action='store_true', help='elenca gli orfani trovati')
+    args = parser.parse_args(argv)
+    observability.configure_logging()
+
+    while True:
+        try:
+            report, orphans = reconcile(args.apply, args.prefix, args.grace_hours)
+            if args.verbose:
+                for orphan in orphans:
+                    print(f"  {orphan['resource_type']}/{orphan['public_id']} ({orphan['bytes']} byte)")
+            print(f"Riconciliazione Cloudinary{'' if args.apply else ' (dry run)'}: {report}")
+        except Exception as e:
+            print(f"Errore nella riconciliazione Cloudinary: {e}")
+            if not args.every:
+                return 1
+        if not args.every:
+            return 0
+        time.sleep(args.every * 3600)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,196 @@
+"""Servizio dei file statici della build del frontend (frontend/dist).
+
+All'avvio la cartella viene letta una volta sola in un manifest in memoria
+(percorso -> dimensione, data, ETag, tipo e varianti precompresse), così le
+richieste non toccano il filesystem per cercare i file:
+- i file con hash nel nome (_app/immutable/ di SvelteKit) hanno
+  Cache-Control 'immutable' per un anno;
+- gli altri (Cesium, favicon...) hanno STATIC_MAX_AGE secondi (default un
+  giorno) e poi vengono rivalidati con l'ETag;
+- se esistono file .br/.gz accanto all'originale vengono inviati quelli,
+  secondo l'Accept-Encoding del client;
+- index.html (anche come fallback delle route della SPA) resta in memoria,
+  già compresso, e viene sempre rivalidato.
+
+Le varianti precompresse si creano dopo 'npm run build' con:
+    python static_assets.py precompress
+
+STATIC_MANIFEST=0 torna a leggere i file ad ogni richiesta (utile in
+sviluppo, quando la build cambia senza riavviare il backend).
+"""
+import argparse
+import gzip
+import hashlib
+import mimetypes
+import os
+import time
+import compression
+
+STATIC_MANIFEST = os.environ.get('STATIC_MANIFEST', '1') != '0'
+STATIC_MAX_AGE = int(os.environ.get('STATIC_MAX_AGE', 86400))
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+# Cartelle i cui file hanno l'hash del contenuto nel nome
+IMMUTABLE_PREFIXES = ('_app/immutable/',)
+# Estensione del file precompresso per ogni codifica, in ordine di preferenza
+VARIANT_EXTENSIONS = {'br': '.br', 'gzip': '.gz'}
+# Tipi da precomprimere (le immagini e i video sono già compressi)
+PRECOMPRESS_EXTENSIONS = ('.html', '.js', '.mjs', '.css', '.json', '.svg', '.xml', '.txt', '.wasm', '.glsl', '.map')
+PRECOMPRESS_MIN_SIZE = 1024
+INDEX_FILE = 'index.html'
+
+
+class StaticManifest:
+    """Indice in memoria dei file di una build statica"""
+
+    def __init__(self, root):
+        self.root = root
+        self.files = {}
+        self.index = None
+        self.scanned_at = None
+
+    def scan(self):
+        """Legge la cartella della build; se non esiste il manifest resta vuoto"""
+        files = {}
+        for dirpath, _, filenames in os.walk(self.root):
+            names = set(filenames)
+            for name in filenames:
+                # Le varianti precompresse vengono registrate insieme all'originale
+                if any(name.endswith(ext) and name[:-len(ext)] in names for ext in VARIANT_EXTENSIONS.values()):
+                    continue
+                path = os.path.join(dirpath, name)
+                relative = os.path.relpath(path, self.root).replace(os.sep, '/')
+                files[relative] = _entry(path, relative, names)
+        self.files = files
+        self.index = self._load_index()
+        self.scanned_at = time.time()
+        return self
+
+    def _load_index(self):
+        entry = self.files.get(INDEX_FILE)
+        if entry is None:
+            return None
+        with open(entry['path'], 'rb') as f:
+            body = f.read()
+        bodies = {None: body}
+        for encoding in compression.available_encodings():
+            bodies[encoding] = compression.compress(body, encoding)
+        return {'bodies': bodies, 'etag': hashlib.sha1(body).hexdigest()[:16]}
+
+    def stats(self):
+        return {
+            'files': len(self.files),
+            'bytes': sum(entry['size'] for entry in self.files.values()),
+            'precompressed': sum(1 for entry in self.files.values() if entry['variants']),
+            'immutable': sum(1 for entry in self.files.values() if entry['immutable']),
+        }
+
+
+def _entry(path, relative, names):
+    stat = os.stat(path)
+    name = os.path.basename(path)
+    mimetype, _ = mimetypes.guess_type(name)
+    return {
+        'path': path,
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        # Dimensione e data bastano: la build riscrive i file che cambiano
+        'etag': f"{stat.st_size:x}-{int(stat.st_mtime * 1000):x}",
+        'mimetype': mimetype or 'application/octet-stream',
+        'immutable': relative.startswith(IMMUTABLE_PREFIXES),
+        'variants': {
+            encoding: path + ext
+            for encoding, ext in VARIANT_EXTENSIONS.items()
+            if name + ext in names
+        },
+    }
+
+
+def send_asset(manifest, filename, request):
+    """Risposta per un file della build, o None se non è nel manifest"""
+    from flask import send_file
+
+    entry = manifest.files.get(filename)
+    if entry is None:
+        return None
+    encoding = None
+    if entry['variants'] and compression.COMPRESSION_ENABLED:
+        encoding = request.accept_encodings.best_match(list(entry['variants']))
+    response = send_file(
+        entry['variants'][encoding] if encoding else entry['path'],
+        mimetype=entry['mimetype'],
+        etag=f"{entry['etag']}-{encoding or 'identity'}",
+        last_modified=entry['mtime'],
+        max_age=IMMUTABLE_MAX_AGE if entry['immutable'] else STATIC_MAX_AGE,
+        conditional=True
+    )
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    if entry['variants']:
+        response.vary.add('Accept-Encoding')
+    if entry['immutable']:
+        response.cache_control.immutable = True
+    return response
+
+
+def send_index(manifest, request):
+    """index.html dalla memoria, o None se la build non c'è"""
+    from flask import current_app
+
+    index = manifest.index
+    if index is None:
+        return None
+    encoding = compression.choose_encoding(request)
+    response = current_app.response_class(index['bodies'][encoding], mimetype='text/html')
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    response.set_etag(f"{index['etag']}-{encoding or 'identity'}")
+    # Sempre rivalidato: dopo un deploy deve puntare subito ai nuovi asset
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+
+def precompress(root, force=False):
+    """Crea accanto ai file testuali della build le varianti .gz (e .br se brotli è installato)"""
+    created = 0
+    encodings = compression.available_encodings()
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            if not name.endswith(PRECOMPRESS_EXTENSIONS):
+                continue
+            path = os.path.join(dirpath, name)
+            if os.path.getsize(path) < PRECOMPRESS_MIN_SIZE:
+                continue
+            with open(path, 'rb') as f:
+                data = None
+                for encoding in encodings:
+                    target = path + VARIANT_EXTENSIONS[encoding]
+                    if not force and os.path.exists(target) and os.path.getmtime(target) >= os.path.getmtime(path):
+                        continue
+                    if data is None:
+                        data = f.read()
+                    if encoding == 'br':
+                        body = compression.brotli.compress(data, quality=11)
+                    else:
+                        body = gzip.compress(data, compresslevel=9, mtime=0)
+                    # Una variante più grande dell'originale non serve
+                    if len(body) >= len(data):
+                        continue
+                    with open(target, 'wb') as out:
+                        out.write(body)
+                    created += 1
+    return created
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='File statici della build del frontend')
+    parser.add_argument('command', choices=['precompress', 'stats'])
+    parser.add_argument('--root', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'frontend', 'dist'))
+    parser.add_argument('--force', action='store_true', help='ricrea anche le varianti già aggiornate')
+    args = parser.parse_args()
+    if not os.path.isdir(args.root):
+        raise SystemExit(f"Build non trovata in {args.root}: esegui prima 'npm run build'")
+    if args.command == 'precompress':
+        print(f"Varianti create: {precompress(args.root, args.force)}")
+    else:
+        print(StaticManifest(args.root).scan().stats())
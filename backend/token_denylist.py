@@ -0,0 +1,61 @@
+"""Denylist compatta dei JWT revocati (logout).
+
+Ogni processo tiene in memoria solo jti -> scadenza dei token revocati e non
+ancora scaduti, così la verifica di un token non fa I/O. Le revoche sono
+salvate anche su MongoDB (collezione con indice TTL) e ogni processo le
+risincronizza al massimo ogni SYNC_INTERVAL secondi, in modo che un logout
+valga per tutti i worker.
+"""
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timezone
+import db_manager
+
+logger = logging.getLogger(__name__)
+
+SYNC_INTERVAL = float(os.environ.get('JWT_DENYLIST_SYNC_INTERVAL', 30))
+
+
+class TokenDenylist:
+    def __init__(self, sync_interval=SYNC_INTERVAL):
+        self.sync_interval = sync_interval
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._last_sync = None
+        self._next_sync = 0.0
+
+    def revoke(self, jti, exp):
+        """Revoca il token con identificativo jti e scadenza exp (timestamp Unix)"""
+        expires_at = datetime.fromtimestamp(exp, tz=timezone.utc).replace(tzinfo=None)
+        with self._lock:
+            self._entries[jti] = expires_at
+        db_manager.add_revoked_token(jti, expires_at)
+
+    def is_revoked(self, jti):
+        self._maybe_sync()
+        with self._lock:
+            expires_at = self._entries.get(jti)
+        return expires_at is not None and expires_at > datetime.utcnow()
+
+    def _maybe_sync(self):
+        now = time.monotonic()
+        if now < self._next_sync:
+            return
+        with self._lock:
+            if now < self._next_sync:
+                return
+            self._next_sync = now + self.sync_interval
+            since = self._last_sync
+        sync_started = datetime.utcnow()
+        try:
+            revoked = db_manager.get_revoked_tokens_since(since)
+        except Exception as e:
+            logger.warning("Impossibile sincronizzare la denylist dei token: %s", e)
+            return
+        with self._lock:
+            self._entries.update(revoked)
+            # Elimina i token già scaduti: non servono più
+            self._entries = {jti: exp for jti, exp in self._entries.items() if exp > sync_started}
+            self._last_sync = sync_started
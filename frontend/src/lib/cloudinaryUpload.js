@@ -0,0 +1,56 @@
+// Upload diretti su Cloudinary firmati dal backend.
+// Il backend firma i parametri (/api/uploads/sign), i file partono in parallelo
+// e le risposte vengono registrate (/api/uploads/complete) con public_id,
+// resource_type, dimensioni e peso esatti.
+
+async function uploadOne(file, displayName, signed) {
+    const formData = new FormData();
+    formData.append('file', file);
+    formData.append('api_key', signed.api_key);
+    formData.append('timestamp', signed.timestamp);
+    formData.append('folder', signed.folder);
+    formData.append('signature', signed.signature);
+
+    const res = await fetch(signed.upload_url, { method: 'POST', body: formData });
+    const data = await res.json();
+    if (!data.secure_url) {
+        throw new Error(data.error?.message || 'upload fallito');
+    }
+    return { ...data, display_name: displayName, type: file.type };
+}
+
+/**
+ * Carica i file in parallelo e ritorna i file registrati, pronti per
+ * POST /api/memories o PUT /api/memories/... (campo files).
+ * Se memoryId è indicato i file vengono anche allegati direttamente al ricordo.
+ */
+export async function uploadFilesToCloudinary(files, displayNames, memoryId = null) {
+    if (!files.length) return [];
+    const signRes = await fetch('/api/uploads/sign', { method: 'POST' });
+    if (!signRes.ok) {
+        alert('Errore durante la preparazione dell\'upload');
+        return [];
+    }
+    const signed = await signRes.json();
+
+    const results = await Promise.allSettled(
+        Array.from(files, (file, i) => uploadOne(file, displayNames[i] || file.name, signed))
+    );
+    const uploads = [];
+    results.forEach((result, i) => {
+        if (result.status === 'fulfilled') {
+            uploads.push(result.value);
+        } else {
+            alert('Errore durante l\'upload di ' + files[i].name);
+        }
+    });
+    if (!uploads.length) return [];
+
+    const completeRes = await fetch('/api/uploads/complete', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ uploads, memory_id: memoryId })
+    });
+    const data = await completeRes.json();
+    return data.files || [];
+}
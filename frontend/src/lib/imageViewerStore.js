@@ -159,14 +159,23 @@ export const isImageFile = (file) => {
            /\.(jpg|jpeg|png|gif|bmp|webp|svg)$/i.test(file.url || file.name || '');
 };
 
+// URL di una variante ridotta del file ('thumbnail', 'preview', 'poster'), se il backend l'ha calcolata.
+// I dettagli del ricordo hanno la mappa completa (derivatives), le liste solo il campo della variante
+export const fileVariant = (file, variant) => {
+    if (!file) return null;
+    return (file.derivatives && file.derivatives[variant]) || file[variant] || null;
+};
+
 // Helper per gestire l'apertura di un file (immagine, video o altro)
 export const handleFileOpen = (file) => {
+    // Il visualizzatore usa la variante 'preview' (già ridimensionata) invece dell'originale
+    const viewUrl = fileVariant(file, 'preview') || file.url;
     if (isImageFile(file)) {
-        openImageViewer(file.url, file.display_name || file.original_name || file.name);
+        openImageViewer(viewUrl, file.display_name || file.original_name || file.name);
     } else if (isVideoFile(file)) {
         // Importa dinamicamente il videoViewerStore per evitare dipendenze circolari
         import('./videoViewerStore.js').then(module => {
-            module.openVideoViewer(file.url, file.display_name || file.original_name || file.name);
+            module.openVideoViewer(viewUrl, file.display_name || file.original_name || file.name);
         });
     } else {
         // Open non-media files in new tab as before
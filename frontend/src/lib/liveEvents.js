@@ -0,0 +1,98 @@
+// Aggiornamenti in tempo reale da GET /api/events (Server-Sent Events).
+// Le modifiche fatte da altre schede o dispositivi arrivano come piccoli eventi
+// { entity, op, id } e vengono rilanciate come gli eventi window già ascoltati
+// dai pannelli ('memory-updated', 'position-updated'), che ricaricano le liste.
+
+// Riconnessione dopo una chiusura (token scaduto, 503 per troppe connessioni):
+// attesa che raddoppia ad ogni tentativo fallito, fino a RECONNECT_MAX_DELAY
+const RECONNECT_DELAY = 5000;
+const RECONNECT_MAX_DELAY = 5 * 60 * 1000;
+
+let source = null;
+let reconnectTimer = null;
+let failures = 0;
+// Aumenta ad ogni stop: una connessione in corso di apertura si ferma
+let generation = 0;
+let connectedBefore = false;
+
+function reconnectDelay() {
+    const delay = Math.min(RECONNECT_DELAY * 2 ** failures, RECONNECT_MAX_DELAY);
+    failures += 1;
+    // Un po' di casualità: le schede non si ricollegano tutte nello stesso istante
+    return delay / 2 + Math.random() * delay / 2;
+}
+
+function notify(entity) {
+    if (entity === 'memory') {
+        window.dispatchEvent(new CustomEvent('memory-updated'));
+    } else {
+        // Una posizione modificata cambia anche i ricordi che la citano
+        window.dispatchEvent(new CustomEvent('position-updated'));
+        window.dispatchEvent(new CustomEvent('memory-updated'));
+    }
+}
+
+function scheduleReconnect() {
+    clearTimeout(reconnectTimer);
+    reconnectTimer = setTimeout(connect, reconnectDelay());
+}
+
+// EventSource non permette header: nella query string va un token breve,
+// valido solo per /api/events, non quello delle API (finirebbe nei log)
+async function eventsToken() {
+    const response = await fetch('/api/events/token', { method: 'POST' });
+    if (!response.ok) throw new Error(`token eventi: ${response.status}`);
+    return (await response.json()).token;
+}
+
+async function connect() {
+    if (!localStorage.getItem('token') || typeof EventSource === 'undefined') return;
+    const current = generation;
+    let token;
+    try {
+        token = await eventsToken();
+    } catch {
+        if (current === generation) scheduleReconnect();
+        return;
+    }
+    if (current !== generation || source) return;
+
+    source = new EventSource(`/api/events?jwt=${encodeURIComponent(token)}`);
+    source.onopen = () => {
+        failures = 0;
+        // Riaperta con un token nuovo: il server non sa cosa si è perso
+        if (connectedBefore) notify('location');
+        connectedBefore = true;
+    };
+    source.addEventListener('change', (e) => {
+        const change = JSON.parse(e.data);
+        notify(change.entity);
+    });
+    // Eventi persi (riconnessione o client troppo lento): si ricarica tutto
+    source.addEventListener('resync', () => notify('location'));
+    source.onerror = () => {
+        // Errori di rete: il browser si ricollega da solo. Se la connessione è
+        // chiusa (token breve scaduto, 503 per troppe connessioni) si chiede un
+        // token nuovo, aspettando sempre di più finché il server non risponde
+        if (source.readyState === EventSource.CLOSED) {
+            source = null;
+            scheduleReconnect();
+        }
+    };
+}
+
+export function startLiveEvents() {
+    if (source) return;
+    connect();
+}
+
+export function stopLiveEvents() {
+    clearTimeout(reconnectTimer);
+    generation += 1;
+    failures = 0;
+    connectedBefore = false;
+    if (source) {
+        source.close();
+        source = null;
+    }
+}
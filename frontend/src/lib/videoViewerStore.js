@@ -162,6 +162,7 @@ export const isVideoFile = (file) => {
 // Helper per gestire l'apertura di un file video
 export const handleVideoOpen = (file) => {
     if (isVideoFile(file)) {
-        openVideoViewer(file.url, file.display_name || file.original_name || file.name);
+        const preview = (file.derivatives && file.derivatives.preview) || file.preview;
+        openVideoViewer(preview || file.url, file.display_name || file.original_name || file.name);
     }
 };